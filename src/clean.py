@@ -198,8 +198,8 @@ def clean_ais_data(
     data there is within the inclusion radius and that have positional data.
     '''
 
-    # Threading differences between systems.
-    number_of_threads = get_num_of_threads(use_all_threads)
+    # Threading differences between systems. The pool of this step has always taken every thread.
+    number_of_threads = get_num_of_threads(use_all_threads=True)
 
     # Read in the hydrophone deployments as we will treat each deployment as an individual dataset.
     hydrophone_deployments = get_hydrophone_deployments(deployment_directory)
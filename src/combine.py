@@ -87,7 +87,7 @@ def interpolation_for_chunks(_chunk):
     else:
         _chunk = _chunk.drop(labels=["time_difference", "to_interpolate"], axis=1)
 
-        return pd.DataFrame(columns=_chunk.columns)
+        return _chunk.iloc[:0]
 
 
 def combine_deployment_ais_data(
@@ -100,13 +100,13 @@ def combine_deployment_ais_data(
 ):
     '''
     This function combines the feather files from the same deployment into one
-    unique cleaned file. It also generate a new interpolated file, with values
-    for the location with more granularity with values generated from the linear
+    unique cleaned file. It also generate a delta file with only the new rows,
+    with values for the location with more granularity generated from the linear
     interpolation of the real ais messages from the original feather files.
     '''
 
-    # Threading differences between systems.
-    number_of_threads = get_num_of_threads(use_all_threads)
+    # Threading differences between systems. The pool of this step has always taken every thread.
+    number_of_threads = get_num_of_threads(use_all_threads=True)
 
     # Find all of the cleaned AIS files for each deployment.
     cleaned_ais_files = [file for file in os.listdir(clean_ais_directory)]
@@ -220,7 +220,9 @@ def combine_deployment_ais_data(
             output_file_name = os.path.join(
                 combined_deployment_directory, output_file_name
             )
-            dump_data_frame_to_feather_file(output_file_name, data_frame)
+            # Uncompressed files can be memory-mapped without decoding, which makes
+            # repeated reads of the big combined files (almost) free.
+            dump_data_frame_to_feather_file(output_file_name, data_frame, compression="uncompressed")
 
             print(
                 "  This took {0:.3f} seconds to process".format(
@@ -250,7 +252,11 @@ def combine_deployment_ais_data(
             threading_pool.close()
             threading_pool.join()
 
-            interpolated_data_frame = pd.concat(outputs)
+            # The delta has the columns and types of the raw file, even without any rows to interpolate.
+            # The integer columns forward filled over the new rows are cast back from floats.
+            interpolated_data_frame = pd.concat(
+                [data_frame.iloc[:0]] + [output for output in outputs if output.shape[0]]
+            ).astype(data_frame.dtypes.to_dict())
 
             print(
                 f"  There are {interpolated_data_frame.shape[0]} interpolated entries across {interpolated_data_frame.mmsi.unique().shape[0]} MMSI's"
@@ -261,42 +267,30 @@ def combine_deployment_ais_data(
                 )
             )
 
-            # Combine the raw and interpolated data frames.
-            print("Combining the raw and interpolated data frames...")
+            # Only the interpolated rows are stored, the raw ones are already in the monolithic file.
+            # Use utils.read_interpolated_ais_data to get the merged and time-ordered view of both files.
+            print("Dumping interpolated deployment AIS rows to a delta FEATHER file...")
 
             start_time = time.time()
-            data_frame = pd.concat(
-                [data_frame, interpolated_data_frame], ignore_index=True
+            interpolated_data_frame = interpolated_data_frame.sort_values(
+                by="pd_timestamp", kind="stable", ignore_index=True
             )
-            data_frame.sort_values(by="pd_timestamp", inplace=True, ignore_index=True)
+            interpolated_data_frame["is_interpolated"] = True
 
-            print(
-                f"  There are now {data_frame.shape[0]} combined entries across {data_frame.mmsi.unique().shape[0]} MMSI's"
-            )
-            print(
-                "  This took {0:.3f} seconds to process".format(
-                    time.time() - start_time
-                )
-            )
-
-            print(
-                "Dumping interpolated deployment AIS data to a monolithic FEATHER file..."
-            )
-
-            start_time = time.time()
             output_file_name = "_".join(
                 [
                     device,
                     pandas_timestamp_to_zulu_format(deployment_begin),
                     pandas_timestamp_to_zulu_format(deployment_end),
-                    "clean_interpolated_ais_data.feather",
+                    "clean_interpolated_delta_ais_data.feather",
                 ]
             )
             output_file_name = os.path.join(
                 combined_deployment_directory, output_file_name
             )
 
-            dump_data_frame_to_feather_file(output_file_name, data_frame)
+            # Uncompressed too, as the delta file is read memory-mapped with the raw one.
+            dump_data_frame_to_feather_file(output_file_name, interpolated_data_frame, compression="uncompressed")
             print(
                 "  This took {0:.3f} seconds to process...".format(
                     time.time() - start_time
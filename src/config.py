@@ -15,15 +15,31 @@ WORK_DIR="/workspaces/underwater/dataset"
 # 11 - Generate metadata for small periods of duration
 # 12 - Split dataset into Train, Test and Validation
 # 13 - Generate a balanced version of the full dataset
+# 14 - Build the vessel track index
 STEPS=[0,1,2,3,4,5,6,7,8,9,10]
 
 MAX_INCLUSION_RADIUS=15000.0
 INCLUSION_RADIUS=4000
 
+# Inclusion radius grid (metres) searched on step 5, as [minimum, maximum, step].
+SCENARIO_RADII=[1000, 10000, 1000]
+# The exclusion radius is the inclusion radius plus this offset (metres).
+EXCLUSION_RADIUS_OFFSET=2000
+# Minimum consecutive minutes of a background or unique vessel interval.
+BACKGROUND_MINIMUM_MINUTES=30
+VESSEL_MINIMUM_MINUTES=5
+
 METADATA_SECONDS=1
 METADATA_FILE="metadata"
+# Format of the metadata files written and read on steps 10 to 13, "csv" or "parquet".
+METADATA_FORMAT="csv"
 METADATA_VAL_SPLIT=0.2
 METADATA_TEST_SPLIT=0.1
+# Define if step 11 writes one row per segment with its number of windows instead of one row per window.
+RANGE_ENCODED_METADATA=False
+# Define if step 12 assigns each segment to a split by a hash of its path, reading the metadata in chunks, instead of shuffling all of it in memory.
+# The test and validation splits are then fractions of all of the rows, not of the smallest class times the number of classes.
+HASH_SPLIT=False
 
 # Pacific - Salish Sea - Strait of Georgia - Fraser River Delta (49.080927,-123.338713)
 AIS_CODE = "DIGITALYACHTAISNET1302-0097-01"
@@ -32,3 +48,24 @@ CTD_DEVICE = "SBECTD19p6935"
 
 # Define if the metadata will include ctd information. Only needed for step 10.
 USE_CTD=True
+
+# Cadence of the bins of the CTD store built after step 9, and window of its rolling statistics.
+CTD_STORE_CADENCE="10s"
+CTD_ROLLING_WINDOW="1h"
+# Define if step 10 reads the CTD means from the CTD store instead of the cleaned CTD files. The means are then over the
+# bins that start in each segment, and the normalization is over the bins of the deployments, not over all of the CTD data.
+USE_CTD_STORE=False
+
+# Define if the inclusion and exclusion zone maps are rendered for sanity checking. Only needed for step 5.
+PLOT_MAPS=False
+
+# Number of processes exporting the audio segments on step 7. None uses half of the threads.
+WAV_EXPORT_WORKERS=None
+
+# Define if step 7 writes only a manifest of spans of the raw WAV files instead of copying the audio segments.
+VIRTUAL_SEGMENTS=False
+
+# Define if step 5 only processes the AIS days appended since its previous run.
+INCREMENTAL_IDENTIFY=False
+# Minutes before the end of the previous run that are aggregated again on an incremental run.
+INCREMENTAL_OVERLAP_MINUTES=60
@@ -0,0 +1,360 @@
+import os
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+from functools import partial
+from utils import (
+    get_num_of_threads,
+    get_hydrophone_deployments,
+    pandas_timestamp_to_zulu_format,
+    get_feather_row_range,
+    read_data_frame_from_feather_file,
+    dump_data_frame_to_feather_file,
+)
+
+
+# CTD variables averaged over the period of each audio segment.
+CTD_COLUMNS = ["t1", "c1", "p1", "sal", "sv"]
+
+# Format of the dates of the cleaned CTD files and of the interval times.
+ZULU_FORMAT = "%Y%m%dT%H%M%S.%fZ"
+
+CTD_STORE_SUFFIX = "ctd_store.feather"
+
+# Statistics of every partition of the CTD store, also used to find the partitions to rebuild.
+CTD_STORE_SUMMARY_FILE = "ctd_store_summary.csv"
+
+
+def _get_ctd_index(dates, sums, counts):
+    ctd_index = pd.DataFrame({"date": dates})
+    for column in CTD_COLUMNS:
+        ctd_index[f"{column}_sum"] = np.cumsum(sums[column])
+        ctd_index[f"{column}_count"] = np.cumsum(counts[column], dtype=np.int64)
+
+    return ctd_index
+
+
+def get_ctd_index(ctd_df):
+    '''
+    Build the aggregate index of the CTD data: the sample times as sorted
+    datetime64 values and, for each variable, the running sum and count of
+    its valid values. The mean over any time window is then the difference
+    between two rows of the index, found with searchsorted.
+    '''
+    dates = pd.to_datetime(ctd_df["date"], format=ZULU_FORMAT).to_numpy()
+    order = np.argsort(dates, kind="stable")
+
+    sums = {}
+    counts = {}
+    for column in CTD_COLUMNS:
+        values = pd.to_numeric(ctd_df[column]).to_numpy(dtype=float)[order]
+        counts[column] = ~np.isnan(values)
+        sums[column] = np.where(counts[column], values, 0.0)
+
+    return _get_ctd_index(dates[order], sums, counts)
+
+
+def get_ctd_store_index(ctd_store, cadence):
+    '''
+    Build the aggregate index of the bins of the CTD store. The bins are
+    keyed by their last instant, so the window means of the index take the
+    bins that start in [begin, end), which for windows aligned to the cadence
+    are the samples in [begin, end).
+    '''
+    dates = ctd_store["date"].to_numpy() + (pd.Timedelta(cadence) - pd.Timedelta(1, unit="ns")).to_timedelta64()
+
+    return _get_ctd_index(
+        dates,
+        {column: ctd_store[f"{column}_sum"].to_numpy() for column in CTD_COLUMNS},
+        {column: ctd_store[f"{column}_count"].to_numpy() for column in CTD_COLUMNS},
+    )
+
+
+def _get_running_totals(running_totals, positions):
+    # Position 0 is before the first sample, where every running total is zero.
+    return np.where(positions > 0, running_totals[np.maximum(positions - 1, 0)], 0)
+
+
+def get_ctd_window_means(ctd_index, begin_times, end_times):
+    '''
+    Get the mean of each CTD variable between each begin and end time (both
+    included), ignoring missing values, for all the windows at once. Each
+    window takes two binary searches on the index. Returns a DataFrame with
+    one row per window, with NaN where a window has no valid values.
+    '''
+    dates = ctd_index["date"].to_numpy()
+    starts = np.searchsorted(dates, pd.DatetimeIndex(begin_times).to_numpy(), side="left")
+    stops = np.maximum(np.searchsorted(dates, pd.DatetimeIndex(end_times).to_numpy(), side="right"), starts)
+
+    means = {}
+    for column in CTD_COLUMNS:
+        running_sums = ctd_index[f"{column}_sum"].to_numpy()
+        running_counts = ctd_index[f"{column}_count"].to_numpy()
+
+        sums = _get_running_totals(running_sums, stops) - _get_running_totals(running_sums, starts)
+        counts = _get_running_totals(running_counts, stops) - _get_running_totals(running_counts, starts)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means[column] = np.where(counts > 0, sums / counts, np.nan)
+
+    return pd.DataFrame(means)
+
+
+def get_ctd_file_timestamp(file):
+    # Same as step 9, the cleaned files are named after the beginning of their data.
+    return pd.Timestamp(file.split("_")[1].split(".")[0])
+
+
+def get_ctd_store_file(ctd_store_directory, device, deployment_begin, deployment_end):
+    return os.path.join(
+        ctd_store_directory,
+        "_".join(
+            [
+                device,
+                pandas_timestamp_to_zulu_format(deployment_begin),
+                pandas_timestamp_to_zulu_format(deployment_end),
+                CTD_STORE_SUFFIX,
+            ]
+        ),
+    )
+
+
+def get_ctd_store(ctd_df, begin, end, cadence="10s", rolling_window="1h"):
+    '''
+    Resample the CTD samples in [begin, end) to bins of a fixed cadence. Each
+    bin has, for every variable, the mean, minimum, maximum, sum and count of
+    its valid samples, and the mean, minimum and maximum over the trailing
+    rolling window. Empty bins are kept, with a count of zero.
+    '''
+    cadence = pd.Timedelta(cadence).value
+    begin = pd.Timestamp(begin).value // cadence * cadence
+    end = pd.Timestamp(end).value
+    number_of_bins = max(-(-(end - begin) // cadence), 0)
+    rolling_bins = max(pd.Timedelta(rolling_window).value // cadence, 1)
+
+    dates = pd.to_datetime(ctd_df["date"], format=ZULU_FORMAT).to_numpy().astype("datetime64[ns]").astype(np.int64)
+    is_in_range = (dates >= begin) & (dates < end)
+    bins = (dates[is_in_range] - begin) // cadence
+
+    ctd_store = pd.DataFrame({"date": (begin + np.arange(number_of_bins, dtype=np.int64) * cadence).astype("datetime64[ns]")})
+    for column in CTD_COLUMNS:
+        values = pd.to_numeric(ctd_df[column]).to_numpy(dtype=float)[is_in_range]
+        is_valid = ~np.isnan(values)
+        values = values[is_valid]
+        value_bins = bins[is_valid]
+
+        sums = np.bincount(value_bins, weights=values, minlength=number_of_bins)
+        counts = np.bincount(value_bins, minlength=number_of_bins)
+
+        minimums = np.full(number_of_bins, np.inf)
+        np.minimum.at(minimums, value_bins, values)
+        maximums = np.full(number_of_bins, -np.inf)
+        np.maximum.at(maximums, value_bins, values)
+
+        is_empty = counts == 0
+        minimums[is_empty] = np.nan
+        maximums[is_empty] = np.nan
+
+        rolling_sums = pd.Series(sums).rolling(rolling_bins, min_periods=1).sum().to_numpy()
+        rolling_counts = pd.Series(counts).rolling(rolling_bins, min_periods=1).sum().to_numpy()
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ctd_store[column] = np.where(is_empty, np.nan, sums / counts).astype(np.float32)
+            ctd_store[f"{column}_min"] = minimums
+            ctd_store[f"{column}_max"] = maximums
+            ctd_store[f"{column}_sum"] = sums
+            ctd_store[f"{column}_count"] = counts.astype(np.int32)
+            ctd_store[f"{column}_rolling_mean"] = np.where(
+                rolling_counts > 0, rolling_sums / rolling_counts, np.nan
+            ).astype(np.float32)
+
+        ctd_store[f"{column}_rolling_min"] = pd.Series(minimums).rolling(rolling_bins, min_periods=1).min().to_numpy(dtype=np.float32)
+        ctd_store[f"{column}_rolling_max"] = pd.Series(maximums).rolling(rolling_bins, min_periods=1).max().to_numpy(dtype=np.float32)
+
+    return ctd_store
+
+
+def build_deployment_ctd_store(ctd_store_file, ctd_files, begin, end, cadence="10s", rolling_window="1h"):
+    if ctd_files:
+        ctd_df = pd.concat(
+            [read_data_frame_from_feather_file(ctd_file, memory_map=False) for ctd_file in ctd_files],
+            ignore_index=True,
+        )
+    else:
+        ctd_df = pd.DataFrame(columns=["date"] + CTD_COLUMNS)
+
+    ctd_store = get_ctd_store(ctd_df, begin, end, cadence=cadence, rolling_window=rolling_window)
+    dump_data_frame_to_feather_file(ctd_store_file, ctd_store, compression="uncompressed")
+
+    summary = {
+        "file": os.path.basename(ctd_store_file),
+        "source_files": len(ctd_files),
+        "cadence": cadence,
+        "rolling_window": rolling_window,
+    }
+    for column in CTD_COLUMNS:
+        summary[f"{column}_min"] = ctd_store[f"{column}_min"].min()
+        summary[f"{column}_max"] = ctd_store[f"{column}_max"].max()
+        summary[f"{column}_sum"] = ctd_store[f"{column}_sum"].sum()
+        summary[f"{column}_count"] = ctd_store[f"{column}_count"].sum()
+
+    return summary
+
+
+def build_ctd_store(
+    deployment_directory,
+    clean_ctd_directory,
+    ctd_store_directory,
+    cadence="10s",
+    rolling_window="1h",
+    use_all_threads=False,
+):
+    '''
+    Build the CTD store: the cleaned CTD data of every deployment resampled
+    to a fixed cadence, with typed columns and rolling statistics, plus a
+    summary with the statistics of each partition. Only the deployments
+    whose cleaned files changed since the previous build are resampled.
+    '''
+
+    # Threading differences between systems.
+    number_of_threads = get_num_of_threads(use_all_threads)
+
+    # Read in the hydrophone deployments as we will treat each deployment as an individual dataset.
+    hydrophone_deployments = get_hydrophone_deployments(deployment_directory)
+
+    summary_file = os.path.join(ctd_store_directory, CTD_STORE_SUMMARY_FILE)
+    summary = pd.DataFrame(columns=["file", "source_files", "cadence", "rolling_window"])
+    if os.path.exists(summary_file):
+        summary = pd.read_csv(summary_file)
+    summary.index = summary["file"].to_numpy()
+
+    ctd_files = sorted(file for file in os.listdir(clean_ctd_directory) if file.endswith(".feather"))
+    ctd_file_timestamps = [get_ctd_file_timestamp(file) for file in ctd_files]
+
+    partitions = []
+    deployments_to_build = []
+    for device in hydrophone_deployments.keys():
+        for deployment in hydrophone_deployments[device].itertuples(index=False):
+
+            deployment_begin = pd.Timestamp(deployment.begin).normalize()
+            deployment_end = pd.Timestamp(deployment.end).normalize() + pd.DateOffset(
+                days=1
+            )
+
+            ctd_store_file = get_ctd_store_file(ctd_store_directory, device, deployment_begin, deployment_end)
+            partition = os.path.basename(ctd_store_file)
+            partitions.append(partition)
+
+            begin = deployment_begin.tz_localize(None)
+            end = deployment_end.tz_localize(None)
+
+            # The files are named after the beginning of their data, so the last one
+            # that begins before the deployment holds its first hours.
+            first_file_timestamp = max(
+                [file_timestamp for file_timestamp in ctd_file_timestamps if file_timestamp < begin], default=begin
+            )
+            deployment_ctd_files = [
+                os.path.join(clean_ctd_directory, file)
+                for file, file_timestamp in zip(ctd_files, ctd_file_timestamps)
+                if first_file_timestamp <= file_timestamp <= end
+            ]
+
+            # A partition is up to date if it was built after its cleaned files, from the same files and constants.
+            if (
+                os.path.exists(ctd_store_file)
+                and partition in summary.index
+                and summary.loc[partition, "source_files"] == len(deployment_ctd_files)
+                and summary.loc[partition, "cadence"] == cadence
+                and summary.loc[partition, "rolling_window"] == rolling_window
+                and os.path.getmtime(ctd_store_file) >= max(
+                    [os.path.getmtime(ctd_file) for ctd_file in deployment_ctd_files], default=0
+                )
+            ):
+                continue
+
+            deployments_to_build.append((ctd_store_file, deployment_ctd_files, begin, end))
+
+    print(f"Resampling the CTD data of {len(deployments_to_build)} deployments to {cadence} bins...")
+
+    function_partial = partial(build_deployment_ctd_store, cadence=cadence, rolling_window=rolling_window)
+
+    outputs = []
+    if deployments_to_build:
+        threading_pool = multiprocessing.Pool(processes=max(min(number_of_threads, len(deployments_to_build)), 1))
+        outputs = threading_pool.starmap(function_partial, deployments_to_build, chunksize=1)
+        threading_pool.close()
+        threading_pool.join()
+
+    # Partitions of deployments that are gone are removed from the store.
+    for file in os.listdir(ctd_store_directory):
+        if file.endswith(CTD_STORE_SUFFIX) and file not in partitions:
+            os.remove(os.path.join(ctd_store_directory, file))
+
+    built_partitions = [output["file"] for output in outputs]
+    summary = summary[summary.index.isin(partitions) & ~summary.index.isin(built_partitions)]
+    if outputs:
+        summary = pd.concat([summary, pd.DataFrame(outputs)], ignore_index=True)
+    # The partitions are listed by the beginning of their deployment, so reading them in order gives sorted bins.
+    summary = summary.assign(begin=[file.split("_")[1] for file in summary["file"]])
+    summary.sort_values(by=["begin", "file"]).drop(columns="begin").to_csv(summary_file, index=False)
+
+    print(f"  {len(outputs)} partitions were built, the others were up to date.")
+
+
+def get_ctd_store_statistics(ctd_store_directory):
+    '''
+    Get the global minimum, maximum, mean and number of samples of each CTD
+    variable from the summary of the CTD store.
+    '''
+    summary = pd.read_csv(os.path.join(ctd_store_directory, CTD_STORE_SUMMARY_FILE))
+
+    return pd.DataFrame(
+        {
+            "min": [summary[f"{column}_min"].min() for column in CTD_COLUMNS],
+            "max": [summary[f"{column}_max"].max() for column in CTD_COLUMNS],
+            "mean": [summary[f"{column}_sum"].sum() / summary[f"{column}_count"].sum() for column in CTD_COLUMNS],
+            "count": [summary[f"{column}_count"].sum() for column in CTD_COLUMNS],
+        },
+        index=CTD_COLUMNS,
+    )
+
+
+def read_ctd_store(ctd_store_directory):
+    '''
+    Read every partition of the CTD store, memory-mapped, into one DataFrame
+    sorted by date. The partitions are read in the order of the summary, and
+    the bins shared by overlapping deployments are kept once, from the
+    deployment that begins first. Nothing is sorted on load.
+    Returns the store and its cadence, or None if the store is empty.
+    '''
+    summary_file = os.path.join(ctd_store_directory, CTD_STORE_SUMMARY_FILE)
+    if not os.path.exists(summary_file):
+        return None
+
+    summary = pd.read_csv(summary_file)
+    if summary.empty:
+        return None
+
+    data_frames = []
+    last_date = None
+    for file in summary["file"]:
+        ctd_store_file = os.path.join(ctd_store_directory, file)
+
+        # Only the bins after the last one already read are taken.
+        row_range = None
+        if last_date is not None:
+            row_range = get_feather_row_range(
+                ctd_store_file, last_date + pd.Timedelta(1, unit="ns"), pd.Timestamp.max, time_column="date"
+            )
+
+        data_frame = read_data_frame_from_feather_file(ctd_store_file, row_range=row_range)
+        if data_frame.shape[0]:
+            data_frames.append(data_frame)
+            last_date = data_frame["date"].iloc[-1]
+
+    if not data_frames:
+        return None
+
+    return pd.concat(data_frames, ignore_index=True), summary["cadence"].iloc[0]
@@ -169,9 +169,9 @@ def download_files(output_directory, deployment_directory, token, file_type="WAV
     return
 
 
-def download_needed_wav(output_directory, deployment_directory, scenario_interval_dir, inclusion_radius, token):
+def download_needed_wav(output_directory, deployment_directory, scenario_interval_dir, inclusion_radius, token, exclusion_radius_offset=2000):
     # Define exclusion range as an offset from the inclusion.
-    exclusion_radius = 2000 + inclusion_radius
+    exclusion_radius = exclusion_radius_offset + inclusion_radius
 
     # Instantiate ONC object.
     onc_api = ONC(token, timeout=600)
@@ -1,11 +1,24 @@
 import os
+import wave
+import multiprocessing
 
 import pandas as pd
 
 from tqdm import tqdm
-from pydub import AudioSegment
+from functools import partial
 from datetime import timedelta
-from utils import create_dir, zulu_string_to_datetime, pandas_timestamp_to_onc_format
+from utils import (
+    bcolors,
+    create_dir,
+    get_num_of_threads,
+    zulu_string_to_datetime,
+    pandas_timestamp_to_onc_format,
+)
+from wav_segments import SEGMENT_MANIFEST_FILE, get_wav_header, update_wav_catalog, write_segment_manifest
+
+
+# Frames copied at a time from a source WAV file, so the memory used does not depend on the segment length.
+WAV_COPY_CHUNK_FRAMES = 65536
 
 
 def find_in_range_wav(data_from_range, wav_file_list):
@@ -35,55 +48,217 @@ def find_in_range_wav(data_from_range, wav_file_list):
     return to_download
 
 
-def split_and_save_wav(raw_wav_directory, output_save_dir, data_from_range, wav_file_names, inclusion_radius=0, interval_ais_data_directory=''):
+def get_wav_frame_position(milliseconds, wav_header):
+    # Same rounding as the pydub slices used before, clamped to the file.
+    length_in_milliseconds = round(1000 * wav_header["frame_count"] / wav_header["sample_rate"])
+    milliseconds = min(max(milliseconds, 0), length_in_milliseconds)
+
+    return min(int(milliseconds * (wav_header["sample_rate"] / 1000.0)), wav_header["frame_count"])
+
+
+def get_wav_segments(raw_wav_directory, wav_files_in_range, begin_datetime, end_datetime):
+    '''
+    Get the frame ranges of the sorted WAV files that cover an interval. The
+    first file is read from the interval begin and the last one up to the
+    interval end, while the files in between are read completely.
+    '''
+    wav_segments = []
+    last_index = len(wav_files_in_range) - 1
+
+    for index, (wav_datetime, wav_file_name) in enumerate(wav_files_in_range):
+        wav_file = os.path.join(raw_wav_directory, wav_file_name)
+        wav_header = get_wav_header(wav_file)
+
+        start_frame = 0
+        stop_frame = wav_header["frame_count"]
+
+        if index == 0:
+            start_frame = get_wav_frame_position((begin_datetime - wav_datetime).total_seconds() * 1000, wav_header)
+        if index == last_index:
+            stop_frame = get_wav_frame_position((end_datetime - wav_datetime).total_seconds() * 1000, wav_header)
+
+        wav_segments.append((wav_file, wav_header, start_frame, max(stop_frame, start_frame)))
+
+    return wav_segments
+
+
+def get_wav_segment_format(wav_segments):
+    '''
+    Get the (channels, sample width, sample rate) of the WAV segments, which
+    must all be PCM with the same format.
+    '''
+    wav_format = None
+    for wav_file, wav_header, _, _ in wav_segments:
+        if wav_header["audio_format"] != 1:
+            raise ValueError(f"{wav_file} is not a PCM WAV file")
+
+        segment_format = (wav_header["channels"], wav_header["sample_width"], wav_header["sample_rate"])
+        if wav_format is None:
+            wav_format = segment_format
+        elif segment_format != wav_format:
+            raise ValueError(f"{wav_file} does not have the same format as the previous files of the segment")
+
+    return wav_format
+
+
+def write_wav_segment(output_file, wav_segments):
+    '''
+    Write the frame ranges of the WAV segments sequentially into one WAV file.
+    The samples are copied in chunks straight from the data chunk of each
+    source file, so they are neither decoded nor kept in memory.
+    '''
+    wav_format = get_wav_segment_format(wav_segments)
+
+    with wave.open(output_file, "wb") as output_wav:
+        output_wav.setnchannels(wav_format[0])
+        output_wav.setsampwidth(wav_format[1])
+        output_wav.setframerate(wav_format[2])
+
+        for wav_file, wav_header, start_frame, stop_frame in wav_segments:
+            frame_width = wav_header["block_align"]
+            remaining_bytes = (stop_frame - start_frame) * frame_width
+
+            with open(wav_file, "rb") as input_wav:
+                input_wav.seek(wav_header["data_offset"] + start_frame * frame_width)
+
+                while remaining_bytes > 0:
+                    data = input_wav.read(min(WAV_COPY_CHUNK_FRAMES * frame_width, remaining_bytes))
+                    if not data:
+                        break
+
+                    output_wav.writeframesraw(data)
+                    remaining_bytes -= len(data)
+
+
+def export_wav_segment(interval, raw_wav_directory, output_save_dir, wav_file_names, wav_file_list_datetime, virtual=False):
+    '''
+    Export the audio of one interval, given as (index, begin, end), to
+    <index>.wav. Returns (index, record, spans, error): the (begin, end,
+    wav_file) record of the exported interval (None if there is no audio
+    for it or the export failed), the (source file, frame offset, frame
+    count) spans of a virtual segment, and the error message if the export
+    failed (None otherwise).
+    In virtual mode nothing is written, the spans describe the segment.
+    '''
     # Define project constants.
     five_minutes = timedelta(minutes = 5)
-    csv_data_to_fetch = []
 
+    file_idx, begin, end = interval
+    ais_begin_datetime = zulu_string_to_datetime(begin)
+    ais_end_datetime = zulu_string_to_datetime(end)
+
+    wav_files_in_range = []
+    for wav_file, wav_datetime in zip(wav_file_names, wav_file_list_datetime):
+        if (wav_datetime >= (ais_begin_datetime - five_minutes)) and (wav_datetime <= ais_end_datetime):
+            wav_files_in_range.append((wav_datetime, wav_file))
+
+    if len(wav_files_in_range) == 0:
+        return file_idx, None, [], None
+
+    wav_files_in_range.sort()
+
+    output_file = os.path.join(output_save_dir, str(file_idx) + ".wav")
+    spans = []
+    try:
+        wav_segments = get_wav_segments(raw_wav_directory, wav_files_in_range, ais_begin_datetime, ais_end_datetime)
+
+        if virtual:
+            get_wav_segment_format(wav_segments)
+            spans = [
+                (wav_file, start_frame, stop_frame - start_frame)
+                for wav_file, _, start_frame, stop_frame in wav_segments
+            ]
+
+            # A file left by a previous materialized export would be served instead of the spans.
+            if os.path.exists(output_file):
+                os.remove(output_file)
+        else:
+            write_wav_segment(output_file, wav_segments)
+    except (OSError, ValueError, EOFError, wave.Error) as error:
+        # Do not leave a partially written segment behind.
+        if os.path.exists(output_file):
+            os.remove(output_file)
+
+        return file_idx, None, [], f"{type(error).__name__}: {error}"
+
+    record = (
+        pandas_timestamp_to_onc_format(ais_begin_datetime),
+        pandas_timestamp_to_onc_format(ais_end_datetime),
+        str(file_idx),
+    )
+
+    return file_idx, record, spans, None
+
+
+def split_and_save_wav(
+    raw_wav_directory,
+    output_save_dir,
+    data_from_range,
+    wav_file_names,
+    inclusion_radius=0,
+    interval_ais_data_directory='',
+    number_of_workers=1,
+    virtual=False,
+):
+    '''
+    Export the audio of each interval of data_from_range to its own WAV file
+    and list the exported intervals in intervals.csv, in interval order.
+    With more than one worker the intervals are exported by a process pool.
+    With virtual=True no audio is copied; the segments are described in a
+    manifest of spans of the raw WAV files, read with wav_segments.read_wav_segment.
+    Returns the failed intervals as dicts with their index, begin, end and
+    error, which are also written to failed_intervals.csv.
+    '''
     wav_file_list_datetime = []
     for wav_file in wav_file_names:
         wav_timestamp = os.path.splitext(wav_file)[0].split("_")[-1]
         wav_file_list_datetime.append(zulu_string_to_datetime(wav_timestamp))
 
-    for file_idx, (begin, end) in enumerate(tqdm(zip(data_from_range.begin, data_from_range.end), total=len(data_from_range.index))):
-        wav_files_in_range = []
-        ais_begin_datetime = zulu_string_to_datetime(begin)
-        ais_end_datetime = zulu_string_to_datetime(end)
-
-        for wav_file, wav_datetime in zip(wav_file_names, wav_file_list_datetime):
-            if (wav_datetime >= (ais_begin_datetime - five_minutes)) and (wav_datetime <= ais_end_datetime):
-                wav_files_in_range.append((wav_datetime, wav_file))
-
-        if len(wav_files_in_range) == 0:
-            continue
-
-        wav_files_in_range.sort()
-
-        try:
-            audio_segment = AudioSegment.from_wav(os.path.join(raw_wav_directory, wav_files_in_range[0][1]))
-            start_time = (ais_begin_datetime - wav_files_in_range[0][0]).total_seconds() * 1000
-            audio_segment = audio_segment[start_time:]
-
-            for idx, (wav_datetime, wav_file_name) in enumerate(wav_files_in_range[:-1]):
-                if idx == 0:
-                    continue
-                audio_segment += AudioSegment.from_wav(os.path.join(raw_wav_directory, wav_file_name))
-
-            last_segment = AudioSegment.from_wav(os.path.join(raw_wav_directory, wav_files_in_range[-1][1]))
-            end_time = (ais_end_datetime - wav_files_in_range[-1][0]).total_seconds() * 1000
-            audio_segment += last_segment[:end_time]
-
-            audio_segment.export(os.path.join(output_save_dir, str(file_idx) + ".wav"), format="wav")
-            csv_data_to_fetch.append(
-                    (
-                        pandas_timestamp_to_onc_format(ais_begin_datetime),
-                        pandas_timestamp_to_onc_format(ais_end_datetime),
-                        str(file_idx),
-                    )
-                )
-        except:
-            print(f"Error while exporting {file_idx} audio segment")
-            continue
+    intervals = [
+        (file_idx, begin, end)
+        for file_idx, (begin, end) in enumerate(zip(data_from_range.begin, data_from_range.end))
+    ]
+
+    function_partial = partial(
+        export_wav_segment,
+        raw_wav_directory=raw_wav_directory,
+        output_save_dir=output_save_dir,
+        wav_file_names=wav_file_names,
+        wav_file_list_datetime=wav_file_list_datetime,
+        virtual=virtual,
+    )
+
+    if number_of_workers > 1:
+        threading_pool = multiprocessing.Pool(processes=number_of_workers)
+        outputs = list(
+            tqdm(
+                threading_pool.imap_unordered(function_partial, intervals, chunksize=1),
+                total=len(intervals),
+            )
+        )
+        threading_pool.close()
+        threading_pool.join()
+    else:
+        outputs = [function_partial(interval) for interval in tqdm(intervals)]
+
+    # The workers finish in any order, so the records are written back in interval order.
+    outputs.sort(key=lambda output: output[0])
+
+    csv_data_to_fetch = [record for _, record, _, _ in outputs if record is not None]
+    failed_intervals = [
+        {"index": file_idx, "begin": intervals[file_idx][1], "end": intervals[file_idx][2], "error": error}
+        for file_idx, _, _, error in outputs
+        if error is not None
+    ]
+
+    manifest_file = os.path.join(output_save_dir, SEGMENT_MANIFEST_FILE)
+    if virtual:
+        write_segment_manifest(
+            output_save_dir,
+            [(record[2], spans) for _, record, spans, _ in outputs if record is not None],
+        )
+    elif os.path.exists(manifest_file):
+        os.remove(manifest_file)
 
     interval_csv_file = open(os.path.join(output_save_dir, "intervals.csv"), "w")
     interval_csv_file.write("begin,end,wav_file\n")
@@ -93,17 +268,47 @@ def split_and_save_wav(raw_wav_directory, output_save_dir, data_from_range, wav_
 
     interval_csv_file.close()
 
+    failed_intervals_file = os.path.join(output_save_dir, "failed_intervals.csv")
+    if failed_intervals:
+        for failed_interval in failed_intervals:
+            print(
+                f"{bcolors.FAIL}Error while exporting {failed_interval['index']} audio segment: "
+                f"{failed_interval['error']}{bcolors.ENDC}"
+            )
+
+        pd.DataFrame(failed_intervals, columns=["index", "begin", "end", "error"]).to_csv(
+            failed_intervals_file, index=False
+        )
+    elif os.path.exists(failed_intervals_file):
+        os.remove(failed_intervals_file)
 
-def group_wav_from_range(classified_wav_directory, scenario_interval_dir, interval_ais_data_directory, raw_wav_directory, inclusion_radius):
+    return failed_intervals
+
+
+def group_wav_from_range(classified_wav_directory, scenario_interval_dir, interval_ais_data_directory, raw_wav_directory, inclusion_radius, exclusion_radius_offset=2000, number_of_workers=None, virtual=False):
+    '''
+    Export the vessel and background audio segments of the chosen range.
+    By default half of the threads export the segments in parallel. With
+    virtual=True only the segment manifests are written, otherwise the
+    headers of the exported segments are catalogued for the later steps.
+    Returns the failed intervals of the vessel and background segments.
+    '''
+
+    # Threading differences between systems.
+    if number_of_workers is None:
+        number_of_workers = get_num_of_threads()
 
     # Define exclusion range as an offset from the inclusion.
-    exclusion_radius = 2000 + inclusion_radius
+    exclusion_radius = exclusion_radius_offset + inclusion_radius
 
     directory_name = "inclusion_" + str(inclusion_radius) + "_exclusion_" + str(exclusion_radius)
     range_directory = create_dir(classified_wav_directory, directory_name)
 
     # Get a list of the WAV file names.
-    wav_file_names = os.listdir(raw_wav_directory)
+    wav_file_names = [file for file in os.listdir(raw_wav_directory) if file.lower().endswith(".wav")]
+
+    # The segments are cut from the catalogued headers, so the raw files are not probed again.
+    update_wav_catalog(raw_wav_directory, number_of_workers)
 
     interval_file_names = os.listdir(scenario_interval_dir)
 
@@ -117,7 +322,18 @@ def group_wav_from_range(classified_wav_directory, scenario_interval_dir, interv
     # Identify, split, and save corresponding wav files into the directory.
     print(f"Generating and saving unique vessel within range files.")
     vessel_save_dir = create_dir(range_directory, "vessel")
-    split_and_save_wav(raw_wav_directory, vessel_save_dir, vessel_data_from_range, wav_file_names, inclusion_radius, interval_ais_data_directory)
+    vessel_failed_intervals = split_and_save_wav(
+        raw_wav_directory,
+        vessel_save_dir,
+        vessel_data_from_range,
+        wav_file_names,
+        inclusion_radius,
+        interval_ais_data_directory,
+        number_of_workers=number_of_workers,
+        virtual=virtual,
+    )
+    if not virtual:
+        update_wav_catalog(vessel_save_dir, number_of_workers)
     
     # Read background range data from csv.
     background_interval_file_names = [file for file in interval_file_names if file.lower().endswith('background_intervals.csv')]
@@ -129,4 +345,15 @@ def group_wav_from_range(classified_wav_directory, scenario_interval_dir, interv
     # Identify, split, and save corresponding wav files into the directory.
     print(f"Generating and saving background files.")
     background_save_dir = create_dir(range_directory, "background")
-    split_and_save_wav(raw_wav_directory, background_save_dir, background_data_from_range, wav_file_names)
+    background_failed_intervals = split_and_save_wav(
+        raw_wav_directory,
+        background_save_dir,
+        background_data_from_range,
+        wav_file_names,
+        number_of_workers=number_of_workers,
+        virtual=virtual,
+    )
+    if not virtual:
+        update_wav_catalog(background_save_dir, number_of_workers)
+
+    return {"vessel": vessel_failed_intervals, "background": background_failed_intervals}
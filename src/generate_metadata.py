@@ -1,13 +1,96 @@
 import os
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 from tqdm import tqdm
-from pydub.utils import mediainfo
-from utils import read_data_frame_from_feather_file, get_min_max_normalization, get_min_max_values_from_df
+from wav_segments import get_wav_segments_info
+from ctd_index import (
+    CTD_COLUMNS,
+    ZULU_FORMAT,
+    get_ctd_index,
+    get_ctd_store_index,
+    get_ctd_store_statistics,
+    get_ctd_window_means,
+    read_ctd_store,
+)
+from utils import read_data_frame_from_feather_file, read_intervals_ais_data, get_min_max_normalization, get_min_max_values_from_df
 
 # Classes to be included on processed metadata. The original one will contain all the available classes.
 CLASSES = ["passengership", "tug", "tanker", "cargo", "background"]
 
+# AIS columns needed from the interval AIS data to describe a vessel.
+AIS_METADATA_COLUMNS = ["distance_to_hydrophone", "type_and_cargo", "mmsi", "dim_a", "dim_b", "dim_c", "dim_d"]
+
+# Metadata columns dictionary encoded on the Parquet files.
+DICTIONARY_COLUMNS = ["label", "path"]
+
+def read_metadata(metadata_file):
+    '''
+    Read a metadata from a CSV or a Parquet file, by its extension. The
+    dictionary encoded columns of a Parquet file are read as categoricals.
+    '''
+    if metadata_file.endswith(".parquet"):
+        return pq.read_table(metadata_file).to_pandas()
+    return pd.read_csv(metadata_file)
+
+
+def iterate_metadata(metadata_file, chunk_rows=1000000):
+    '''
+    Yield a metadata from a CSV or a Parquet file, by its extension, in chunks
+    of at most chunk_rows rows.
+    '''
+    if metadata_file.endswith(".parquet"):
+        parquet_file = pq.ParquetFile(metadata_file)
+        # Like the CSV reader, an empty file still gives one empty chunk.
+        if parquet_file.metadata.num_rows == 0:
+            yield parquet_file.schema_arrow.empty_table().to_pandas()
+        for batch in parquet_file.iter_batches(batch_size=chunk_rows):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(metadata_file, chunksize=chunk_rows)
+
+
+def get_metadata_table(metadata):
+    '''
+    Get the Arrow table of a metadata, with the label and the path dictionary
+    encoded and the numeric columns with their pandas types.
+    '''
+    table = pa.Table.from_pandas(metadata, preserve_index=False)
+    for column in DICTIONARY_COLUMNS:
+        if column in table.column_names:
+            index = table.column_names.index(column)
+            table = table.set_column(index, column, table[column].cast(pa.dictionary(pa.int32(), pa.string())))
+
+    return table
+
+
+def append_metadata(metadata, output_file, writer=None):
+    '''
+    Write a batch of a metadata to a CSV or a Parquet file, by the extension
+    of output_file. Without a writer the file is created, with the header of
+    the batch; the writer returned takes the next batches, and is closed
+    after the last one.
+    '''
+    if output_file.endswith(".parquet"):
+        table = get_metadata_table(metadata)
+        if writer is None:
+            writer = pq.ParquetWriter(output_file, table.schema)
+        if table.num_rows:
+            writer.write_table(table.cast(writer.schema))
+    elif writer is None:
+        writer = open(output_file, "w", newline="")
+        metadata.to_csv(writer, index=False)
+    else:
+        metadata.to_csv(writer, index=False, header=False)
+
+    return writer
+
+
+def write_metadata(metadata, output_file):
+    append_metadata(metadata, output_file).close()
+
+
 def get_class_from_code(code):
     """Codes were extracted from these sources:
     https://api.vtexplorer.com/docs/ref-aistypes.html
@@ -39,16 +122,6 @@ def get_class_from_code(code):
     return "other"
 
 
-def get_mean_ctd_from_range(data_frame, begin_time, end_time):
-    columns = ["t1", "c1", "p1", "sal", "sv"]
-
-    ctd_df = data_frame[data_frame['date'].between(begin_time, end_time, inclusive="both")]
-    ctd_df = ctd_df[columns]
-    t1, c1, p1, sal, sv = ctd_df.apply(pd.to_numeric).mean()
-
-    return t1, c1, p1, sal, sv
-
-
 def get_full_ctd_dataframe(clean_ctd_directory):
     data_files = [file for file in os.listdir(clean_ctd_directory)]
 
@@ -65,130 +138,135 @@ def get_full_ctd_dataframe(clean_ctd_directory):
     return df
 
 
-def generate_full_metadata(root_path, clean_ctd_directory, interval_ais_dir, inclusion_radius, use_ctd=True):
+def read_segments(root_path, segment_type):
+    '''
+    Read the audio segments of the vessel or background directory with their
+    interval, path, duration, sample rate and date.
+    '''
+    segment_directory = os.path.join(root_path, segment_type)
+    intervals = pd.read_csv(os.path.join(segment_directory, "intervals.csv"), dtype={"wav_file": str})
+    file_names = intervals["wav_file"] + ".wav"
+
+    # The duration and sample rate of every segment are read from the WAV headers at once.
+    segments_info = get_wav_segments_info(segment_directory, file_names)
+
+    begin_times = intervals["begin"].str.replace("-", "").str.replace(":", "")
+    end_times = intervals["end"].str.replace("-", "").str.replace(":", "")
+
+    return pd.DataFrame(
+        {
+            "begin_time": begin_times,
+            "end_time": end_times,
+            "interval_id": begin_times + "_" + end_times,
+            "path": f"./{segment_type}/" + file_names,
+            "duration_sec": segments_info["duration"].to_numpy(),
+            "sample_rate": segments_info["sample_rate"].to_numpy(),
+            "date": intervals["begin"].str.replace("-", "").str.split("T").str[0],
+        }
+    )
+
+
+def get_vessel_attributes(interval_ais_dir, interval_ids, inclusion_radius):
+    '''
+    Get the class code, MMSI, length and width of the vessel of each interval
+    from its first AIS message within the inclusion radius, in one pass over
+    the AIS rows of all the intervals. Returns a DataFrame indexed by interval_id.
+    '''
+    interval_ids = pd.unique(np.asarray(interval_ids, dtype=object))
+
+    ais_data = read_intervals_ais_data(interval_ais_dir, interval_ids, columns=AIS_METADATA_COLUMNS)
+    ais_data = ais_data[ais_data["distance_to_hydrophone"] <= inclusion_radius]
+    ais_data = ais_data.drop_duplicates(subset="interval_position").set_index("interval_position")
+    ais_data = ais_data.reindex(np.arange(interval_ids.shape[0]))
+
+    missing_intervals = interval_ids[ais_data["mmsi"].isna().to_numpy()]
+    if missing_intervals.shape[0]:
+        raise ValueError(
+            f"No AIS message within {inclusion_radius} m for the intervals {', '.join(missing_intervals)}"
+        )
+
+    return pd.DataFrame(
+        {
+            "class_code": ais_data["type_and_cargo"].to_numpy(),
+            "MMSI": ais_data["mmsi"].to_numpy(),
+            "length": (ais_data["dim_a"] + ais_data["dim_b"]).to_numpy(),
+            "width": (ais_data["dim_c"] + ais_data["dim_d"]).to_numpy(),
+        },
+        index=pd.Index(interval_ids, name="interval_id"),
+    )
+
+
+def generate_full_metadata(root_path, clean_ctd_directory, interval_ais_dir, inclusion_radius, use_ctd=True, ctd_store_directory=None, output_format="csv"):
+    '''
+    Generate the metadata of the vessel and background segments. The CTD
+    means come from the cleaned CTD files, over the samples in [begin, end]
+    of each segment. With a ctd_store_directory that has a store, they come
+    from its bins that start in [begin, end) instead, and the normalization
+    is over the bins of the deployments instead of over all of the CTD data.
+    '''
 
     columns = ["label", "duration_sec", "path", "sample_rate", "class_code",
                "date", "MMSI", "length", "width"]
     if use_ctd:
-        columns.extend(["t1", "c1", "p1", "sal", "sv", "t1_norm",
-               "c1_norm", "p1_norm", "sal_norm", "sv_norm"])
+        columns.extend(CTD_COLUMNS + [f"{column}_norm" for column in CTD_COLUMNS])
+
+    print(f"Vessel Metafile")
+    vessel_segments = read_segments(root_path, "vessel")
+    vessel_segments = vessel_segments.join(
+        get_vessel_attributes(interval_ais_dir, vessel_segments["interval_id"], inclusion_radius),
+        on="interval_id",
+    )
 
-    metadata = {key:[] for key in columns}
+    print(f"Background Metafile")
+    background_segments = read_segments(root_path, "background")
+    background_segments = background_segments.assign(class_code=0, MMSI=0, length=0, width=0)
 
-    dir_vessel = os.path.join(root_path, "vessel")
-    meta_vessel = os.path.join(dir_vessel, "intervals.csv")
-    df_vessel = pd.read_csv(meta_vessel)
+    metadata = pd.concat([vessel_segments, background_segments], ignore_index=True)
+
+    # The class of each distinct code is looked up once.
+    class_codes = metadata["class_code"].unique()
+    metadata["label"] = metadata["class_code"].map(
+        dict(zip(class_codes, [get_class_from_code(code) for code in class_codes]))
+    )
 
     if use_ctd:
-        ctd_df = get_full_ctd_dataframe(clean_ctd_directory)
-        min_max_ctd = get_min_max_values_from_df(ctd_df, ["t1", "c1", "p1", "sal", "sv"])
+        ctd_store = None
+        if ctd_store_directory is not None:
+            ctd_store = read_ctd_store(ctd_store_directory)
+
+        if ctd_store is not None:
+            # The store is memory-mapped and its statistics were computed when it was built.
+            ctd_index = get_ctd_store_index(*ctd_store)
+            ctd_statistics = get_ctd_store_statistics(ctd_store_directory)
+            min_max_ctd = {
+                column: (ctd_statistics.loc[column, "min"], ctd_statistics.loc[column, "max"])
+                for column in CTD_COLUMNS
+            }
+        else:
+            ctd_df = get_full_ctd_dataframe(clean_ctd_directory)
+            ctd_index = get_ctd_index(ctd_df)
+            min_max_ctd = get_min_max_values_from_df(ctd_df, CTD_COLUMNS)
+
+        ctd_means = get_ctd_window_means(
+            ctd_index,
+            pd.to_datetime(metadata["begin_time"], format=ZULU_FORMAT),
+            pd.to_datetime(metadata["end_time"], format=ZULU_FORMAT),
+        )
+        for column in CTD_COLUMNS:
+            metadata[column] = ctd_means[column].to_numpy()
+            metadata[f"{column}_norm"] = get_min_max_normalization(
+                metadata[column], min_max_ctd[column][0], min_max_ctd[column][1]
+            )
 
-    print(f"Vessel Metafile")
-    for _, row in tqdm(df_vessel.iterrows(), total=df_vessel.shape[0]):
-        begin_time = row["begin"].replace("-","").replace(":","")
-        end_time = row["end"].replace("-","").replace(":","")
-
-        interval_file = os.path.join(interval_ais_dir, f"{begin_time}_{end_time}_interval_data.feather")
-        metadata_file = read_data_frame_from_feather_file(interval_file)
-
-        class_code = metadata_file[metadata_file["distance_to_hydrophone"] <= inclusion_radius].type_and_cargo.unique()[0]
-        mmsi = metadata_file[metadata_file["distance_to_hydrophone"] <= inclusion_radius].mmsi.unique()[0]
-        file_name = f'{row["wav_file"]}.wav'
-        path = os.path.join(dir_vessel, file_name)
-        info = mediainfo(path)
-
-
-        # Append AIS data
-        metadata["MMSI"].append(mmsi)
-        metadata["class_code"].append(class_code)
-        metadata["label"].append(get_class_from_code(class_code))
-        
-        # Append vessel dimension data from AIS
-        dim_a = metadata_file[metadata_file["distance_to_hydrophone"] <= inclusion_radius].dim_a.unique()[0]
-        dim_b = metadata_file[metadata_file["distance_to_hydrophone"] <= inclusion_radius].dim_b.unique()[0]
-        dim_c = metadata_file[metadata_file["distance_to_hydrophone"] <= inclusion_radius].dim_c.unique()[0]
-        dim_d = metadata_file[metadata_file["distance_to_hydrophone"] <= inclusion_radius].dim_d.unique()[0]
-        metadata["length"].append(dim_a+dim_b)
-        metadata["width"].append(dim_c+dim_d)
-
-        # Append audio data
-        metadata["path"].append(f"./vessel/{file_name}")
-        metadata["duration_sec"].append(info["duration"])
-        metadata["sample_rate"].append(info["sample_rate"])
-        metadata["date"].append(row["begin"].replace("-","").split("T")[0])
-
-        if use_ctd:
-            t1, c1, p1, sal, sv = get_mean_ctd_from_range(ctd_df, begin_time, end_time)
-            
-            # Append CTD data
-            metadata["t1"].append(t1)
-            metadata["c1"].append(c1)
-            metadata["p1"].append(p1)
-            metadata["sv"].append(sv)
-            metadata["sal"].append(sal)
-
-            # Append normalized CTD data
-            metadata["t1_norm"].append(get_min_max_normalization(t1, min_max_ctd["t1"][0], min_max_ctd["t1"][1]))
-            metadata["c1_norm"].append(get_min_max_normalization(c1, min_max_ctd["c1"][0], min_max_ctd["c1"][1]))
-            metadata["p1_norm"].append(get_min_max_normalization(p1, min_max_ctd["p1"][0], min_max_ctd["p1"][1]))
-            metadata["sv_norm"].append(get_min_max_normalization(sv, min_max_ctd["sv"][0], min_max_ctd["sv"][1]))
-            metadata["sal_norm"].append(get_min_max_normalization(sal, min_max_ctd["sal"][0], min_max_ctd["sal"][1]))
-
-    dir_background = os.path.join(root_path, "background")
-    meta_backgorund = os.path.join(dir_background, "intervals.csv")
-    df_background = pd.read_csv(meta_backgorund)
+    write_metadata(metadata[columns], os.path.join(root_path, f"metadata.{output_format}"))
 
-    print(f"Background Metafile")
-    for _, row in tqdm(df_background.iterrows(), total=df_background.shape[0]):
-        begin_time = row["begin"].replace("-","").replace(":","")
-        end_time = row["end"].replace("-","").replace(":","")
-
-        interval_file = os.path.join(interval_ais_dir, f"{begin_time}_{end_time}_interval_data.feather")    
-        metadata_file = read_data_frame_from_feather_file(interval_file)
-
-        file_name = f'{row["wav_file"]}.wav'
-        path = os.path.join(dir_background, file_name)
-        info = mediainfo(path)
-
-
-        # Append AIS data
-        class_code = 0
-        metadata["MMSI"].append(0)
-        metadata["class_code"].append(class_code)
-        metadata["label"].append(get_class_from_code(class_code))
-        metadata["length"].append(0)
-        metadata["width"].append(0)
-        
-        # Append audio data
-        metadata["path"].append(f"./background/{file_name}")
-        metadata["duration_sec"].append(info["duration"])
-        metadata["sample_rate"].append(info["sample_rate"])
-        metadata["date"].append(row["begin"].replace("-","").split("T")[0])
-
-        if use_ctd:
-            t1, c1, p1, sal, sv = get_mean_ctd_from_range(ctd_df, begin_time, end_time)
-
-            # Append CTD data
-            metadata["t1"].append(t1)
-            metadata["c1"].append(c1)
-            metadata["p1"].append(p1)
-            metadata["sv"].append(sv)
-            metadata["sal"].append(sal)
-
-            # Append normalized CTD data
-            metadata["t1_norm"].append(get_min_max_normalization(t1, min_max_ctd["t1"][0], min_max_ctd["t1"][1]))
-            metadata["c1_norm"].append(get_min_max_normalization(c1, min_max_ctd["c1"][0], min_max_ctd["c1"][1]))
-            metadata["p1_norm"].append(get_min_max_normalization(p1, min_max_ctd["p1"][0], min_max_ctd["p1"][1]))
-            metadata["sv_norm"].append(get_min_max_normalization(sv, min_max_ctd["sv"][0], min_max_ctd["sv"][1]))
-            metadata["sal_norm"].append(get_min_max_normalization(sal, min_max_ctd["sal"][0], min_max_ctd["sal"][1]))
-
-    final_metadata = pd.DataFrame.from_dict(metadata)
-    final_metadata.to_csv(os.path.join(root_path, "metadata.csv"), index=False)
-
-
-def generate_oversampled_metadata(metadata_file, root_path, inbalance_limit=2):
-    meta = pd.read_csv(os.path.join(root_path, metadata_file))
-    meta_dict = {label:meta[meta["label"] == label]["duration_sec"].sum() for label in CLASSES}
+
+def generate_oversampled_metadata(metadata_file, root_path, inbalance_limit=2, output_format="csv"):
+    meta = read_metadata(os.path.join(root_path, metadata_file))
+    window_counts = get_window_counts(meta)
+    window_labels = np.repeat(meta["label"].to_numpy(), window_counts)
+    window_durations = np.repeat(meta["duration_sec"].to_numpy(), window_counts)
+    meta_dict = {label:window_durations[window_labels == label].sum() for label in CLASSES}
 
     bigger_class = max(meta_dict, key=meta_dict.get)
     smaller_class = min(meta_dict, key=meta_dict.get)
@@ -196,104 +274,248 @@ def generate_oversampled_metadata(metadata_file, root_path, inbalance_limit=2):
     relation = min(inbalance_limit, meta_dict[bigger_class]/meta_dict[smaller_class])
 
     final_size = meta_dict[smaller_class] * relation
-    classes_df = []
+    classes_windows = []
 
     for label in CLASSES:
-        sub_metadata = meta[meta["label"] == label].sample(frac=1, random_state=42).reset_index(drop=True)
-        current_size = 0
-        max_row_num = len(sub_metadata.index)
+        class_windows = np.flatnonzero(window_labels == label)
+        class_windows = class_windows[np.random.RandomState(42).permutation(class_windows.shape[0])]
+        class_durations = window_durations[class_windows]
+
+        # The shuffled windows are taken in a cycle until the class reaches the final size. The running total is a
+        # cumulative sum over enough copies of the cycle, with the same additions in the same order as a loop.
         row_num = 0
-        rows = []
-        while current_size < final_size:
-            current_size += sub_metadata.iloc[row_num]["duration_sec"]
-            rows.append(row_num)
-            
-            row_num += 1
-            if row_num == max_row_num:
-                classes_df.append(sub_metadata[sub_metadata.index.isin(rows)])
-                row_num = 0
-                rows = []
-        classes_df.append(sub_metadata[sub_metadata.index.isin(rows)])
+        if final_size > 0:
+            cycles = int(final_size // class_durations.sum()) + 1
+            current_sizes = np.cumsum(np.tile(class_durations, cycles))
+            while current_sizes[-1] < final_size:
+                current_sizes = np.r_[current_sizes, np.cumsum(np.r_[current_sizes[-1], class_durations])[1:]]
+            row_num = np.searchsorted(current_sizes, final_size, side="left") + 1
+        classes_windows.append(class_windows[np.arange(row_num) % max(class_windows.shape[0], 1)])
 
     file_name = metadata_file.split(".")[0]
-    balanced_set = pd.concat(classes_df, ignore_index=True)
-    balanced_set.sample(frac=1, random_state=42).reset_index(drop=True).to_csv(os.path.join(root_path, f"{file_name}_oversampled.csv"), index=False)
+    balanced_windows = np.concatenate(classes_windows)
+    balanced_windows = balanced_windows[np.random.RandomState(42).permutation(balanced_windows.shape[0])]
+    write_windows(meta, balanced_windows, os.path.join(root_path, f"{file_name}_oversampled.{output_format}"))
 
 
-def generate_undersampled_metadata(metadata_file, root_path):
-    meta = pd.read_csv(os.path.join(root_path, metadata_file))
-    meta_dict = {label:meta[meta["label"] == label]["duration_sec"].sum() for label in CLASSES}
+def generate_undersampled_metadata(metadata_file, root_path, output_format="csv"):
+    meta = read_metadata(os.path.join(root_path, metadata_file))
+    window_counts = get_window_counts(meta)
+    window_labels = np.repeat(meta["label"].to_numpy(), window_counts)
+    window_durations = np.repeat(meta["duration_sec"].to_numpy(), window_counts)
+    meta_dict = {label:window_durations[window_labels == label].sum() for label in CLASSES}
     min_time_label = min(meta_dict, key=meta_dict.get)
-    idx_dict = {}
+    idx_list = []
     for label in CLASSES:
-        base_time = meta_dict[min_time_label]
-        idx_dict[label] = []
-        for idx, row in meta[meta["label"] == label].iterrows():
-            idx_dict[label].append(idx)
-            base_time = base_time - row.duration_sec
-            if base_time <= 0:
-                break
-    idx_list = [idx for _, sublist in idx_dict.items() for idx in sublist]
+        class_windows = np.flatnonzero(window_labels == label)
+
+        # Each class takes its windows in order until the time left of the smaller class is over.
+        base_times = np.cumsum(np.r_[meta_dict[min_time_label], -window_durations[class_windows]])[1:]
+        row_num = np.searchsorted(-base_times, 0, side="left") + 1
+        idx_list.append(class_windows[:row_num])
     file_name = metadata_file.split(".")[0]
-    meta[meta.index.isin(idx_list)].to_csv(os.path.join(root_path, f"{file_name}_undersampled.csv"), index=False)
+    write_windows(meta, np.sort(np.concatenate(idx_list)), os.path.join(root_path, f"{file_name}_undersampled.{output_format}"))
 
 
-def generate_balanced_metadata(metadata_file, root_path):
-    generate_oversampled_metadata(metadata_file, root_path)
-    generate_undersampled_metadata(metadata_file, root_path)
+def generate_balanced_metadata(metadata_file, root_path, output_format="csv"):
+    generate_oversampled_metadata(metadata_file, root_path, output_format=output_format)
+    generate_undersampled_metadata(metadata_file, root_path, output_format=output_format)
 
 
-def get_metadata_for_small_times(root_path, metadata_file, seconds):
-    initial_meta = pd.read_csv(os.path.join(root_path, metadata_file))
-    desired_classes = CLASSES.copy()
-    desired_classes.remove("other")
-    desired_classes.remove("background")
-    duration = []
-    for label in desired_classes:
-        time = initial_meta[initial_meta["label"] == label]["duration_sec"].sum()
-        duration.append(time)
-    
-    max_duration = max(duration)
-
-    col = list(initial_meta.columns) + ['sub_init']
-    class_duration = {key:0 for key in CLASSES}
-    metadata = []
-    for index, row in tqdm(initial_meta.iterrows(), total=initial_meta.shape[0]):
-        duration = int(row.duration_sec)
-        row["duration_sec"] = float(seconds)
-        if class_duration[row.label] > max_duration:
-            continue
-        class_duration[row.label] += duration
-        for i in range(0, duration, seconds):
-            metadata.append(list(row) + [i])
-
-    metadata_pd = pd.DataFrame(metadata, columns=col)
+def get_small_time_window_counts(metadata, seconds):
+    '''
+    Get the number of windows of the given seconds of each segment. Each
+    class takes its segments in order until its total duration is over the
+    total duration of the longest vessel class; the later ones get none.
+    '''
+    vessel_classes = [label for label in CLASSES if label not in ["other", "background"]]
+    max_duration = max(metadata[metadata["label"] == label]["duration_sec"].sum() for label in vessel_classes)
+
+    durations = metadata["duration_sec"].to_numpy().astype(np.int64)
+
+    # The running total of a class stops growing once it is over the maximum, so the kept segments are a prefix.
+    previous_durations = pd.Series(durations).groupby(metadata["label"].to_numpy(), sort=False).cumsum().to_numpy() - durations
+    is_kept = previous_durations <= max_duration
+
+    return np.where(is_kept & (durations > 0), -(-durations // seconds), 0)
+
+
+def get_window_counts(metadata):
+    '''
+    Get the number of windows of each row of the metadata. A range encoded
+    metadata has a window_count column, and each of its rows stands for
+    window_count windows of duration_sec seconds, the first one starting at
+    sub_init; any other metadata has one window per row.
+    '''
+    if "window_count" in metadata.columns:
+        return metadata["window_count"].to_numpy().astype(np.int64)
+    return np.ones(metadata.shape[0], dtype=np.int64)
+
+
+def locate_windows(window_ends, window_indexes):
+    '''
+    Map global window indexes to the row of the metadata holding them and to
+    their offset on that row, with a binary search on the cumulative window
+    counts of the rows.
+    '''
+    window_indexes = np.asarray(window_indexes, dtype=np.int64)
+    positions = np.searchsorted(window_ends, window_indexes, side="right")
+    offsets = window_indexes - np.r_[0, window_ends][positions]
+
+    return positions, offsets
+
+
+def expand_windows(metadata, window_indexes, window_ends=None):
+    '''
+    Get the rows of the given global window indexes, in the same order, as
+    get_metadata_for_small_times writes them without the range encoding.
+    '''
+    if "window_count" not in metadata.columns:
+        return metadata.iloc[window_indexes].reset_index(drop=True)
+
+    if window_ends is None:
+        window_ends = np.cumsum(get_window_counts(metadata))
+    positions, offsets = locate_windows(window_ends, window_indexes)
+
+    windows = metadata.iloc[positions].drop(columns="window_count").reset_index(drop=True)
+    sub_init = windows["sub_init"].to_numpy() + offsets * windows["duration_sec"].to_numpy()
+    windows["sub_init"] = sub_init.astype(metadata["sub_init"].dtype)
+
+    return windows
+
+
+def iterate_windows(metadata, window_indexes=None, batch_rows=1000000):
+    '''
+    Yield the rows of the given global window indexes, or of all of the
+    windows of the metadata, in batches of at most batch_rows rows.
+    '''
+    window_ends = np.cumsum(get_window_counts(metadata))
+    if window_indexes is None:
+        window_indexes = np.arange(window_ends[-1] if window_ends.shape[0] else 0)
+
+    for batch_begin in range(0, len(window_indexes), batch_rows):
+        yield expand_windows(metadata, window_indexes[batch_begin:batch_begin + batch_rows], window_ends)
+
+
+def write_windows(metadata, window_indexes, output_file, batch_rows=1000000):
+    '''
+    Write the rows of the given global window indexes to a CSV or a Parquet
+    file, expanding batch_rows windows at a time.
+    '''
+    # The header is written even without windows.
+    columns = metadata.columns.drop("window_count", errors="ignore")
+    writer = append_metadata(metadata.iloc[:0][columns], output_file)
+
+    for windows in iterate_windows(metadata, window_indexes, batch_rows):
+        append_metadata(windows, output_file, writer)
+    writer.close()
+
+
+def get_metadata_for_small_times(root_path, metadata_file, seconds, output_format="csv", batch_rows=1000000, range_encoded=False):
+    '''
+    Split the segments of the metadata into windows of the given seconds,
+    with the start of each window in sub_init. The windows are written in
+    batches of about batch_rows rows, to a CSV or a Parquet file. A range
+    encoded metadata keeps one row per segment instead, with its first window
+    and the number of windows in window_count.
+    '''
+    initial_meta = read_metadata(os.path.join(root_path, metadata_file))
+
+    window_counts = get_small_time_window_counts(initial_meta, seconds)
+
     file_name = metadata_file.split(".")[0]
-    metadata_pd.to_csv(os.path.join(root_path, f"{file_name}_{seconds}s.csv"), index=False)
+    output_file = os.path.join(root_path, f"{file_name}_{seconds}s.{output_format}")
 
+    if range_encoded:
+        is_kept = window_counts > 0
+        metadata = initial_meta[is_kept].reset_index(drop=True)
+        metadata["duration_sec"] = float(seconds)
+        metadata["sub_init"] = 0
+        metadata["window_count"] = window_counts[is_kept]
 
-def split_dataset(root_path, metadata_file, validation_split=0.2, test_split=0.1, random_seed=42):
-    metadata = pd.read_csv(os.path.join(root_path, metadata_file))
-    metadata = metadata.sample(frac=1, random_state=random_seed).reset_index(drop=True)
+        write_metadata(metadata, output_file)
+        return
 
-    meta_dict = {label:metadata[metadata["label"] == label].count()[0] for label in CLASSES}
+    window_ends = np.cumsum(window_counts)
+
+    # Batches are made of whole segments, so the window offsets restart with each segment.
+    total_windows = window_ends[-1] if window_ends.shape[0] else 0
+    batch_boundaries = np.searchsorted(window_ends, np.arange(batch_rows, total_windows, batch_rows)) + 1
+    batch_boundaries = np.unique(batch_boundaries[batch_boundaries < initial_meta.shape[0]])
+    batch_boundaries = np.r_[0, batch_boundaries, initial_meta.shape[0]]
+
+    writer = None
+    for batch_begin, batch_end in tqdm(list(zip(batch_boundaries[:-1], batch_boundaries[1:]))):
+        batch_counts = window_counts[batch_begin:batch_end]
+        window_offsets = np.arange(batch_counts.sum()) - np.repeat(np.cumsum(batch_counts) - batch_counts, batch_counts)
+
+        metadata = initial_meta.iloc[np.repeat(np.arange(batch_begin, batch_end), batch_counts)].reset_index(drop=True)
+        metadata["duration_sec"] = float(seconds)
+        metadata["sub_init"] = window_offsets * seconds
+
+        writer = append_metadata(metadata, output_file, writer)
+    writer.close()
+
+
+def split_dataset(root_path, metadata_file, validation_split=0.2, test_split=0.1, random_seed=42, output_format="csv"):
+    metadata = read_metadata(os.path.join(root_path, metadata_file))
+    window_counts = get_window_counts(metadata)
+
+    # The windows are shuffled by their global indexes, so a range encoded metadata is only expanded when written.
+    window_indexes = np.random.RandomState(random_seed).permutation(window_counts.sum())
+
+    label_counts = pd.Series(window_counts).groupby(metadata["label"].to_numpy()).sum()
+    meta_dict = {label:label_counts.get(label, 0) for label in CLASSES}
     smaller_class = min(meta_dict, key=meta_dict.get)
 
     # Creating data indices for training and validation splits:
-    #dataset_size = len(metadata.index)
+    #dataset_size = window_counts.sum()
     dataset_size = meta_dict[smaller_class]*len(CLASSES)
     test_idx = int(np.floor(test_split * dataset_size))
     validation_idx = test_idx + int(np.floor(validation_split * dataset_size))
 
-    test_dataset = metadata[:test_idx]
-    val_dataset = metadata[test_idx:validation_idx]
-    train_dataset = metadata[validation_idx:]
+    file_name = metadata_file.split(".")[0]
 
+    write_windows(metadata, window_indexes[:test_idx], os.path.join(root_path, f"{file_name}_test.{output_format}"))
+    write_windows(metadata, window_indexes[test_idx:validation_idx], os.path.join(root_path, f"{file_name}_validation.{output_format}"))
+    write_windows(metadata, window_indexes[validation_idx:], os.path.join(root_path, f"{file_name}_train.{output_format}"))
+
+
+def split_dataset_by_hash(root_path, metadata_file, validation_split=0.2, test_split=0.1, random_seed=42, split_key=("path",), chunk_rows=1000000, output_format="csv"):
+    '''
+    Split the metadata into train, validation and test datasets by a hash of
+    the split_key columns of each row and the seed, so all of the windows of
+    a segment go to the same dataset. The metadata is read and written in
+    chunks of chunk_rows rows, and the split does not depend on the order or
+    the number of rows. A range encoded metadata is kept range encoded,
+    unless sub_init is in the split_key.
+    Unlike split_dataset, which sizes the test and validation datasets from
+    the smallest class times the number of classes, test_split and
+    validation_split are fractions of all of the rows, so appending rows
+    never moves the rows already assigned.
+    '''
+    split_key = list(split_key)
     file_name = metadata_file.split(".")[0]
+    output_files = [os.path.join(root_path, f"{file_name}_{dataset}.{output_format}") for dataset in ["test", "validation", "train"]]
+
+    # The hash key is 16 bytes, taken from the seed.
+    hash_key = str(random_seed).zfill(16)[-16:]
+    split_limits = np.array([test_split, test_split + validation_split])
+
+    writers = [None for _ in output_files]
+    for metadata in tqdm(iterate_metadata(os.path.join(root_path, metadata_file), chunk_rows)):
+        if "sub_init" in split_key and "window_count" in metadata.columns:
+            metadata = pd.concat(list(iterate_windows(metadata, batch_rows=chunk_rows)), ignore_index=True)
+
+        # The 64 bits hash is mapped to [0, 1), and compared with the proportions of the datasets.
+        hashes = pd.util.hash_pandas_object(metadata[split_key], index=False, hash_key=hash_key).to_numpy()
+        datasets = np.searchsorted(split_limits, (hashes >> np.uint64(11)) / 2**53, side="right")
+
+        for dataset, output_file in enumerate(output_files):
+            writers[dataset] = append_metadata(metadata[datasets == dataset], output_file, writers[dataset])
 
-    test_dataset.to_csv(os.path.join(root_path, f"{file_name}_test.csv"), index=False)
-    val_dataset.to_csv(os.path.join(root_path, f"{file_name}_validation.csv"), index=False)
-    train_dataset.to_csv(os.path.join(root_path, f"{file_name}_train.csv"), index=False)
+    for writer in writers:
+        writer.close()
 
 
 def main():
@@ -1,47 +1,56 @@
 import os
-import folium
+import multiprocessing
 
 import numpy as np
 import pandas as pd
 
 from tqdm import tqdm
+from functools import partial
 from utils import (
     create_dir,
+    get_num_of_threads,
+    get_available_memory,
     get_hydrophone_deployments,
+    zulu_string_to_datetime,
     pandas_timestamp_to_zulu_format,
-    dump_data_frame_to_feather_file,
+    get_interval_id,
+    get_feather_row_range,
+    get_feather_row_ranges,
+    read_interpolated_ais_data,
     read_data_frame_from_feather_file,
+    dump_data_frame_to_feather_file,
 )
 
 
+# Rough peak memory of the scenario identification relative to the size of the deployment files.
+DEPLOYMENT_MEMORY_FACTOR = 2
+
+
 class map_colors:
     exclusion_zone = "#ad2727"
     inclusion_zone = "#27ad27"
 
 
 def plot_map(
-    deployment,
+    deployment_location,
     device,
     map_data_directory,
     exclusion_radius=0,
     inclusion_radius=0,
     file_name="map"):
 
+    # Folium is only needed for the optional sanity check maps, so it is not imported with the module.
+    import folium
+
     folium_map = folium.Map(
-        location=(
-            deployment.latitude,
-            deployment.longitude,
-        ),
+        location=deployment_location,
         tiles="CartoDB positron",
         zoom_start=12,
     )
 
     if exclusion_radius != 0:
         folium.Circle(
-            location=(
-                deployment.latitude,
-                deployment.longitude,
-            ),
+            location=deployment_location,
             radius=float(exclusion_radius),
             dash_array="10,20",
             color=map_colors.exclusion_zone,
@@ -53,10 +62,7 @@ def plot_map(
 
     if inclusion_radius != 0:
         folium.Circle(
-            location=(
-                deployment.latitude,
-                deployment.longitude,
-            ),
+            location=deployment_location,
             radius=float(inclusion_radius),
             dash_array="10,20",
             color=map_colors.inclusion_zone,
@@ -67,10 +73,7 @@ def plot_map(
         ).add_to(folium_map)
 
     folium.Circle(
-        location=(
-            deployment.latitude,
-            deployment.longitude,
-        ),
+        location=deployment_location,
         radius=1.0,
         color="#3388ff",
         popup=f"{device}",
@@ -84,83 +87,349 @@ def plot_map(
         )
     )
 
-def generate_csv(
-    interval_dicts,
-    device,
-    deployment_begin,
-    deployment_end,
-    scenario_intervals_directory,
-    interval_ais_data_directory,
-    data_frame,
-    minimum_consecutive_minutes=30,
-    is_background=True,
-    csv_name="file.csv"
-    ):
+def plot_scenario_maps(deployment_location, device, map_data_directory, mapped_radii):
+    '''
+    Render the sanity check maps of all the (exclusion, inclusion) radius pairs
+    in parallel. An inclusion radius of 0 draws only the exclusion zone.
+    '''
+    map_arguments = []
+    for exclusion_radius, inclusion_radius in mapped_radii:
+        if inclusion_radius == 0:
+            file_name = f"exclusion_radius_{exclusion_radius:05d}_metres.html"
+        else:
+            file_name = f"inclusion_radius_{inclusion_radius:05d}_metres_exclusion_radius_{exclusion_radius:05d}_metres.html"
+
+        map_arguments.append(
+            (deployment_location, device, map_data_directory, exclusion_radius, inclusion_radius, file_name)
+        )
 
-    list_of_data_to_fetch = {}
+    if not map_arguments:
+        return
+
+    threading_pool = multiprocessing.Pool(processes=min(len(map_arguments), multiprocessing.cpu_count()))
+    threading_pool.starmap(plot_map, map_arguments)
+    threading_pool.close()
+    threading_pool.join()
+
+
+def get_minute_aggregates(data_frame, distance_thresholds, first_minute=None, last_minute=None):
+    '''
+    Reduce the AIS messages of a deployment to 1-minute buckets (left labelled,
+    including the empty ones). For each bucket it computes the minimum distance
+    to the hydrophone and, for every distance threshold, the number of messages
+    and of distinct MMSIs within that distance.
+    The buckets span from the first to the last message, unless first_minute or
+    last_minute (numpy datetime64[m]) are given.
+    '''
+    minutes = data_frame["pd_timestamp"].to_numpy(dtype="datetime64[ns]").astype("datetime64[m]")
+    distances = data_frame["distance_to_hydrophone"].to_numpy(dtype=float)
+    mmsi_codes, _ = pd.factorize(data_frame["mmsi"])
+
+    if first_minute is None:
+        first_minute = minutes.min()
+    if last_minute is None:
+        last_minute = minutes.max()
+
+    buckets = (minutes - first_minute).astype(np.int64)
+    number_of_buckets = int((last_minute - first_minute).astype(np.int64)) + 1
+
+    # Sort by bucket and MMSI so both become contiguous runs that can be reduced in one pass.
+    order = np.lexsort((mmsi_codes, buckets))
+    sorted_buckets = buckets[order]
+    sorted_mmsi_codes = mmsi_codes[order]
+    sorted_distances = np.where(np.isnan(distances[order]), np.inf, distances[order])
+
+    minimum_distance = np.full(number_of_buckets, np.inf)
+    vessel_buckets = np.empty(0, dtype=np.int64)
+    vessel_distances = np.empty(0)
+
+    if sorted_buckets.shape[0]:
+        bucket_starts = np.flatnonzero(np.r_[True, sorted_buckets[1:] != sorted_buckets[:-1]])
+        minimum_distance[sorted_buckets[bucket_starts]] = np.minimum.reduceat(sorted_distances, bucket_starts)
+
+        # The closest message of each vessel in each bucket tells within which thresholds that vessel is.
+        vessel_starts = np.flatnonzero(
+            np.r_[
+                True,
+                (sorted_buckets[1:] != sorted_buckets[:-1])
+                | (sorted_mmsi_codes[1:] != sorted_mmsi_codes[:-1]),
+            ]
+        )
+        vessel_buckets = sorted_buckets[vessel_starts]
+        vessel_distances = np.minimum.reduceat(sorted_distances, vessel_starts)
 
-    # We need to incrementally enforce uniqueness so that each sample is statistically isolated.
-    # That is to say, if an interval is selected at 10000 meters, it needs to be removed from all closer ranges.
-    descending_keys = list(interval_dicts.keys())
-    descending_keys.sort(reverse=True)
+    return {
+        "interval_left": pd.date_range(
+            pd.Timestamp(first_minute), periods=number_of_buckets, freq="1min"
+        ),
+        "minimum_distance": minimum_distance,
+        "messages_within": {
+            threshold: np.bincount(buckets[distances <= threshold], minlength=number_of_buckets)
+            for threshold in distance_thresholds
+        },
+        "vessels_within": {
+            threshold: np.bincount(vessel_buckets[vessel_distances <= threshold], minlength=number_of_buckets)
+            for threshold in distance_thresholds
+        },
+    }
+
+
+def slice_minute_aggregates(minute_aggregates, start, stop=None):
+    '''
+    Keep the minute aggregates of the buckets [start, stop).
+    '''
+    return {
+        "interval_left": minute_aggregates["interval_left"][start:stop],
+        "minimum_distance": minute_aggregates["minimum_distance"][start:stop],
+        "messages_within": {
+            threshold: counts[start:stop] for threshold, counts in minute_aggregates["messages_within"].items()
+        },
+        "vessels_within": {
+            threshold: counts[start:stop] for threshold, counts in minute_aggregates["vessels_within"].items()
+        },
+    }
+
+
+def concatenate_minute_aggregates(first_aggregates, second_aggregates):
+    '''
+    Append the minute aggregates of the buckets that follow the first ones.
+    '''
+    return {
+        "interval_left": first_aggregates["interval_left"].append(second_aggregates["interval_left"]),
+        "minimum_distance": np.concatenate(
+            [first_aggregates["minimum_distance"], second_aggregates["minimum_distance"]]
+        ),
+        "messages_within": {
+            threshold: np.concatenate([counts, second_aggregates["messages_within"][threshold]])
+            for threshold, counts in first_aggregates["messages_within"].items()
+        },
+        "vessels_within": {
+            threshold: np.concatenate([counts, second_aggregates["vessels_within"][threshold]])
+            for threshold, counts in first_aggregates["vessels_within"].items()
+        },
+    }
+
+
+def save_scenario_state(state_file, minute_aggregates, parameters, cut_minute, background_resume_minutes, vessel_resume_minutes):
+    '''
+    Persist the minute aggregates of a deployment and the tail state needed to
+    continue the identification when new AIS days arrive. Buckets from
+    cut_minute onwards are recomputed from the AIS data, and the intervals of
+    each radius are identified again from its resume minute onwards.
+    '''
+    thresholds = np.array(sorted(minute_aggregates["messages_within"].keys()))
+
+    np.savez(
+        state_file,
+        parameters=parameters,
+        first_minute=minute_aggregates["interval_left"][0].to_datetime64().astype("datetime64[m]"),
+        thresholds=thresholds,
+        minimum_distance=minute_aggregates["minimum_distance"],
+        messages_within=np.stack([minute_aggregates["messages_within"][threshold] for threshold in thresholds]),
+        vessels_within=np.stack([minute_aggregates["vessels_within"][threshold] for threshold in thresholds]),
+        cut_minute=cut_minute,
+        background_resume_minutes=background_resume_minutes,
+        vessel_resume_minutes=vessel_resume_minutes,
+    )
 
-    print(f"Identifying consecutively time intervals and saving to feather file...")
-    for distance_index, key in tqdm(enumerate(descending_keys)):
 
-        # Create a temporary DataFrame with a single column.
-        temporary_data_frame = pd.DataFrame(
-            interval_dicts[key],
-            columns=["closed_left"],
-        )
+def load_scenario_state(state_file, parameters):
+    '''
+    Load the state saved by save_scenario_state. Returns None when there is no
+    state or when it was computed with other parameters.
+    '''
+    if not os.path.exists(state_file):
+        return None
 
-        # Calculate the difference between each row and the next.
-        temporary_data_frame["difference"] = (
-            temporary_data_frame["closed_left"]
-            .diff()
-            .dt.total_seconds()
-            .div(60, fill_value=0.0)
+    with np.load(state_file) as state:
+        if not np.array_equal(state["parameters"], parameters):
+            return None
+
+        minute_aggregates = {
+            "interval_left": pd.date_range(
+                pd.Timestamp(state["first_minute"][()]), periods=state["minimum_distance"].shape[0], freq="1min"
+            ),
+            "minimum_distance": state["minimum_distance"],
+            "messages_within": dict(zip(state["thresholds"], state["messages_within"])),
+            "vessels_within": dict(zip(state["thresholds"], state["vessels_within"])),
+        }
+
+        return (
+            minute_aggregates,
+            state["cut_minute"][()],
+            state["background_resume_minutes"],
+            state["vessel_resume_minutes"],
         )
 
-        # This logic ignore the first occurency of consecutive diference (the value will be 1 for the first element).
-        # This behaviour is compensated at the feather file dump by incrementing one to the interval.
-        # Tally the number of consecutive differences (e.g. where delta_time == 1 consistently).
-        temporary_data_frame["consecutive"] = (
-            temporary_data_frame["difference"]
-            .groupby(
-                (
-                    temporary_data_frame["difference"]
-                    != temporary_data_frame["difference"].shift()
-                ).cumsum()
+
+def get_scenario_masks(minute_aggregates, inclusion_radii, exclusion_radius_offset=2000):
+    '''
+    Evaluate every inclusion radius over the minute aggregates. Yields the
+    inclusion radius, the exclusion radius and the masks of the background
+    and of the single vessel buckets.
+    '''
+    for inclusion_radius in inclusion_radii:
+        exclusion_radius = inclusion_radius + exclusion_radius_offset
+
+        # No entries within exclusion range means that we can use this interval for background noise estimation.
+        is_background = minute_aggregates["minimum_distance"] > exclusion_radius
+
+        # If there is only a single vessel within the exclusion range and that vessel is within the inclusion range.
+        is_single_vessel = (
+            ~is_background
+            & (minute_aggregates["vessels_within"][exclusion_radius] == 1)
+            & (
+                minute_aggregates["messages_within"][inclusion_radius]
+                == minute_aggregates["messages_within"][exclusion_radius]
             )
-            .transform("size")
         )
 
-        # Select only the intervals where the consecutive number (e.g. total time) meets the criteria above.
-        temporary_data_frame = temporary_data_frame[
-            temporary_data_frame["consecutive"] >= minimum_consecutive_minutes
+        yield inclusion_radius, exclusion_radius, is_background, is_single_vessel
+
+
+def get_scenario_radii(key):
+    '''
+    Get the radii of a scenario key, to sort the keys by distance: the
+    exclusion radius of a background key, or the (inclusion, exclusion) radii
+    of an "in_{inclusion}_out_{exclusion}" vessel key, as numbers, since the
+    zero padding of the names does not cover radii of six digits or more.
+    '''
+    if isinstance(key, str):
+        scenario_parts = key.split("_")
+        return int(scenario_parts[1]), int(scenario_parts[3])
+
+    return key
+
+
+def get_resume_positions(scenario_masks, list_of_data_to_fetch, cut_position, interval_left):
+    '''
+    Find, for each key of scenario_masks, the first bucket from which its
+    intervals have to be identified again when the buckets from cut_position
+    onwards change. It is the start of the selected sequence that is still
+    open at the cut, or of an interval that is not complete before it.
+    Closer ranges never resume after farther ones, because the intervals
+    selected at farther ranges are removed from them.
+    '''
+    resume_positions = {}
+    resume_position = cut_position
+
+    for key in sorted(scenario_masks, key=get_scenario_radii, reverse=True):
+        mask = scenario_masks[key]
+        interval_positions = [
+            (
+                (interval[0] - interval_left[0]) // pd.Timedelta(minutes=1),
+                (interval[1] - interval_left[0]) // pd.Timedelta(minutes=1),
+            )
+            for interval in list_of_data_to_fetch.get(key, [])
         ]
 
-        start_index = -1
-        end_index = -1
-        start_timestamp = None
-        end_timestamp = None
+        while True:
+            previous_resume_position = resume_position
+
+            if resume_position > 0 and mask[resume_position - 1]:
+                unselected_positions = np.flatnonzero(~mask[:resume_position - 1])
+                resume_position = unselected_positions[-1] + 1 if unselected_positions.shape[0] else 0
+
+            # An interval begins one bucket after its sequence starts.
+            for begin_position, end_position in interval_positions:
+                if end_position > resume_position and begin_position - 1 < resume_position:
+                    resume_position = max(begin_position - 1, 0)
+
+            if resume_position == previous_resume_position:
+                break
+
+        resume_positions[key] = int(resume_position)
+
+    return resume_positions
+
+
+def read_intervals_csv(interval_file, is_background=True):
+    '''
+    Read the intervals written by write_intervals back into [begin, end] lists per key.
+    '''
+    list_of_data_to_fetch = {}
+    if not os.path.exists(interval_file):
+        return list_of_data_to_fetch
+
+    interval_data = pd.read_csv(interval_file, dtype=str)
+    for row in interval_data.itertuples(index=False):
+        if is_background:
+            key = int(row.exclusion_radius)
+        else:
+            key = f"in_{row.inclusion_radius}_out_{row.exclusion_radius}"
+
+        if key not in list_of_data_to_fetch:
+            list_of_data_to_fetch[key] = []
+
+        list_of_data_to_fetch[key].append(
+            [pd.Timestamp(zulu_string_to_datetime(row.begin)), pd.Timestamp(zulu_string_to_datetime(row.end))]
+        )
+
+    return list_of_data_to_fetch
+
+
+def get_consecutive_runs(minutes, minimum_consecutive_minutes):
+    '''
+    Run-length encode the differences between a sorted array of minute indices
+    and return the [start, end) indices of the runs with at least
+    minimum_consecutive_minutes equal differences.
+    The first minute of a sequence has a different difference from the ones
+    that follow it, so it is not part of the run (its difference is the gap
+    from the previous sequence). This is compensated at the feather file dump
+    by adding one minute to both sides of the interval.
+    '''
+    if minutes.shape[0] == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    differences = np.diff(minutes, prepend=minutes[0])
+    run_boundaries = np.flatnonzero(differences[1:] != differences[:-1]) + 1
+
+    run_starts = np.r_[0, run_boundaries]
+    run_ends = np.r_[run_boundaries, minutes.shape[0]]
+    is_long_enough = (run_ends - run_starts) >= minimum_consecutive_minutes
+
+    return run_starts[is_long_enough], run_ends[is_long_enough]
+
+
+def get_unique_intervals(interval_dicts, minimum_consecutive_minutes=30, previous_intervals=None):
+    '''
+    Find the intervals of at least minimum_consecutive_minutes for each key of
+    interval_dicts (an exclusion radius or a scenario name, mapped to the
+    selected 1-minute bucket lefts). Returns the [begin, end] intervals per key.
+    The previous_intervals of each key, selected by an earlier run before the
+    minutes of interval_dicts, are kept and removed from the closer ranges too.
+    '''
+
+    list_of_data_to_fetch = {}
+
+    if previous_intervals is None:
+        previous_intervals = {}
+
+    # Work on integer minute indices, which are the left edges of the 1-minute buckets.
+    interval_minutes = {
+        key: pd.DatetimeIndex(values).values.astype("datetime64[m]").astype(np.int64)
+        for key, values in interval_dicts.items()
+    }
+
+    # We need to incrementally enforce uniqueness so that each sample is statistically isolated.
+    # That is to say, if an interval is selected at 10000 meters, it needs to be removed from all closer ranges.
+    descending_keys = list(set(interval_dicts) | set(previous_intervals))
+    descending_keys.sort(key=get_scenario_radii, reverse=True)
+
+    print(f"Identifying consecutively time intervals and saving to feather file...")
+    for distance_index, key in tqdm(enumerate(descending_keys)):
+
+        minutes = interval_minutes.get(key, np.empty(0, dtype=np.int64))
+        run_starts, run_ends = get_consecutive_runs(minutes, minimum_consecutive_minutes)
+
+        if previous_intervals.get(key):
+            list_of_data_to_fetch[key] = list(previous_intervals[key])
 
-        # There is most certainly a more pandas way of doing this whole process, but bugger it, this is fast enough.
         # Get start and end timestamps from the consecutive periods.
-        while end_index != (temporary_data_frame.shape[0] - 1):
-            start_index = end_index + 1
-            end_index = (
-                start_index
-                + temporary_data_frame.iloc[start_index]["consecutive"]
-                - 1
-            )
-            start_timestamp = temporary_data_frame.iloc[start_index][
-                "closed_left"
-            ]
-            end_timestamp = temporary_data_frame.iloc[end_index][
-                "closed_left"
-            ] + pd.DateOffset(minutes=1)
+        start_timestamps = pd.DatetimeIndex(minutes[run_starts].astype("datetime64[m]"))
+        end_timestamps = pd.DatetimeIndex((minutes[run_ends - 1] + 1).astype("datetime64[m]"))
 
+        for start_timestamp, end_timestamp in zip(start_timestamps, end_timestamps):
             if key not in list_of_data_to_fetch:
                 list_of_data_to_fetch[key] = []
 
@@ -168,19 +437,43 @@ def generate_csv(
                 [start_timestamp, end_timestamp]
             )
 
+        # Every minute of the selected runs is removed from the closer ranges with a sorted set difference.
+        run_lengths = run_ends - run_starts
+        selected_minutes = minutes[
+            np.repeat(run_starts - np.r_[0, np.cumsum(run_lengths)[:-1]], run_lengths)
+            + np.arange(run_lengths.sum())
+        ]
 
-        # Having the reference list as a set makes the look-up an O(1) operation instead of an O(N) for a list.
-        # Utterly hilarious difference in performance between those two with large lists.
-        reference_list = set(temporary_data_frame["closed_left"])
+        previous_minutes = [
+            np.arange(*pd.DatetimeIndex(interval).values.astype("datetime64[m]").astype(np.int64))
+            for interval in previous_intervals.get(key, [])
+        ]
+        selected_minutes = np.concatenate(previous_minutes + [selected_minutes])
 
         for modify_index in range(distance_index + 1, len(descending_keys)):
-            interval_dicts[descending_keys[modify_index]] = [
-                value
-                for value in interval_dicts[
-                    descending_keys[modify_index]
-                ]
-                if value not in reference_list
-            ]
+            if descending_keys[modify_index] not in interval_minutes:
+                continue
+
+            interval_minutes[descending_keys[modify_index]] = np.setdiff1d(
+                interval_minutes[descending_keys[modify_index]],
+                selected_minutes,
+                assume_unique=True,
+            )
+
+    return list_of_data_to_fetch
+
+
+def write_intervals(
+    list_of_data_to_fetch,
+    device,
+    deployment_begin,
+    deployment_end,
+    scenario_intervals_directory,
+    interval_ais_data_directory,
+    deployment_files,
+    is_background=True,
+    csv_name="file.csv"
+    ):
 
     file_name = "_".join(
         [
@@ -227,30 +520,261 @@ def generate_csv(
                         + "\n"
                     )
 
-            # Dump the AIS data for these scenarios to individual feather files.
-            feather_file_name = "_".join(
+    output_file.close()
+
+    # Instead of dumping the AIS data of each interval, record where its rows are in the time-sorted deployment files.
+    intervals = [interval for intervals in list_of_data_to_fetch.values() for interval in intervals]
+    interval_table = {
+        "interval_id": [get_interval_id(interval[0], interval[1]) for interval in intervals],
+    }
+
+    interval_begins = [interval[0] - pd.DateOffset(minutes=1) for interval in intervals]
+    interval_ends = [interval[1] + pd.DateOffset(minutes=1) for interval in intervals]
+
+    for file_type, deployment_file in zip(["raw", "delta"], deployment_files):
+        row_starts, row_stops = get_feather_row_ranges(deployment_file, interval_begins, interval_ends)
+
+        interval_table[f"{file_type}_file"] = os.path.relpath(deployment_file, interval_ais_data_directory)
+        interval_table[f"{file_type}_start"] = row_starts
+        interval_table[f"{file_type}_stop"] = row_stops
+
+    dump_data_frame_to_feather_file(
+        os.path.join(
+            interval_ais_data_directory,
+            file_name.replace(".csv", "_ais_data.feather"),
+        ),
+        pd.DataFrame(interval_table),
+    )
+
+
+def get_scenario_state_file(device, deployment_begin, deployment_end, scenario_intervals_directory):
+    return os.path.join(
+        scenario_intervals_directory,
+        "_".join(
+            [
+                device,
+                pandas_timestamp_to_zulu_format(deployment_begin),
+                pandas_timestamp_to_zulu_format(deployment_end),
+                "scenario_state.npz",
+            ]
+        ),
+    )
+
+
+def read_appended_ais_data(deployment_files, cut_minute, deployment_end, columns):
+    '''
+    Read only the AIS rows from cut_minute onwards of the raw and interpolated
+    delta files. Their order does not matter for the minute aggregates.
+    '''
+    data_frames = []
+    for deployment_file in deployment_files:
+        row_range = get_feather_row_range(deployment_file, pd.Timestamp(cut_minute), deployment_end)
+        data_frames.append(
+            read_data_frame_from_feather_file(deployment_file, columns=columns, row_range=row_range)
+        )
+
+    return pd.concat(data_frames, ignore_index=True)
+
+
+def identify_deployment_scenarios(
+    device,
+    deployment_begin,
+    deployment_end,
+    deployment_files,
+    scenario_intervals_directory,
+    interval_ais_data_directory,
+    inclusion_radii,
+    exclusion_radius_offset=2000,
+    background_minimum_consecutive_minutes=30,
+    vessel_minimum_consecutive_minutes=5,
+    incremental=False,
+    overlap_minutes=60,
+):
+    '''
+    Identify the background and unique vessel intervals of a single deployment.
+    Returns the (exclusion, inclusion) radius pairs that matched at least one
+    minute, so the sanity check maps can be rendered afterwards.
+    With incremental=True and a state file from a previous run with the same
+    parameters, only the AIS rows of the last overlap_minutes of that run and
+    the appended days are aggregated, and only the intervals that were not
+    complete before the state resume minute are identified again.
+    '''
+
+    print(
+        "\nWorking on device {0} for deployment from {1} to {2}...".format(
+            device, deployment_begin, deployment_end
+        )
+    )
+
+    scenario_columns = ["pd_timestamp", "mmsi", "distance_to_hydrophone"]
+    distance_thresholds = np.union1d(
+        inclusion_radii, inclusion_radii + exclusion_radius_offset
+    )
+
+    state_file = get_scenario_state_file(device, deployment_begin, deployment_end, scenario_intervals_directory)
+    state_parameters = np.r_[
+        inclusion_radii,
+        exclusion_radius_offset,
+        background_minimum_consecutive_minutes,
+        vessel_minimum_consecutive_minutes,
+    ]
+
+    interval_files = {
+        is_background: os.path.join(
+            scenario_intervals_directory,
+            "_".join(
                 [
-                    pandas_timestamp_to_zulu_format(interval[0]),
-                    pandas_timestamp_to_zulu_format(interval[1]),
-                    "interval_data.feather",
+                    device,
+                    pandas_timestamp_to_zulu_format(deployment_begin),
+                    pandas_timestamp_to_zulu_format(deployment_end),
+                    csv_name,
                 ]
-            )
+            ),
+        )
+        for is_background, csv_name in [(True, "background_intervals.csv"), (False, "unique_vessel_intervals.csv")]
+    }
 
-            dump_data_frame_to_feather_file(
-                os.path.join(interval_ais_data_directory, feather_file_name),
-                data_frame[
-                    (
-                        data_frame["pd_timestamp"]
-                        >= (interval[0] - pd.DateOffset(minutes=1))
-                    )
-                    & (
-                        data_frame["pd_timestamp"]
-                        <= (interval[1] + pd.DateOffset(minutes=1))
-                    )
-                ],
-            )
+    state = None
+    if incremental and all(os.path.exists(interval_file) for interval_file in interval_files.values()):
+        state = load_scenario_state(state_file, state_parameters)
 
-    output_file.close()
+    if state is None:
+        # Only the columns used for the scenario detection are read from the memory-mapped files.
+        data_frame = read_interpolated_ais_data(*deployment_files, columns=scenario_columns)
+
+        # The whole deployment is reduced to per-minute aggregates once, and every radius is then evaluated as array masks.
+        minute_aggregates = get_minute_aggregates(data_frame, distance_thresholds)
+    else:
+        previous_aggregates, cut_minute, background_resume_minutes, vessel_resume_minutes = state
+        first_minute = previous_aggregates["interval_left"][0].to_datetime64().astype("datetime64[m]")
+        cut_minute = max(cut_minute, first_minute)
+
+        # The buckets before the cut are final, so only the newer rows are read and aggregated.
+        data_frame = read_appended_ais_data(deployment_files, cut_minute, deployment_end, scenario_columns)
+        appended_minutes = data_frame["pd_timestamp"].to_numpy(dtype="datetime64[ns]").astype("datetime64[m]")
+        last_minute = appended_minutes.max() if appended_minutes.shape[0] else cut_minute - 1
+
+        minute_aggregates = concatenate_minute_aggregates(
+            slice_minute_aggregates(previous_aggregates, 0, int((cut_minute - first_minute).astype(np.int64))),
+            get_minute_aggregates(data_frame, distance_thresholds, first_minute=cut_minute, last_minute=last_minute),
+        )
+
+        print(f"  Resuming from {pd.Timestamp(cut_minute)} with {data_frame.shape[0]} appended AIS rows...")
+
+    interval_left = minute_aggregates["interval_left"]
+
+    # 2: Find the time intervals where only one vessel is within range.
+
+    # Radii pairs that matched at least one minute, for the optional sanity check maps.
+    mapped_radii = []
+
+    # Breaking the data off into dictionaries of masks to make organising it easier, compared to n-columns being added to all entries.
+    background_masks = {}
+    vessel_masks = {}
+
+    reporting_day = interval_left[0].normalize()
+
+    print(f"Processing {interval_left.shape[0]} minutes from day {reporting_day} now...")
+
+    for inclusion_radius, exclusion_radius, is_background, is_single_vessel in tqdm(
+        get_scenario_masks(minute_aggregates, inclusion_radii, exclusion_radius_offset),
+        total=len(inclusion_radii),
+    ):
+        background_masks[exclusion_radius] = is_background
+        vessel_masks[f"in_{inclusion_radius:05d}_out_{exclusion_radius:05d}"] = is_single_vessel
+
+        if is_background.any():
+            mapped_radii.append((exclusion_radius, 0))
+
+        if is_single_vessel.any():
+            mapped_radii.append((exclusion_radius, inclusion_radius))
+
+    print(f"  Finished identifying all scenarios...")
+
+    # Tail state for the next incremental run.
+    cut_position = max(interval_left.shape[0] - overlap_minutes, 0)
+    state_resume_minutes = {}
+
+    for is_background, scenario_masks, minimum_consecutive_minutes, csv_name in [
+        (True, background_masks, background_minimum_consecutive_minutes, "background_intervals.csv"),
+        (False, vessel_masks, vessel_minimum_consecutive_minutes, "unique_vessel_intervals.csv"),
+    ]:
+        resume_positions = dict.fromkeys(scenario_masks, 0)
+        previous_intervals = None
+
+        if state is not None:
+            resume_minutes = background_resume_minutes if is_background else vessel_resume_minutes
+            resume_positions = {
+                key: int((resume_minute - first_minute).astype(np.int64))
+                for key, resume_minute in zip(scenario_masks, resume_minutes)
+            }
+
+            # The intervals that were complete before the resume minute of their key are kept from the previous run.
+            previous_intervals = {
+                key: [
+                    interval for interval in intervals
+                    if interval[1] <= interval_left[resume_positions[key]]
+                ]
+                for key, intervals in read_intervals_csv(interval_files[is_background], is_background).items()
+            }
+
+        interval_dicts = {
+            key: interval_left[resume_positions[key]:][mask[resume_positions[key]:]]
+            for key, mask in scenario_masks.items()
+            if mask[resume_positions[key]:].any()
+        }
+
+        # Find unique intervals.
+        list_of_data_to_fetch = get_unique_intervals(
+            interval_dicts, minimum_consecutive_minutes, previous_intervals
+        )
+
+        write_intervals(
+            list_of_data_to_fetch,
+            device,
+            deployment_begin,
+            deployment_end,
+            scenario_intervals_directory,
+            interval_ais_data_directory,
+            deployment_files,
+            is_background=is_background,
+            csv_name=csv_name,
+        )
+
+        resume_positions = get_resume_positions(scenario_masks, list_of_data_to_fetch, cut_position, interval_left)
+        state_resume_minutes[is_background] = interval_left[
+            [resume_positions[key] for key in scenario_masks]
+        ].values.astype("datetime64[m]")
+
+    save_scenario_state(
+        state_file,
+        minute_aggregates,
+        state_parameters,
+        interval_left[cut_position].to_datetime64().astype("datetime64[m]"),
+        state_resume_minutes[True],
+        state_resume_minutes[False],
+    )
+
+    return mapped_radii
+
+
+def get_number_of_deployment_workers(deployment_files_list, use_all_threads=False):
+    '''
+    Limit the number of deployments processed at the same time by the number of
+    threads and by how many of the largest deployments fit in the available memory.
+    '''
+    number_of_workers = min(get_num_of_threads(use_all_threads), len(deployment_files_list))
+
+    available_memory = get_available_memory()
+    if available_memory is not None and deployment_files_list:
+        largest_deployment_size = max(
+            sum(os.path.getsize(file) for file in deployment_files)
+            for deployment_files in deployment_files_list
+        )
+        deployment_memory = DEPLOYMENT_MEMORY_FACTOR * largest_deployment_size
+        number_of_workers = min(number_of_workers, int(available_memory // max(deployment_memory, 1)))
+
+    return max(number_of_workers, 1)
 
 
 def identify_scenarios(
@@ -259,14 +783,36 @@ def identify_scenarios(
     scenario_intervals_directory,
     interval_ais_data_directory,
     combined_deployment_directory,
+    plot_maps=False,
+    minimum_radius=1000,
+    maximum_radius=10000,
+    radius_step=1000,
+    exclusion_radius_offset=2000,
+    background_minimum_consecutive_minutes=30,
+    vessel_minimum_consecutive_minutes=5,
+    incremental=False,
+    overlap_minutes=60,
+    use_all_threads=False,
 ):
+    '''
+    This function finds, for every inclusion radius of the grid, the time
+    intervals where no vessel is within the exclusion radius (background) and
+    where only one vessel is within range. Deployments are independent, so
+    they are processed in parallel, as many at a time as the memory allows.
+    With incremental=True, deployments that were already identified only
+    process the AIS days appended since the previous run.
+    '''
+
+    inclusion_radii = np.arange(
+        minimum_radius, maximum_radius + radius_step, radius_step
+    )
 
     # Read in the hydrophone deployments as we will treat each deployment as an individual dataset.
     hydrophone_deployments = get_hydrophone_deployments(deployment_directory)
 
     # 1: Find all of the cleaned AIS files for each deployment.
-    devices = hydrophone_deployments.keys()
-    for device in devices:
+    deployments = []
+    for device in hydrophone_deployments.keys():
         for deployment in hydrophone_deployments[device].itertuples(index=False):
 
             deployment_begin = pd.Timestamp(deployment.begin).normalize()
@@ -274,162 +820,63 @@ def identify_scenarios(
                 days=1
             )
 
-            print(
-                "\nWorking on device {0} for deployment from {1} to {2}...".format(
-                    device, deployment_begin, deployment_end
+            # The raw AIS data and its interpolated rows are stored separately and merged on read.
+            deployment_files = tuple(
+                os.path.join(
+                    combined_deployment_directory,
+                    "_".join(
+                        [
+                            device,
+                            pandas_timestamp_to_zulu_format(deployment_begin),
+                            pandas_timestamp_to_zulu_format(deployment_end),
+                            file_suffix,
+                        ]
+                    ),
                 )
+                for file_suffix in ["clean_ais_data.feather", "clean_interpolated_delta_ais_data.feather"]
             )
 
-            deployment_file_name = "_".join(
-                [
-                    device,
-                    pandas_timestamp_to_zulu_format(deployment_begin),
-                    pandas_timestamp_to_zulu_format(deployment_end),
-                    "clean_interpolated_ais_data.feather",
-                ]
-            )
-
-            data_frame = read_data_frame_from_feather_file(
-                os.path.join(combined_deployment_directory, deployment_file_name)
+            deployments.append(
+                (device, deployment_begin, deployment_end, deployment_files, (deployment.latitude, deployment.longitude))
             )
 
-            minimum_distance = 1000
-            maximum_distance = 10000
-            distance_step = 1000
-            inclusion_radii = np.arange(
-                minimum_distance, maximum_distance + distance_step, distance_step
-            )
-            exclusion_radius_offset = 2000
-
-            data_frame = data_frame.sort_values(by=["pd_timestamp"])
-
-            # 2: Find the time intervals where only one vessel is within range.
-
-            map_data_directory = create_dir(
-                working_directory, "99_inclusion_exclusion_zone_maps"
-            )
-
-            # Sanity checking for one-time map generation per entry.
-            exclusion_radii_mapped = []
-            inclusion_radii_mapped = []
-
-            # Breaking the data off into dictionaries of DataFrames to make organising it easier, compared to n-columns being added to all entries.
-            inclusion_exclusion_interval_dicts = {}
-            background_noise_interval_dicts = {}
-
-            data_frame.set_index(data_frame["pd_timestamp"], inplace=True)
-
-            grouped_by_time_intervals = data_frame.groupby(
-                pd.Grouper(freq="1Min", offset="0Min", label="left")
-            )
-
-            reporting_day = (
-                grouped_by_time_intervals.first().iloc[0]["pd_timestamp"].normalize()
-            )
-
-            print(f"Processing day {reporting_day} now...")
-
-            # Due to the size of the primary DataFrame, we only really want to iterate through the entire thing once, so the interval is top.
-            for interval_left, interval_data in tqdm(grouped_by_time_intervals):
-
-                for inclusion_radius in inclusion_radii:
-                    exclusion_radius = inclusion_radius + exclusion_radius_offset
-
-                    # No entries within exclusion range means that we can use this interval for background noise estimation.
-                    if (sum(interval_data["distance_to_hydrophone"] <= exclusion_radius) == 0):
-                        if exclusion_radius not in background_noise_interval_dicts:
-                            background_noise_interval_dicts[exclusion_radius] = []
-
-                        background_noise_interval_dicts[exclusion_radius].append(interval_left)
-
-                        # Create the map for sanity checking.
-                        if exclusion_radius not in exclusion_radii_mapped:
-                            exclusion_radii_mapped.append(exclusion_radius)
-                            plot_map(
-                                deployment,
-                                device,
-                                map_data_directory,
-                                exclusion_radius=exclusion_radius,
-                                file_name=f"exclusion_radius_{exclusion_radius:05d}_metres.html"
-                            )
-
-                    # Else there is something in the exclusion range.
-                    else:
-                        only_one_vessel_within_exclusion_radius = (
-                            interval_data[
-                                interval_data["distance_to_hydrophone"]
-                                <= exclusion_radius
-                            ]["mmsi"]
-                            .unique()
-                            .shape[0]
-                        ) == 1
-
-                        number_of_messages_in_inclusion_radius = sum(
-                            interval_data["distance_to_hydrophone"] <= inclusion_radius
-                        )
-                        number_of_messages_in_exclusion_radius = sum(
-                            interval_data["distance_to_hydrophone"] <= exclusion_radius
-                        )
-                        all_messages_are_within_inclusion_radius = (
-                            number_of_messages_in_inclusion_radius
-                            == number_of_messages_in_exclusion_radius
-                        )
+    number_of_workers = get_number_of_deployment_workers(
+        [deployment[3] for deployment in deployments], use_all_threads
+    )
+    print(f"Identifying scenarios of {len(deployments)} deployments with {number_of_workers} workers...")
+
+    function_partial = partial(
+        identify_deployment_scenarios,
+        scenario_intervals_directory=scenario_intervals_directory,
+        interval_ais_data_directory=interval_ais_data_directory,
+        inclusion_radii=inclusion_radii,
+        exclusion_radius_offset=exclusion_radius_offset,
+        background_minimum_consecutive_minutes=background_minimum_consecutive_minutes,
+        vessel_minimum_consecutive_minutes=vessel_minimum_consecutive_minutes,
+        incremental=incremental,
+        overlap_minutes=overlap_minutes,
+    )
+    deployment_arguments = [deployment[:4] for deployment in deployments]
 
-                        # If there is only a single vessel within the exclusion range and that vessel is within the inclusion range.
-                        if (
-                            only_one_vessel_within_exclusion_radius
-                            and all_messages_are_within_inclusion_radius
-                        ):
-                            scenario = (
-                                f"in_{inclusion_radius:05d}_out_{exclusion_radius:05d}"
-                            )
-
-                            if scenario not in inclusion_exclusion_interval_dicts:
-                                inclusion_exclusion_interval_dicts[scenario] = []
-
-                            inclusion_exclusion_interval_dicts[scenario].append(
-                                interval_left
-                            )
-
-                            if inclusion_radius not in inclusion_radii_mapped:
-                                inclusion_radii_mapped.append(inclusion_radius)
-
-                                plot_map(
-                                    deployment,
-                                    device,
-                                    map_data_directory,
-                                    exclusion_radius=exclusion_radius,
-                                    inclusion_radius=inclusion_radius,
-                                    file_name=f"inclusion_radius_{inclusion_radius:05d}_metres_exclusion_radius_{exclusion_radius:05d}_metres.html"
-                                )
-
-            print(f"  Finished identifying all scenarios...")
-
-            # Find unique background intervals.
-            generate_csv(
-                background_noise_interval_dicts,
-                device,
-                deployment_begin,
-                deployment_end,
-                scenario_intervals_directory,
-                interval_ais_data_directory,
-                data_frame,
-                minimum_consecutive_minutes=30,
-                is_background=True,
-                csv_name="background_intervals.csv"
-            )
+    if number_of_workers == 1:
+        mapped_radii = [function_partial(*arguments) for arguments in deployment_arguments]
+    else:
+        threading_pool = multiprocessing.Pool(processes=number_of_workers)
+        mapped_radii = threading_pool.starmap(function_partial, deployment_arguments, chunksize=1)
+        threading_pool.close()
+        threading_pool.join()
+
+    # Create the maps for sanity checking.
+    if plot_maps:
+        map_data_directory = create_dir(
+            working_directory, "99_inclusion_exclusion_zone_maps"
+        )
 
-            # Find unique inclusion intervals.
-            generate_csv(
-                inclusion_exclusion_interval_dicts,
+        for (device, _, _, _, deployment_location), deployment_mapped_radii in zip(deployments, mapped_radii):
+            print(f"Rendering {len(deployment_mapped_radii)} inclusion and exclusion zone maps of device {device}...")
+            plot_scenario_maps(
+                deployment_location,
                 device,
-                deployment_begin,
-                deployment_end,
-                scenario_intervals_directory,
-                interval_ais_data_directory,
-                data_frame,
-                minimum_consecutive_minutes=5,
-                is_background=False,
-                csv_name="unique_vessel_intervals.csv"
+                map_data_directory,
+                deployment_mapped_radii,
             )
-
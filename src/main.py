@@ -9,7 +9,9 @@ from clean import clean_ais_data, clean_ctd_data
 from combine import combine_deployment_ais_data
 from identify import identify_scenarios
 from format import group_wav_from_range
-from generate_metadata import generate_full_metadata, generate_balanced_metadata, get_metadata_for_small_times, split_dataset
+from track_index import build_track_index, query_track_index, query_track_rows
+from ctd_index import build_ctd_store
+from generate_metadata import generate_full_metadata, generate_balanced_metadata, get_metadata_for_small_times, split_dataset, split_dataset_by_hash
 
 
 def create_parser():
@@ -55,7 +57,8 @@ def create_parser():
         "10 - Generate the metadata for the full dataset; "
         "11 - Generate a balanced version of the full dataset; "
         "12 - Generate metadata for small periods of duration; "
-        "13 - Split dataset into Train, Test and Validation.",
+        "13 - Split dataset into Train, Test and Validation; "
+        "14 - Build the vessel track index.",
     )
 
     parser.add_argument(
@@ -74,6 +77,35 @@ def create_parser():
         help="The maximum distance (metres) that a vessel can be from the hydrophone. Used on the subset",
     )
 
+    parser.add_argument(
+        "--scenario_radii",
+        type=int,
+        nargs=3,
+        default=SCENARIO_RADII,
+        help="The minimum, maximum and step (metres) of the inclusion radius grid searched on step 5.",
+    )
+
+    parser.add_argument(
+        "--exclusion_radius_offset",
+        type=int,
+        default=EXCLUSION_RADIUS_OFFSET,
+        help="The distance (metres) added to the inclusion radius to get the exclusion radius.",
+    )
+
+    parser.add_argument(
+        "--background_minutes",
+        type=int,
+        default=BACKGROUND_MINIMUM_MINUTES,
+        help="The minimum consecutive minutes of a background interval.",
+    )
+
+    parser.add_argument(
+        "--vessel_minutes",
+        type=int,
+        default=VESSEL_MINIMUM_MINUTES,
+        help="The minimum consecutive minutes of a unique vessel interval.",
+    )
+
     parser.add_argument(
         "--seconds",
         "-t",
@@ -90,12 +122,49 @@ def create_parser():
         help="Define if the metadata will include ctd information.",
     )
 
+    parser.add_argument(
+        "--use_ctd_store",
+        type=int,
+        default=USE_CTD_STORE,
+        help="Define if step 10 reads the CTD means from the CTD store built after step 9 instead of the cleaned CTD files.",
+    )
+
+    parser.add_argument(
+        "--plot_maps",
+        "-p",
+        type=int,
+        default=PLOT_MAPS,
+        help="Define if the inclusion and exclusion zone maps are rendered on step 5.",
+    )
+
+    parser.add_argument(
+        "--virtual_segments",
+        type=int,
+        default=VIRTUAL_SEGMENTS,
+        help="Define if step 7 writes only a manifest of the audio segments instead of copying them.",
+    )
+
+    parser.add_argument(
+        "--incremental",
+        type=int,
+        default=INCREMENTAL_IDENTIFY,
+        help="Define if step 5 only processes the AIS days appended since its previous run.",
+    )
+
     parser.add_argument(
         "--metadata_file",
         "-f",
         type=str,
         default=METADATA_FILE,
-        help="The name of the metadata file without the extension. Assumed to be .csv",
+        help="The name of the metadata file without the extension.",
+    )
+
+    parser.add_argument(
+        "--metadata_format",
+        type=str,
+        choices=["csv", "parquet"],
+        default=METADATA_FORMAT,
+        help="The format of the metadata files written and read on steps 10 to 13.",
     )
 
     parser.add_argument(
@@ -114,44 +183,155 @@ def create_parser():
         help="The proportion reserved from metadata to the test split"
     )
 
+    parser.add_argument(
+        "--range_encoded",
+        type=int,
+        default=RANGE_ENCODED_METADATA,
+        help="Define if step 11 writes one row per segment with its number of windows instead of one row per window.",
+    )
+
+    parser.add_argument(
+        "--hash_split",
+        type=int,
+        default=HASH_SPLIT,
+        help="Define if step 12 assigns each segment to a split by a hash of its path, reading the metadata in chunks. "
+        "The test and validation splits are then fractions of all of the rows, instead of fractions of the smallest class times the number of classes.",
+    )
+
+    subparsers = parser.add_subparsers(dest="command")
+
+    tracks_parser = subparsers.add_parser(
+        "tracks",
+        help="Query the vessel track index built on step 14 instead of executing steps.",
+    )
+
+    tracks_parser.add_argument(
+        "--device",
+        type=str,
+        required=True,
+        help="The hydrophone device code.",
+    )
+
+    tracks_parser.add_argument(
+        "--begin",
+        type=str,
+        required=True,
+        help="The beginning of the time window, e.g. 2017-06-24T00:00:00.",
+    )
+
+    tracks_parser.add_argument(
+        "--end",
+        type=str,
+        required=True,
+        help="The end of the time window, e.g. 2017-06-25T00:00:00.",
+    )
+
+    tracks_parser.add_argument(
+        "--radius",
+        type=float,
+        default=INCLUSION_RADIUS,
+        help="The maximum distance (metres) from the hydrophone.",
+    )
+
+    tracks_parser.add_argument(
+        "--minimum_radius",
+        type=float,
+        default=0,
+        help="The minimum distance (metres) from the hydrophone.",
+    )
+
+    tracks_parser.add_argument(
+        "--rows",
+        type=int,
+        default=0,
+        help="Define if the matching AIS rows are returned instead of the vessel intervals.",
+    )
+
+    tracks_parser.add_argument(
+        "--output",
+        "-o",
+        type=str,
+        default=None,
+        help="The .csv file where the result is saved. By default, it is printed.",
+    )
+
     return parser
 
 
+def _query_tracks(args, track_index_directory, combined_deployment_directory):
+    if args.rows:
+        result = query_track_rows(
+            track_index_directory,
+            combined_deployment_directory,
+            args.device,
+            args.begin,
+            args.end,
+            args.radius,
+            minimum_radius=args.minimum_radius,
+        )
+    else:
+        result = query_track_index(
+            track_index_directory,
+            args.device,
+            args.begin,
+            args.end,
+            args.radius,
+            minimum_radius=args.minimum_radius,
+        )
+
+    if args.output is not None:
+        result.to_csv(args.output, index=False)
+    else:
+        print(result.to_string(index=False))
+
+
 def _main():
     parser = create_parser()
     args = parser.parse_args()
 
-    print(f"{bcolors.HEADER}Dataset Preparation Script{bcolors.ENDC}\n")
-
     working_directory = args.work_dir
 
+    if args.command == "tracks":
+        _query_tracks(
+            args,
+            os.path.join(working_directory, "05b_vessel_track_index"),
+            os.path.join(working_directory, "05_combined_deployment_ais_data"),
+        )
+        return
+
+    print(f"{bcolors.HEADER}Dataset Preparation Script{bcolors.ENDC}\n")
+
     deployment_directory = create_dir(working_directory, "00_hydrophone_deployments")
     raw_ais_directory = create_dir(working_directory, "01_raw_ais_files")
     parsed_ais_directory = create_dir(working_directory, "03_parsed_ais_files")
     clean_ais_directory = create_dir(working_directory, "04_clean_and_inrange_ais_data")
     combined_deployment_directory = create_dir(working_directory, "05_combined_deployment_ais_data")
+    track_index_directory = create_dir(working_directory, "05b_vessel_track_index")
     scenario_intervals_directory = create_dir(working_directory, "06a_scenario_intervals")
     interval_ais_data_directory = create_dir(working_directory, "06b_interval_ais_data")
     needed_wav_directory = create_dir(working_directory, "07a_needed_wav_files")
     classified_wav_directory = create_dir(working_directory, "07b_classified_wav_files")
     raw_ctd_directory = create_dir(working_directory, "08_raw_ctd_files")
     clean_ctd_directory = create_dir(working_directory, "09_cleaned_ctd_files")
+    ctd_store_directory = create_dir(working_directory, "09b_ctd_store")
 
     token = args.onc_token
 
     # The maximum distance (metres) that a vessel can be from the hydrophone before we start caring about it.
     max_inclusion_radius = args.max_inclusion_radius
     inclusion_radius = args.inclusion_radius
+    exclusion_radius_offset = args.exclusion_radius_offset
 
     # The size of each audio sample in metadata.
     seconds = args.seconds
 
     # The matadata file name.
     metadata_file = args.metadata_file
+    metadata_format = args.metadata_format
     metadata_val_split=args.validation_split
     metadata_test_split=args.test_split
 
-    root_path = os.path.join(classified_wav_directory, f"inclusion_{inclusion_radius}_exclusion_{get_exclusion_radius(inclusion_radius)}")
+    root_path = os.path.join(classified_wav_directory, f"inclusion_{inclusion_radius}_exclusion_{get_exclusion_radius(inclusion_radius, exclusion_radius_offset)}")
 
     if 0 in args.steps:
         print(f"\n{bcolors.HEADER}Querying Ocean Natworks Canada for Deployments{bcolors.ENDC}")
@@ -208,6 +388,16 @@ def _main():
             scenario_intervals_directory,
             interval_ais_data_directory,
             combined_deployment_directory,
+            plot_maps=args.plot_maps,
+            minimum_radius=args.scenario_radii[0],
+            maximum_radius=args.scenario_radii[1],
+            radius_step=args.scenario_radii[2],
+            exclusion_radius_offset=exclusion_radius_offset,
+            background_minimum_consecutive_minutes=args.background_minutes,
+            vessel_minimum_consecutive_minutes=args.vessel_minutes,
+            incremental=args.incremental,
+            overlap_minutes=INCREMENTAL_OVERLAP_MINUTES,
+            use_all_threads=False,
         )
 
     if 6 in args.steps:
@@ -218,6 +408,7 @@ def _main():
             scenario_intervals_directory,
             inclusion_radius,
             token,
+            exclusion_radius_offset=exclusion_radius_offset,
         )
 
     if 7 in args.steps:
@@ -228,6 +419,9 @@ def _main():
             interval_ais_data_directory,
             needed_wav_directory,
             inclusion_radius,
+            exclusion_radius_offset=exclusion_radius_offset,
+            number_of_workers=WAV_EXPORT_WORKERS,
+            virtual=args.virtual_segments,
         )
 
     if 8 in args.steps:
@@ -248,6 +442,17 @@ def _main():
             use_all_threads=False,
         )
 
+        if args.use_ctd_store:
+            print(f"\n{bcolors.HEADER}Building the CTD store{bcolors.ENDC}")
+            build_ctd_store(
+                deployment_directory,
+                clean_ctd_directory,
+                ctd_store_directory,
+                cadence=CTD_STORE_CADENCE,
+                rolling_window=CTD_ROLLING_WINDOW,
+                use_all_threads=False,
+            )
+
     if 10 in args.steps:
         print(f"\n{bcolors.HEADER}Generating the metadata for the full dataset{bcolors.ENDC}")
         generate_full_metadata(
@@ -255,31 +460,47 @@ def _main():
             clean_ctd_directory,
             interval_ais_data_directory,
             inclusion_radius,
-            use_ctd=args.use_ctd
+            use_ctd=args.use_ctd,
+            ctd_store_directory=ctd_store_directory if args.use_ctd_store else None,
+            output_format=metadata_format,
         )
 
     if 11 in args.steps:
         print(f"\n{bcolors.HEADER}Splitting dataset into small periods of time{bcolors.ENDC}")
         get_metadata_for_small_times(
             root_path,
-            f"{metadata_file}.csv",
+            f"{metadata_file}.{metadata_format}",
             seconds,
+            output_format=metadata_format,
+            range_encoded=args.range_encoded,
         )
 
     if 12 in args.steps:
         print(f"\n{bcolors.HEADER}Splitting dataset into train, test and validation datasets{bcolors.ENDC}")
-        split_dataset(
+        split_function = split_dataset_by_hash if args.hash_split else split_dataset
+        split_function(
             root_path,
-            f"{metadata_file}_{seconds}s.csv",
+            f"{metadata_file}_{seconds}s.{metadata_format}",
             validation_split=metadata_val_split,
-            test_split=metadata_test_split
+            test_split=metadata_test_split,
+            output_format=metadata_format,
         )
 
     if 13 in args.steps:
         print(f"\n{bcolors.HEADER}Generating the balanced metadata version{bcolors.ENDC}")
         generate_balanced_metadata(
-            f"{metadata_file}_{seconds}s_train.csv",
+            f"{metadata_file}_{seconds}s_train.{metadata_format}",
             root_path,
+            output_format=metadata_format,
+        )
+
+    if 14 in args.steps:
+        print(f"\n{bcolors.HEADER}Building the vessel track index{bcolors.ENDC}")
+        build_track_index(
+            deployment_directory,
+            combined_deployment_directory,
+            track_index_directory,
+            use_all_threads=False,
         )
 
 
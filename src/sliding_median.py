@@ -0,0 +1,171 @@
+import importlib.util
+
+import numpy as np
+from scipy import ndimage
+
+
+# Padding of np.pad that extends a signal like each boundary mode of scipy.ndimage.
+PAD_MODES = {"reflect": "symmetric", "nearest": "edge", "wrap": "wrap", "constant": "constant"}
+
+# Newer scipy versions filter 1-D signals with a compiled O(n log k) rank filter; the older ones take O(n k).
+SCIPY_FAST_RANK_FILTER = importlib.util.find_spec("scipy.ndimage._rank_filter_1d") is not None
+
+# Pairs of blocks filtered together. More pairs take fewer steps, until their lists are out of the CPU caches.
+PAIRS_PER_BATCH = 1024
+
+
+def _get_sorted_blocks(blocks):
+    '''
+    Get the doubly linked lists of the values of each block in sorted order.
+    The nodes of a block are 0 and kernel_size + 1 for the lowest and highest
+    sentinels, and rank + 1 for its values; the nodes of all of the blocks
+    are numbered together, so the lists are flat arrays of node numbers.
+    '''
+    number_of_blocks, kernel_size = blocks.shape
+    node_count = kernel_size + 2
+
+    # The stable sort breaks ties by position, so equal values keep their order along the signal.
+    order = np.argsort(blocks, axis=1, kind="stable")
+    ranks = np.empty_like(order)
+    np.put_along_axis(ranks, order, np.arange(kernel_size)[np.newaxis], axis=1)
+
+    if np.issubdtype(blocks.dtype, np.floating):
+        lowest, highest = -np.inf, np.inf
+    else:
+        lowest, highest = np.iinfo(blocks.dtype).min, np.iinfo(blocks.dtype).max
+    values = np.empty((number_of_blocks, node_count), dtype=blocks.dtype)
+    values[:, 0] = lowest
+    values[:, 1:-1] = np.take_along_axis(blocks, order, axis=1)
+    values[:, -1] = highest
+
+    # Node numbers of 32 bits halve the memory read on each step, when all of the nodes fit.
+    node_dtype = np.int32 if number_of_blocks * node_count < np.iinfo(np.int32).max else np.int64
+    first_nodes = np.arange(number_of_blocks, dtype=node_dtype)[:, np.newaxis] * node_count
+    nodes = np.arange(number_of_blocks * node_count, dtype=node_dtype).reshape(number_of_blocks, node_count)
+    next_nodes = (nodes + 1).ravel()
+    previous_nodes = (nodes - 1).ravel()
+
+    return values.ravel(), next_nodes, previous_nodes, (ranks + 1 + first_nodes).astype(node_dtype), first_nodes[:, 0]
+
+
+def _get_batch_window_medians(signal, kernel_size):
+    '''
+    Get the median of each window of kernel_size values of a 1-D signal, with
+    the sorted blocks algorithm of J. Suomela, "Median filtering is equivalent
+    to sorting" (2014). The signal is split into blocks of kernel_size values,
+    and the windows starting on a block are made of the values of that block
+    not yet passed and of the first values of the next one. Both are kept as
+    sorted linked lists, and the median moves at most a few nodes on each
+    step, so each step is vectorized over all of the pairs of blocks.
+    '''
+    number_of_windows = signal.shape[0] - kernel_size + 1
+    number_of_pairs = -(-number_of_windows // kernel_size)
+    rank = kernel_size // 2
+
+    # The values past the end only take part in windows that are dropped.
+    blocks = np.zeros((number_of_pairs + 1) * kernel_size, dtype=signal.dtype)
+    blocks[:signal.shape[0]] = signal
+    blocks = blocks.reshape(-1, kernel_size)
+
+    # Each pair has its own lists of the block being left (a) and of the next one, being entered (b).
+    values, next_nodes, previous_nodes, nodes, first_nodes = _get_sorted_blocks(np.concatenate([blocks[:-1], blocks[1:]]))
+    a_nodes = nodes[:number_of_pairs]
+    b_nodes = nodes[number_of_pairs:]
+
+    # The values of b are unlinked from the last one to the first, so linking them back in order restores the list.
+    for position in range(kernel_size - 1, -1, -1):
+        node = b_nodes[:, position]
+        next_nodes[previous_nodes[node]] = next_nodes[node]
+        previous_nodes[next_nodes[node]] = previous_nodes[node]
+
+    # The window starts as the whole block a; a and b point to the first values over the median.
+    a = first_nodes[:number_of_pairs] + rank + 1
+    b = first_nodes[number_of_pairs:] + kernel_size + 1
+    small_count = np.full(number_of_pairs, rank, dtype=np.int32)
+
+    medians = np.empty((number_of_pairs, kernel_size), dtype=signal.dtype)
+    medians[:, 0] = values[a]
+    for position in range(1, kernel_size):
+        # The value of a leaves the window.
+        node = a_nodes[:, position - 1]
+        small_count -= node < a
+        a = np.where(node == a, next_nodes[node], a)
+        next_nodes[previous_nodes[node]] = next_nodes[node]
+        previous_nodes[next_nodes[node]] = previous_nodes[node]
+
+        # The value of b enters the window.
+        node = b_nodes[:, position - 1]
+        next_nodes[previous_nodes[node]] = node
+        previous_nodes[next_nodes[node]] = node
+        small_count += node < b
+
+        # On equal values, the ones of a come first, as they come first on the signal.
+        a_first = values[a] <= values[b]
+        is_short = small_count < rank
+        a = np.where(is_short & a_first, next_nodes[a], a)
+        b = np.where(is_short & ~a_first, next_nodes[b], b)
+
+        previous_a = previous_nodes[a]
+        previous_b = previous_nodes[b]
+        is_long = small_count > rank
+        previous_a_first = values[previous_a] <= values[previous_b]
+        a = np.where(is_long & ~previous_a_first, previous_a, a)
+        b = np.where(is_long & previous_a_first, previous_b, b)
+        small_count += is_short.astype(small_count.dtype) - is_long
+
+        # A value of b under the median can only be over the first value of a when it just entered, so the two swap.
+        previous_b = previous_nodes[b]
+        is_swapped = values[previous_b] >= values[a]
+        a = np.where(is_swapped, next_nodes[a], a)
+        b = np.where(is_swapped, previous_b, b)
+
+        medians[:, position] = np.where(values[a] <= values[b], values[a], values[b])
+
+    return medians.ravel()[:number_of_windows]
+
+
+def get_window_medians(signal, kernel_size):
+    '''
+    Get the median of each window of kernel_size values of a 1-D signal. The
+    pairs of blocks are filtered in batches, whose lists fit in the caches.
+    '''
+    number_of_windows = signal.shape[0] - kernel_size + 1
+    batch_windows = PAIRS_PER_BATCH * kernel_size
+
+    return np.concatenate([
+        _get_batch_window_medians(signal[begin:begin + batch_windows + kernel_size - 1], kernel_size)
+        for begin in range(0, number_of_windows, batch_windows)
+    ])
+
+
+def sliding_median(samples, kernel_size, mode="reflect"):
+    '''
+    Get the median of the kernel_size samples around each sample of a 1-D
+    signal, or of each row of a 2-D batch of signals, with the same result as
+    scipy.ndimage.median_filter on each signal and the same boundary modes
+    (without cval, the constant mode pads with zeros, as scipy.signal.medfilt).
+    It takes O(log k) operations per sample, and all of the signals of a
+    batch are filtered together, by the rank filter of scipy when it is the
+    fast one, or otherwise by get_window_medians.
+    '''
+    samples = np.asarray(samples)
+    if kernel_size == 1 or samples.size == 0:
+        return samples.copy()
+    rows = samples.reshape(-1, samples.shape[-1])
+
+    # The boundary modes extend short signals past their own length in ways of their own.
+    if rows.shape[1] < kernel_size:
+        return np.stack([ndimage.median_filter(row, size=kernel_size, mode=mode) for row in rows]).reshape(samples.shape)
+
+    # The rows are padded like scipy, and filtered as a single signal; the windows across two rows are dropped.
+    left_padding = kernel_size // 2
+    padded_rows = np.pad(rows, ((0, 0), (left_padding, kernel_size - 1 - left_padding)), mode=PAD_MODES[mode])
+
+    if SCIPY_FAST_RANK_FILTER:
+        # The windows of the padded samples are centered on the samples left_padding after their start.
+        window_medians = ndimage.median_filter(padded_rows.ravel(), size=kernel_size)[left_padding:]
+    else:
+        window_medians = get_window_medians(padded_rows.ravel(), kernel_size)
+    window_starts = np.arange(rows.shape[0])[:, np.newaxis] * padded_rows.shape[1] + np.arange(rows.shape[1])
+
+    return window_medians[window_starts].reshape(samples.shape)
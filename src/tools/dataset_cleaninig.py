@@ -1,12 +1,19 @@
 import os
+import sys
+from functools import partial
+from multiprocessing import Pool
 
 import pandas as pd
 import numpy as np
 
-from pydub import AudioSegment
-from scipy import ndimage
 from tqdm import tqdm
 
+# The audio segment reader lives with the pipeline modules.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils import get_num_of_threads
+from sliding_median import sliding_median
+from wav_segments import read_wav_segment
+
 SECONDS = 10
 INCLUSION_RADIUS = 4000
 
@@ -14,52 +21,95 @@ EXCLUSION_RADIUS = 2000 + INCLUSION_RADIUS
 ROOT_PATH = f"/workspaces/underwater/dataset/07_classified_wav_files/inclusion_{INCLUSION_RADIUS}_exclusion_{EXCLUSION_RADIUS}/metadata/complete"
 METADATA = f"{ROOT_PATH}/metadata.csv"
 
-def flutuation_analysis(metadata):
+# Maximum number of chunks filtered at once by a worker, which bounds its memory.
+CHUNKS_PER_BATCH = 32
+USE_ALL_THREADS = False
+
+def get_flutuation(chunks, kernel_size):
+    '''
+    Get the flutuation of each chunk of a batch of (chunks, frames) or
+    (chunks, frames, channels) samples, around its median filter.
+    '''
+    # Perform a Median Filter on each chunk, all of them together. The samples of the
+    # channels are filtered interleaved, as the array of samples of an audio file.
+    audio_median = sliding_median(chunks.reshape(chunks.shape[0], -1), kernel_size).reshape(chunks.shape)
+
+    # Get the difference between the median signal and the original sound.
+    # The objective here is to extract only the flutuation of the signal,
+    # not the median value.
+    return chunks - audio_median
+
+
+def get_flutuation_std(chunks, kernel_size):
+    '''
+    Get the standard deviation of the flutuation of each chunk of a batch of
+    (chunks, frames) or (chunks, frames, channels) samples.
+    '''
+    audio_diff = get_flutuation(chunks, kernel_size)
+
+    # Get the standard deviation of the flutuation of the signal.
+    return np.std(audio_diff.reshape(chunks.shape[0], -1), axis=1)
+
+
+def get_flutuation_records(seconds, segment):
+    '''
+    Get the (segment, sub_init, std) records of the chunks of seconds of a
+    segment, given as (segment, path, duration, sample rate). The segment is
+    read once, and its whole chunks are filtered in batches.
+    '''
+    position, path, duration, sample_rate = segment
+
+    # Find the proportion of the median filter kernel related to the
+    # total size of the chunk (Seconds * Sample Rate).
+    chunk_size = int(seconds * sample_rate)
+    kernel_size = int(seconds * sample_rate/1000) + 1
+
+    # Split the audio file into chunks of seconds, straight from the (possibly virtual) segment.
+    sub_inits = np.arange(0, int(duration), seconds)
+    audio_array = read_wav_segment(path)
+
+    records = []
+    whole_chunks = min(sub_inits.shape[0], audio_array.shape[0] // chunk_size)
+    for batch_begin in range(0, whole_chunks, CHUNKS_PER_BATCH):
+        batch_end = min(batch_begin + CHUNKS_PER_BATCH, whole_chunks)
+        chunks = audio_array[batch_begin * chunk_size:batch_end * chunk_size]
+        chunks = chunks.reshape((batch_end - batch_begin, chunk_size) + audio_array.shape[1:])
+        records.extend(zip([position] * chunks.shape[0], sub_inits[batch_begin:batch_end], get_flutuation_std(chunks, kernel_size)))
+
+    # The chunks past the end of the audio are shorter, or empty.
+    for chunk in range(whole_chunks, sub_inits.shape[0]):
+        chunks = audio_array[chunk * chunk_size:(chunk + 1) * chunk_size][np.newaxis]
+        records.append((position, sub_inits[chunk], get_flutuation_std(chunks, kernel_size)[0]))
+
+    return records
+
+
+def flutuation_analysis(metadata, use_all_threads=USE_ALL_THREADS):
     columns = list(metadata.columns) + ['std', 'sub_init']
-    metadata_list = []
-
-    for idx, row in tqdm(metadata.iterrows(), total=metadata.shape[0]):
-        # Read the audio signal.
-        audio = AudioSegment.from_file(row.path, format="wav")
-    
-        # Find the proportion of the median filter kernel related to the
-        # total size of the chunk (Seconds * Sample Rate).
-        chunk_size = SECONDS * row.sample_rate
-        kernel_size = int(chunk_size/1000) + 1
-
-        duration = int(row.duration_sec)
-        row["duration_sec"] = float(SECONDS)
-        row_list = list(row)
-
-        # Split the audio file into chunks of SECONDS.
-        for i in range(0, duration, SECONDS):
-            # Get only the chunk of this file.
-            audio_array = audio[i*1000:(i+SECONDS)*1000].get_array_of_samples()
-
-            # Perform a Median Filter on the signal.
-            audio_median = ndimage.median_filter(audio_array, size=kernel_size)
-
-            # Get the difference between the median signal and the original sound.
-            # The objective here is to extract only the flutuation of the signal,
-            # not the median value.
-            audio_diff = audio_array - audio_median
-
-            # Get the standard deviation of the flutuation of the signal.
-            std_dev = np.std(audio_diff)
-
-            # Append on the Dataframe list.
-            metadata_list.append(row_list + [std_dev, i])
-
-    processed_metadata = pd.DataFrame(metadata_list, columns=columns)
-    return processed_metadata
-
-
-def main():
-    print("Starting Dataset Cleaning")
-
-    # Read the scenario metadata.
-    meta = pd.read_csv(METADATA)
-
+    segments = list(zip(range(metadata.shape[0]), metadata["path"], metadata["duration_sec"], metadata["sample_rate"]))
+
+    # Each worker reads and filters whole segments, and sends back only their records.
+    pool = Pool(get_num_of_threads(use_all_threads))
+    records = []
+    for segment_records in tqdm(pool.imap_unordered(partial(get_flutuation_records, SECONDS), segments), total=len(segments)):
+        records.extend(segment_records)
+    pool.close()
+    pool.join()
+
+    records = pd.DataFrame(records, columns=["segment", "sub_init", "std"]).sort_values(["segment", "sub_init"])
+
+    processed_metadata = metadata.iloc[records["segment"].to_numpy()].reset_index(drop=True)
+    processed_metadata["duration_sec"] = float(SECONDS)
+    processed_metadata["std"] = records["std"].to_numpy()
+    processed_metadata["sub_init"] = records["sub_init"].to_numpy()
+    return processed_metadata[columns]
+
+
+def get_cleaning_metadata(meta):
+    '''
+    Get the segments of the scenario metadata that take part in the cleaning:
+    the vessels, and as much background as the most extense vessel class.
+    '''
     # Get the duration of each class (excluding background and others).
     desired_classes = list(meta.label.unique())
     desired_classes.remove("other")
@@ -85,7 +135,16 @@ def main():
     # Background and Others are ignored in this analysis.
     meta_vessel = meta[meta.label.isin(["tug","tanker","passengership","cargo"])]
 
-    total_meta = pd.concat([meta_back, meta_vessel])
+    return pd.concat([meta_back, meta_vessel])
+
+
+def main():
+    print("Starting Dataset Cleaning")
+
+    # Read the scenario metadata.
+    meta = pd.read_csv(METADATA)
+
+    total_meta = get_cleaning_metadata(meta)
 
     final_meta_df = flutuation_analysis(total_meta)
 
@@ -1,4 +1,5 @@
 import os
+import sys
 
 import pandas as pd
 import matplotlib.ticker as ticker
@@ -6,9 +7,12 @@ import matplotlib.pyplot as plt
 import numpy as np
 
 from pydub import AudioSegment
-from scipy import signal
 from tqdm import tqdm
 
+# The sliding median lives with the pipeline modules.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from sliding_median import sliding_median
+
 INCLUSION_RADIUS = 2000
 EXCLUSION_RADIUS = 2000 + INCLUSION_RADIUS
 METADATA = f"/workspaces/underwater/dataset/07_classified_wav_files/inclusion_{INCLUSION_RADIUS}_exclusion_{EXCLUSION_RADIUS}/metadata/10_seconds/metadata_10s.csv"
@@ -33,7 +37,7 @@ for idx, row in tqdm(meta.iterrows(), total=meta.shape[0]):
 
     kernel_size = int(chunk_size/1000) + 1
     audio_array = audio.get_array_of_samples()
-    audio_median = signal.medfilt(audio_array, kernel_size=kernel_size)
+    audio_median = sliding_median(audio_array, kernel_size, mode="constant")
 
     audio_diff = audio_array - audio_median
     audio.export(os.path.join(ROOT_PATH, f"{idx}.wav"), format="wav")
@@ -0,0 +1,216 @@
+import os
+import sys
+from multiprocessing import Pool
+
+import pandas as pd
+import numpy as np
+
+from tqdm import tqdm
+
+# The audio segment reader lives with the pipeline modules.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils import get_num_of_threads, dump_data_frame_to_feather_file, read_data_frame_from_feather_file
+from wav_segments import read_wav_segment
+from dataset_cleaninig import CHUNKS_PER_BATCH, get_flutuation, get_cleaning_metadata
+
+# The median filter kernel is the one of the cleaning for chunks of KERNEL_SECONDS,
+# so the windows of KERNEL_SECONDS (or of multiples of it) get the same std as the cleaning.
+KERNEL_SECONDS = 10
+INCLUSION_RADIUS = 2000
+
+EXCLUSION_RADIUS = 2000 + INCLUSION_RADIUS
+ROOT_PATH = f"/workspaces/underwater/dataset/07_classified_wav_files/inclusion_{INCLUSION_RADIUS}_exclusion_{EXCLUSION_RADIUS}/metadata/complete"
+METADATA = f"{ROOT_PATH}/metadata.csv"
+FEATURE_CACHE_PATH = f"{ROOT_PATH}/feature_cache"
+
+# Index of the cached segments: their metadata, with the offset of their first second and their frame count.
+FEATURE_INDEX_FILE = "feature_index.feather"
+
+# Features of each second of audio, each one stored as a float32 .npy array of all of the seconds.
+FEATURES = ["flutuation_mean", "flutuation_std", "rms", "peak"]
+
+USE_ALL_THREADS = False
+
+
+def get_second_features(audio, flutuation):
+    '''
+    Get the features of each row of a batch of (seconds, samples) of audio,
+    and of its flutuation, as a (seconds, features) array.
+    '''
+    features = np.empty((audio.shape[0], len(FEATURES)))
+    features[:, 0] = np.mean(flutuation, axis=1, dtype=np.float64)
+    features[:, 1] = np.std(flutuation, axis=1, dtype=np.float64)
+    features[:, 2] = np.sqrt(np.mean(np.square(audio, dtype=np.float64), axis=1))
+    # The peak of the negative samples is taken from the minimum, as the absolute value of the lowest one overflows.
+    features[:, 3] = np.maximum(audio.max(axis=1).astype(np.float64), -audio.min(axis=1).astype(np.float64))
+
+    return features
+
+
+def get_chunk_features(chunk, flutuation, sample_rate):
+    '''
+    Get the features of each second of a chunk, the last of which may be partial.
+    '''
+    whole_seconds = chunk.shape[0] // sample_rate
+    features = [np.empty((0, len(FEATURES)))]
+    # Chunks shorter than a second have no whole seconds, which cannot be reshaped from an empty array.
+    if whole_seconds > 0:
+        features.append(
+            get_second_features(
+                chunk[:whole_seconds * sample_rate].reshape(whole_seconds, -1),
+                flutuation[:whole_seconds * sample_rate].reshape(whole_seconds, -1),
+            )
+        )
+    if chunk.shape[0] > whole_seconds * sample_rate:
+        features.append(
+            get_second_features(
+                chunk[whole_seconds * sample_rate:].reshape(1, -1),
+                flutuation[whole_seconds * sample_rate:].reshape(1, -1),
+            )
+        )
+
+    return np.concatenate(features)
+
+
+def get_segment_features(segment):
+    '''
+    Get the features of each second of a segment, given as (path, sample rate).
+    The segment is read once, and its chunks of KERNEL_SECONDS are filtered in
+    batches, as in the cleaning. Returns the features and the frame count.
+    '''
+    path, sample_rate = segment
+    sample_rate = int(sample_rate)
+
+    chunk_size = int(KERNEL_SECONDS * sample_rate)
+    kernel_size = int(KERNEL_SECONDS * sample_rate/1000) + 1
+
+    audio_array = read_wav_segment(path)
+
+    features = [np.empty((0, len(FEATURES)))]
+    whole_chunks = audio_array.shape[0] // chunk_size
+    for batch_begin in range(0, whole_chunks, CHUNKS_PER_BATCH):
+        batch_end = min(batch_begin + CHUNKS_PER_BATCH, whole_chunks)
+        chunks = audio_array[batch_begin * chunk_size:batch_end * chunk_size]
+        chunks = chunks.reshape((batch_end - batch_begin, chunk_size) + audio_array.shape[1:])
+        flutuation = get_flutuation(chunks, kernel_size)
+        features.append(
+            get_chunk_features(chunks.reshape((-1,) + audio_array.shape[1:]), flutuation.reshape((-1,) + audio_array.shape[1:]), sample_rate)
+        )
+
+    # The last chunk is shorter.
+    if audio_array.shape[0] > whole_chunks * chunk_size:
+        chunk = audio_array[whole_chunks * chunk_size:]
+        features.append(get_chunk_features(chunk, get_flutuation(chunk[np.newaxis], kernel_size)[0], sample_rate))
+
+    return np.concatenate(features), audio_array.shape[0]
+
+
+def build_feature_cache(metadata, cache_path, use_all_threads=USE_ALL_THREADS):
+    '''
+    Decode every segment of the metadata once, and store the features of each
+    of its seconds on the cache. Any window length is then an aggregation of
+    the cache, by get_window_features.
+    '''
+    os.makedirs(cache_path, exist_ok=True)
+    metadata = metadata.reset_index(drop=True)
+    segments = list(zip(metadata["path"], metadata["sample_rate"]))
+
+    # The workers send back only the features of their segments, which take 16 bytes per second.
+    pool = Pool(get_num_of_threads(use_all_threads))
+    features = []
+    frames = []
+    for segment_features, frame_count in tqdm(pool.imap(get_segment_features, segments), total=len(segments)):
+        features.append(segment_features)
+        frames.append(frame_count)
+    pool.close()
+    pool.join()
+
+    features = np.concatenate(features) if features else np.empty((0, len(FEATURES)))
+    for position, feature in enumerate(FEATURES):
+        np.save(os.path.join(cache_path, f"{feature}.npy"), features[:, position].astype(np.float32))
+
+    second_counts = -(-np.array(frames, dtype=np.int64) // metadata["sample_rate"].to_numpy().astype(np.int64))
+    feature_index = metadata.copy()
+    feature_index["offset"] = np.cumsum(np.r_[0, second_counts])[:-1]
+    feature_index["frames"] = np.array(frames, dtype=np.int64)
+    dump_data_frame_to_feather_file(os.path.join(cache_path, FEATURE_INDEX_FILE), feature_index)
+
+
+def load_feature_cache(cache_path):
+    '''
+    Load the index of the cache, and memory-map its features.
+    '''
+    feature_index = read_data_frame_from_feather_file(os.path.join(cache_path, FEATURE_INDEX_FILE), memory_map=False)
+    features = {feature: np.load(os.path.join(cache_path, f"{feature}.npy"), mmap_mode="r") for feature in FEATURES}
+
+    return feature_index, features
+
+
+def get_window_features(feature_cache, seconds):
+    '''
+    Get the metadata of the windows of seconds of the cached segments, as the
+    cleaning does, with the std of their flutuation and their rms and peak.
+    Windows past the end of the audio get NaN, as the empty chunks of the
+    cleaning. The seconds are weighted by their frame count.
+    '''
+    feature_index, features = feature_cache
+    sample_rates = feature_index["sample_rate"].to_numpy().astype(np.int64)
+    frames = feature_index["frames"].to_numpy()
+    offsets = feature_index["offset"].to_numpy()
+    second_counts = -(-frames // sample_rates)
+
+    # The frames of each cached second: all of them but the last one are whole.
+    second_frames = np.repeat(sample_rates, second_counts).astype(np.float64)
+    last_seconds = offsets + second_counts - 1
+    second_frames[last_seconds[second_counts > 0]] = (frames - (second_counts - 1) * sample_rates)[second_counts > 0]
+
+    # The windows of a segment start on each multiple of seconds before its duration.
+    window_counts = -(-np.floor(feature_index["duration_sec"].to_numpy()).astype(np.int64) // seconds)
+    segment = np.repeat(np.arange(feature_index.shape[0]), window_counts)
+    sub_init = (np.arange(segment.shape[0]) - np.repeat(np.cumsum(window_counts) - window_counts, window_counts)) * seconds
+    begins = offsets[segment] + np.minimum(sub_init, second_counts[segment])
+    ends = offsets[segment] + np.minimum(sub_init + seconds, second_counts[segment])
+
+    # The sums over the windows are differences of the cumulative sums over the seconds.
+    mean = features["flutuation_mean"].astype(np.float64)
+    std = features["flutuation_std"].astype(np.float64)
+    rms = features["rms"].astype(np.float64)
+    sums = np.zeros((second_frames.shape[0] + 1, 4))
+    np.cumsum(np.stack([second_frames, second_frames * mean, second_frames * (std ** 2 + mean ** 2), second_frames * rms ** 2], axis=1), axis=0, out=sums[1:])
+    window_sums = sums[ends] - sums[begins]
+    is_empty = ends == begins
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        window_mean = window_sums[:, 1] / window_sums[:, 0]
+        window_std = np.sqrt(np.maximum(window_sums[:, 2] / window_sums[:, 0] - window_mean ** 2, 0))
+        window_rms = np.sqrt(window_sums[:, 3] / window_sums[:, 0])
+
+    # The maximum over each window is reduced from its begin to its end; a last zero keeps the ends in range.
+    peak = np.r_[features["peak"].astype(np.float64), 0]
+    window_peak = np.maximum.reduceat(peak, np.ravel(np.stack([begins, ends], axis=1)))[::2] if segment.shape[0] else np.empty(0)
+
+    window_std[is_empty] = np.nan
+    window_rms[is_empty] = np.nan
+    window_peak[is_empty] = np.nan
+
+    columns = [column for column in feature_index.columns if column not in ["offset", "frames"]]
+    window_metadata = feature_index.iloc[segment][columns].reset_index(drop=True)
+    window_metadata["duration_sec"] = float(seconds)
+    window_metadata["std"] = window_std
+    window_metadata["rms"] = window_rms
+    window_metadata["peak"] = window_peak
+    window_metadata["sub_init"] = sub_init
+
+    return window_metadata[columns + ["std", "rms", "peak", "sub_init"]]
+
+
+def main():
+    print("Starting Feature Cache")
+
+    # Read the scenario metadata.
+    meta = pd.read_csv(METADATA)
+
+    build_feature_cache(get_cleaning_metadata(meta), FEATURE_CACHE_PATH)
+
+if __name__ == "__main__":
+    main()
@@ -6,55 +6,101 @@ import numpy as np
 
 ALPHA = 0
 
+# Alphas of the threshold sweep, which only needs the statistic of the windows.
+SWEEP_ALPHAS = np.arange(-2, 2.25, 0.25)
+
+# Statistic of the windows that is thresholded: the std of their flutuation, their rms or their peak.
+# Only the std is in the cleaned metadata; all of them are in the feature cache.
+STATISTIC = "std"
+
 SECONDS = 10
 INCLUSION_RADIUS = 2000
 
 EXCLUSION_RADIUS = 2000 + INCLUSION_RADIUS
 ROOT_PATH = f"/workspaces/underwater/dataset/07_classified_wav_files/inclusion_{INCLUSION_RADIUS}_exclusion_{EXCLUSION_RADIUS}/metadata/complete"
 
+# Aggregate the windows of SECONDS from the feature cache of dataset_feature_cache,
+# instead of reading the metadata of dataset_cleaninig, so no audio is decoded.
+USE_FEATURE_CACHE = False
+FEATURE_CACHE_PATH = f"{ROOT_PATH}/feature_cache"
+
+def get_threshold(background_values, alphas):
+    '''
+    Get the threshold of each alpha over the statistic of the background windows.
+    The windows without audio (NaN) are left out.
+    '''
+    back_mean = np.nanmean(background_values, axis=0)
+    back_std = np.nanstd(background_values, axis=0)
+
+    return back_mean + np.asarray(alphas)*back_std
+
+
+def threshold_sweep(metadata, alphas, statistic=STATISTIC):
+    '''
+    Get the threshold of each alpha and the vessel windows it keeps. The vessel
+    values are sorted once, so each alpha takes a binary search.
+    '''
+    vessel_values = metadata.loc[metadata["label"] != "background", statistic].to_numpy(dtype=np.float64)
+    background_values = metadata.loc[metadata["label"] == "background", statistic].to_numpy(dtype=np.float64)
+
+    # The windows without audio (NaN) are kept by no threshold, as in the filter.
+    vessel_values = np.sort(vessel_values[~np.isnan(vessel_values)])
+    thresholds = get_threshold(background_values, alphas)
+    valid_vessels = vessel_values.shape[0] - np.searchsorted(vessel_values, thresholds, side="left")
+
+    return pd.DataFrame({
+        "alpha": alphas,
+        "threshold": thresholds,
+        "valid_vessels": valid_vessels,
+        "valid_fraction": valid_vessels / max(vessel_values.shape[0], 1),
+    })
+
+
 def main():
     # Read the entire metadata with Standard Deviation info.
-    cleaned_meta=pd.read_csv(os.path.join(ROOT_PATH, f"cleaned_optm_metadata_{SECONDS}s.csv"))
+    if USE_FEATURE_CACHE:
+        # The cache reads the pipeline modules, which the metadata CSV does not need.
+        from dataset_feature_cache import load_feature_cache, get_window_features
+
+        cleaned_meta = get_window_features(load_feature_cache(FEATURE_CACHE_PATH), SECONDS)
+    else:
+        cleaned_meta=pd.read_csv(os.path.join(ROOT_PATH, f"cleaned_optm_metadata_{SECONDS}s.csv"))
+
+    # Show how many vessel windows each alpha would keep.
+    print(threshold_sweep(cleaned_meta, SWEEP_ALPHAS, STATISTIC).to_string(index=False))
 
     # Read the vessel and the background splits of the data.
     vessel_metadata = cleaned_meta[cleaned_meta["label"] != "background"]
     background_metadata = cleaned_meta[cleaned_meta["label"]=="background"]
 
-    # Get the mean and standard deviation of the array of background flutuations.
-    back_std = list(background_metadata["std"])
-    back_std_array = np.array(back_std)
-
-    back_mean = np.mean(back_std_array, axis=0)
-    back_std = np.std(back_std_array, axis=0)
-
     # Considering the normal curve distribution, we stablish the threshold to get all the
     # inferior portion of the curve (50%) plus the ALPHA*sigma of the superior part (X%),
     # totalising (50+X)% of the data. Every entry that is located on this region is considered
     # as background sound and is removed from the vessel entry.
-    threshold = back_mean + ALPHA*back_std
+    threshold = get_threshold(np.array(list(background_metadata[STATISTIC])), ALPHA)
 
     # Separate the vessel info according the threshold.
-    valid_vessels = vessel_metadata[vessel_metadata["std"] >= threshold]
-    invalid_vessels = vessel_metadata[vessel_metadata["std"] < threshold]
+    valid_vessels = vessel_metadata[vessel_metadata[STATISTIC] >= threshold]
+    invalid_vessels = vessel_metadata[vessel_metadata[STATISTIC] < threshold]
 
     # Save the valid metadata.
     total_metadata = pd.concat([valid_vessels, background_metadata])
     total_metadata.to_csv(os.path.join(ROOT_PATH, f"filtered_metadata_{SECONDS}s.csv"), index=False)
 
     # Plot the result on a bar plot graph.
-    invalid_vessels = invalid_vessels.sort_values(by=['std'])
-    std_dev_list_outlier = list(invalid_vessels["std"])
+    invalid_vessels = invalid_vessels.sort_values(by=[STATISTIC])
+    std_dev_list_outlier = list(invalid_vessels[STATISTIC])
     outlier_num = len(std_dev_list_outlier)
     outlier_list = list(range(0,outlier_num))
 
-    valid_vessels = valid_vessels.sort_values(by=['std'])
-    std_dev_list_not_outlier = list(valid_vessels["std"])
+    valid_vessels = valid_vessels.sort_values(by=[STATISTIC])
+    std_dev_list_not_outlier = list(valid_vessels[STATISTIC])
     not_outlier_num = len(std_dev_list_not_outlier)
     not_outlier_list = list(range(outlier_num,outlier_num+not_outlier_num))
 
     plt.figure(figsize=[30, 6])
     plt.xlabel("Audio Index")
-    plt.ylabel("Standard Deviation")
+    plt.ylabel({"std": "Standard Deviation", "rms": "RMS", "peak": "Peak"}[STATISTIC])
     plt.bar(outlier_list, std_dev_list_outlier, color = 'red')
     plt.bar(not_outlier_list, std_dev_list_not_outlier, color = 'blue')
     plt.savefig(os.path.join(ROOT_PATH, "filtered_plot.svg"))
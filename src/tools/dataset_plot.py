@@ -1,12 +1,16 @@
 import folium
 import os
+import sys
 
 import numpy as np
 import pandas as pd
-import pyarrow.feather as feather
 
 from tqdm import tqdm
 
+# The interval AIS data reader lives with the pipeline modules.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils import read_interval_ais_data
+
 INCLUSION_RADIUS = 2000
 EXCLUSION_RADIUS = 2000 + INCLUSION_RADIUS
 SCENARIO_ROOT_PATH = f"/workspaces/underwater/dataset/07_classified_wav_files/inclusion_{INCLUSION_RADIUS}_exclusion_{EXCLUSION_RADIUS}"
@@ -27,9 +31,6 @@ class map_colors:
     inclusion_vessel = "#bb33ff"
     exclusion_vessel = "#ffaa33"
 
-def read_data_frame_from_feather_file(_file):
-    return feather.read_feather(_file)
-
 def gen_hex_colors(num_of_colors):
     color_max = 16777215
     step = int(16777215/num_of_colors)
@@ -120,8 +121,9 @@ if __name__ == "__main__":
         end_time = row["end"].replace("-","").replace(":","")
         wav_file = row["wav_file"]
 
-        interval_file_name = "_".join([begin_time, end_time, "interval_data.feather"])
-        interval_file = read_data_frame_from_feather_file(os.path.join(SCENARIO_AIS_DIR, interval_file_name))
+        interval_file = read_interval_ais_data(
+            SCENARIO_AIS_DIR, "_".join([begin_time, end_time]), columns=["x", "y", "mmsi"]
+        )
 
         map_file_name = f"{wav_file}.html"
         plot_map(
@@ -0,0 +1,107 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+from pydub.utils import mediainfo
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from generate_metadata import generate_full_metadata
+from wav_segments import SEGMENT_MANIFEST_FILE, get_wav_segments_info
+
+INCLUSION_RADIUS = 4000
+EXCLUSION_RADIUS = 2000 + INCLUSION_RADIUS
+USE_CTD = True
+
+ROOT_PATH = f"/workspaces/underwater/dataset/07_classified_wav_files/inclusion_{INCLUSION_RADIUS}_exclusion_{EXCLUSION_RADIUS}"
+INTERVAL_AIS_DIR = "/workspaces/underwater/dataset/06b_interval_ais_data"
+CLEAN_CTD_DIR = "/workspaces/underwater/dataset/09_cleaned_ctd_files"
+
+
+def get_segment_file_names(segment_directory):
+    intervals = pd.read_csv(os.path.join(segment_directory, "intervals.csv"), dtype={"wav_file": str})
+    return list(intervals["wav_file"] + ".wav")
+
+
+def benchmark_mediainfo(segment_directory, file_names):
+    # How step 10 read the audio info before: one ffprobe process per segment.
+    begin = time.perf_counter()
+    info = [mediainfo(os.path.join(segment_directory, file_name)) for file_name in file_names]
+    elapsed = time.perf_counter() - begin
+
+    segments_info = pd.DataFrame(
+        {
+            "sample_rate": [int(segment_info["sample_rate"]) for segment_info in info],
+            "duration": [float(segment_info["duration"]) for segment_info in info],
+        },
+        index=file_names,
+    )
+
+    return elapsed, segments_info
+
+
+def benchmark_wav_headers(segment_directory, file_names):
+    begin = time.perf_counter()
+    segments_info = get_wav_segments_info(segment_directory, file_names)
+    elapsed = time.perf_counter() - begin
+
+    return elapsed, segments_info
+
+
+def benchmark_step_10(root_path):
+    # The metadata is written to a temporary directory, so the one of the dataset is kept.
+    output_path = tempfile.mkdtemp()
+    for segment_directory in ["vessel", "background"]:
+        os.symlink(os.path.join(root_path, segment_directory), os.path.join(output_path, segment_directory))
+
+    begin = time.perf_counter()
+    generate_full_metadata(output_path, CLEAN_CTD_DIR, INTERVAL_AIS_DIR, INCLUSION_RADIUS, use_ctd=USE_CTD)
+    elapsed = time.perf_counter() - begin
+
+    shutil.rmtree(output_path)
+
+    return elapsed
+
+
+def main():
+    mediainfo_time = 0
+    wav_headers_time = 0
+    for segment_directory in ["vessel", "background"]:
+        segment_directory = os.path.join(ROOT_PATH, segment_directory)
+        file_names = get_segment_file_names(segment_directory)
+
+        # The first call also refreshes the header catalog, as step 7 does after exporting.
+        refresh_time, _ = benchmark_wav_headers(segment_directory, file_names)
+        elapsed, headers_info = benchmark_wav_headers(segment_directory, file_names)
+        wav_headers_time += elapsed
+        print(f"{segment_directory}: {len(file_names)} segments")
+        print(f"  WAV headers: {elapsed:.3f} s ({refresh_time:.3f} s with the catalog refresh)")
+
+        if os.path.exists(os.path.join(segment_directory, SEGMENT_MANIFEST_FILE)):
+            print("  mediainfo: skipped, the segments are virtual")
+            continue
+
+        elapsed, mediainfo_info = benchmark_mediainfo(segment_directory, file_names)
+        mediainfo_time += elapsed
+        print(f"  mediainfo: {elapsed:.3f} s")
+
+        # Both must describe the same audio, up to the rounding of the ffprobe durations.
+        duration_difference = np.abs(mediainfo_info["duration"] - headers_info["duration"]).max()
+        same_sample_rates = (mediainfo_info["sample_rate"] == headers_info["sample_rate"]).all()
+        print(f"  Largest duration difference: {duration_difference:.6f} s, same sample rates: {same_sample_rates}")
+
+    step_10_time = benchmark_step_10(ROOT_PATH)
+    print(f"Step 10 with the WAV headers: {step_10_time:.3f} s")
+    if mediainfo_time:
+        print(f"Step 10 with mediainfo (estimated): {step_10_time - wav_headers_time + mediainfo_time:.3f} s")
+
+
+if __name__ == "__main__":
+    if not os.path.exists(ROOT_PATH):
+        print(f"{ROOT_PATH} does not exists! Finishing execution.")
+        exit()
+    main()
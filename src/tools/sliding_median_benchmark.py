@@ -0,0 +1,101 @@
+import os
+import sys
+import time
+import warnings
+
+import numpy as np
+from scipy import ndimage, signal
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import sliding_median
+from sliding_median import get_window_medians
+
+SAMPLE_RATE = 64000
+SECONDS = 10
+NUMBER_OF_CHUNKS = 6
+NUMBER_OF_CHECKS = 500
+RANDOM_SEED = 42
+
+# Kernel of the fluctuation analysis of the dataset tools.
+KERNEL_SIZE = int(SECONDS * SAMPLE_RATE/1000) + 1
+
+
+def get_audio_chunks(random_state):
+    # Noise over a slow tone, as int16 samples, so the kernel has both ties and trends.
+    frames = np.arange(SECONDS * SAMPLE_RATE)
+    tone = 8000 * np.sin(2 * np.pi * 50 * frames / SAMPLE_RATE)
+    noise = random_state.normal(0, 2000, (NUMBER_OF_CHUNKS, frames.shape[0]))
+    return np.clip(tone + noise, -32768, 32767).astype(np.int16)
+
+
+def check_equivalence(random_state):
+    '''
+    Compare the sliding median with both backends against the scipy filters,
+    on random batches of small signals, with many equal samples.
+    '''
+    fast_rank_filter = sliding_median.SCIPY_FAST_RANK_FILTER
+    mismatches = 0
+    for _ in range(NUMBER_OF_CHECKS):
+        kernel_size = random_state.randint(1, 60)
+        length = random_state.randint(1, 300)
+        maximum = random_state.choice([2, 10, 32767])
+        samples = random_state.randint(-maximum, maximum, (random_state.randint(1, 5), length)).astype(np.int16)
+        mode = random_state.choice(list(sliding_median.PAD_MODES))
+
+        expected = np.stack([ndimage.median_filter(row, size=kernel_size, mode=mode) for row in samples])
+        for sliding_median.SCIPY_FAST_RANK_FILTER in [True, False]:
+            mismatches += not np.array_equal(sliding_median.sliding_median(samples, kernel_size, mode=mode), expected)
+
+        # The padding of medfilt is the constant mode, and it only takes odd kernels.
+        if kernel_size % 2:
+            with warnings.catch_warnings():
+                # medfilt warns about kernels longer than the signal.
+                warnings.simplefilter("ignore", UserWarning)
+                expected = np.stack([signal.medfilt(row, kernel_size=kernel_size) for row in samples])
+            mismatches += not np.array_equal(sliding_median.sliding_median(samples, kernel_size, mode="constant"), expected)
+
+    sliding_median.SCIPY_FAST_RANK_FILTER = fast_rank_filter
+
+    return mismatches
+
+
+def benchmark(name, function, chunks):
+    begin = time.perf_counter()
+    medians = function(chunks)
+    elapsed = time.perf_counter() - begin
+    print(f"  {name}: {elapsed / chunks.shape[0]:.3f} s per chunk")
+
+    return medians
+
+
+def main():
+    random_state = np.random.RandomState(RANDOM_SEED)
+
+    mismatches = check_equivalence(random_state)
+    print(f"Equivalence checks: {NUMBER_OF_CHECKS} batches, {mismatches} mismatches")
+
+    chunks = get_audio_chunks(random_state)
+    padding = KERNEL_SIZE // 2
+    print(f"{NUMBER_OF_CHUNKS} chunks of {SECONDS} s at {SAMPLE_RATE} Hz, kernel of {KERNEL_SIZE} samples")
+    print(f"  scipy 1-D rank filter of O(n log k): {sliding_median.SCIPY_FAST_RANK_FILTER}")
+
+    expected = benchmark("ndimage.median_filter, one chunk at a time", lambda x: np.stack([ndimage.median_filter(row, size=KERNEL_SIZE) for row in x]), chunks)
+    medfilt = benchmark("signal.medfilt, one chunk at a time", lambda x: np.stack([signal.medfilt(row, kernel_size=KERNEL_SIZE) for row in x]), chunks)
+    batch = benchmark("ndimage.median_filter, one 2-D batch (one chunk)", lambda x: ndimage.median_filter(x, size=(1, KERNEL_SIZE)), chunks[:1])
+    median = benchmark("sliding_median, one batch", lambda x: sliding_median.sliding_median(x, KERNEL_SIZE), chunks)
+    sorted_blocks = benchmark(
+        "sliding_median, sorted blocks of one batch",
+        lambda x: get_window_medians(np.pad(x, ((0, 0), (padding, padding)), mode="symmetric").ravel(), KERNEL_SIZE),
+        chunks,
+    )
+
+    # The windows across two chunks are dropped, as in sliding_median.
+    window_starts = np.arange(chunks.shape[0])[:, np.newaxis] * (chunks.shape[1] + 2 * padding) + np.arange(chunks.shape[1])
+    print(f"Same medians as ndimage: {np.array_equal(median, expected)} (sliding_median), "
+          f"{np.array_equal(sorted_blocks[window_starts], expected)} (sorted blocks), {np.array_equal(batch, expected[:1])} (2-D batch)")
+    print(f"Same medians as medfilt: {np.array_equal(sliding_median.sliding_median(chunks, KERNEL_SIZE, mode='constant'), medfilt)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+import os
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+from utils import (
+    get_num_of_threads,
+    get_hydrophone_deployments,
+    pandas_timestamp_to_zulu_format,
+    zulu_string_to_datetime,
+    get_feather_row_range,
+    get_interpolated_ais_data_row_range,
+    read_table_from_feather_file,
+    read_data_frame_from_feather_file,
+    read_interpolated_ais_data,
+    dump_data_frame_to_feather_file,
+)
+
+
+TRACK_INDEX_SUFFIX = "track_index.feather"
+
+
+def get_track_index_file(track_index_directory, device, deployment_begin, deployment_end):
+    return os.path.join(
+        track_index_directory,
+        "_".join(
+            [
+                device,
+                pandas_timestamp_to_zulu_format(deployment_begin),
+                pandas_timestamp_to_zulu_format(deployment_end),
+                TRACK_INDEX_SUFFIX,
+            ]
+        ),
+    )
+
+
+def get_track_index(deployment_files):
+    '''
+    Reduce the raw and interpolated AIS messages of a deployment to one row per
+    1-minute bucket (left labelled) and MMSI, with the closest distance of the
+    vessel to the hydrophone and the number of messages.
+    The rows are sorted by minute and MMSI, so a time window is a row range.
+    '''
+    tables = [
+        read_table_from_feather_file(deployment_file, columns=["pd_timestamp", "mmsi", "distance_to_hydrophone"])
+        for deployment_file in deployment_files
+    ]
+
+    minutes = np.concatenate(
+        [table.column("pd_timestamp").to_numpy().astype("datetime64[m]").astype(np.int64) for table in tables]
+    )
+    mmsi = np.concatenate([table.column("mmsi").to_numpy().astype(np.int64) for table in tables])
+    distances = np.concatenate([table.column("distance_to_hydrophone").to_numpy() for table in tables])
+
+    order = np.lexsort((mmsi, minutes))
+    minutes = minutes[order]
+    mmsi = mmsi[order]
+    distances = distances[order]
+
+    group_starts = np.flatnonzero(
+        np.r_[True, (minutes[1:] != minutes[:-1]) | (mmsi[1:] != mmsi[:-1])]
+    )[:minutes.shape[0]]
+
+    minimum_distance = np.full(group_starts.shape[0], np.inf)
+    if group_starts.shape[0]:
+        minimum_distance = np.minimum.reduceat(distances, group_starts)
+
+    return pd.DataFrame(
+        {
+            "minute": pd.DatetimeIndex(minutes[group_starts].astype("datetime64[m]")).astype("datetime64[ns]"),
+            "mmsi": mmsi[group_starts],
+            "minimum_distance": minimum_distance.astype(np.float32),
+            "messages": np.diff(np.r_[group_starts, minutes.shape[0]]).astype(np.int32),
+        }
+    )
+
+
+def build_deployment_track_index(track_index_file, deployment_files):
+    # The index is only rebuilt when it is older than the deployment files it was built from.
+    if os.path.exists(track_index_file) and os.path.getmtime(track_index_file) >= max(
+        os.path.getmtime(deployment_file) for deployment_file in deployment_files
+    ):
+        return track_index_file, False
+
+    dump_data_frame_to_feather_file(
+        track_index_file,
+        get_track_index(deployment_files),
+        compression="uncompressed",
+    )
+
+    return track_index_file, True
+
+
+def build_track_index(
+    deployment_directory,
+    combined_deployment_directory,
+    track_index_directory,
+    use_all_threads=False,
+):
+    '''
+    Build the vessel track index of every deployment from its combined AIS
+    files. It allows querying which vessels were within any radius of the
+    hydrophone at any time without running the steps 3 to 5 again.
+    '''
+
+    # Threading differences between systems.
+    number_of_threads = get_num_of_threads(use_all_threads)
+
+    # Read in the hydrophone deployments as we will treat each deployment as an individual dataset.
+    hydrophone_deployments = get_hydrophone_deployments(deployment_directory)
+
+    deployments = []
+    for device in hydrophone_deployments.keys():
+        for deployment in hydrophone_deployments[device].itertuples(index=False):
+
+            deployment_begin = pd.Timestamp(deployment.begin).normalize()
+            deployment_end = pd.Timestamp(deployment.end).normalize() + pd.DateOffset(
+                days=1
+            )
+
+            deployment_files = tuple(
+                os.path.join(
+                    combined_deployment_directory,
+                    "_".join(
+                        [
+                            device,
+                            pandas_timestamp_to_zulu_format(deployment_begin),
+                            pandas_timestamp_to_zulu_format(deployment_end),
+                            file_suffix,
+                        ]
+                    ),
+                )
+                for file_suffix in ["clean_ais_data.feather", "clean_interpolated_delta_ais_data.feather"]
+            )
+
+            if not all(os.path.exists(deployment_file) for deployment_file in deployment_files):
+                continue
+
+            deployments.append(
+                (
+                    get_track_index_file(track_index_directory, device, deployment_begin, deployment_end),
+                    deployment_files,
+                )
+            )
+
+    print(f"Indexing the vessel tracks of {len(deployments)} deployments...")
+
+    threading_pool = multiprocessing.Pool(processes=max(min(number_of_threads, len(deployments)), 1))
+    outputs = threading_pool.starmap(build_deployment_track_index, deployments, chunksize=1)
+    threading_pool.close()
+    threading_pool.join()
+
+    print(f"  {sum(is_built for _, is_built in outputs)} track indexes were built, the others were up to date.")
+
+
+def get_track_index_files(track_index_directory, device, begin, end):
+    '''
+    Find the track index files of a device whose deployment overlaps [begin, end].
+    '''
+    begin = pd.Timestamp(begin).tz_localize(None) if pd.Timestamp(begin).tz else pd.Timestamp(begin)
+    end = pd.Timestamp(end).tz_localize(None) if pd.Timestamp(end).tz else pd.Timestamp(end)
+
+    track_index_files = []
+    for file in sorted(os.listdir(track_index_directory)):
+        if not file.endswith(TRACK_INDEX_SUFFIX):
+            continue
+
+        file_device, deployment_begin, deployment_end = file.split("_")[:3]
+        if file_device != device:
+            continue
+
+        if zulu_string_to_datetime(deployment_begin) <= end and zulu_string_to_datetime(deployment_end) >= begin:
+            track_index_files.append(os.path.join(track_index_directory, file))
+
+    return track_index_files
+
+
+def read_track_index_window(track_index_file, begin, end):
+    '''
+    Read the rows of a track index whose minute bucket overlaps [begin, end].
+    '''
+    row_range = get_feather_row_range(
+        track_index_file,
+        pd.Timestamp(begin).floor("1min"),
+        pd.Timestamp(end),
+        time_column="minute",
+    )
+
+    return read_data_frame_from_feather_file(track_index_file, row_range=row_range)
+
+
+def query_track_index(track_index_directory, device, begin, end, radius, minimum_radius=0):
+    '''
+    Find the vessels that were between minimum_radius and radius metres from
+    the hydrophone of a device between begin and end. Returns one row per
+    vessel and interval of consecutive minutes, with its closest distance.
+    '''
+    columns = ["mmsi", "begin", "end", "minimum_distance", "messages"]
+
+    data_frames = [
+        read_track_index_window(track_index_file, begin, end)
+        for track_index_file in get_track_index_files(track_index_directory, device, begin, end)
+    ]
+    if not data_frames:
+        return pd.DataFrame(columns=columns)
+
+    data_frame = pd.concat(data_frames, ignore_index=True)
+    data_frame = data_frame[
+        (data_frame["minimum_distance"] <= radius) & (data_frame["minimum_distance"] >= minimum_radius)
+    ]
+    data_frame = data_frame.sort_values(by=["mmsi", "minute"], kind="stable", ignore_index=True)
+
+    # Consecutive minutes of the same vessel are merged into one interval.
+    minutes = data_frame["minute"].to_numpy().astype("datetime64[m]").astype(np.int64)
+    mmsi = data_frame["mmsi"].to_numpy()
+    interval_ids = np.cumsum(np.r_[True, (mmsi[1:] != mmsi[:-1]) | (np.diff(minutes) != 1)])[:minutes.shape[0]]
+
+    intervals = data_frame.groupby(interval_ids).agg(
+        mmsi=("mmsi", "first"),
+        begin=("minute", "first"),
+        end=("minute", "last"),
+        minimum_distance=("minimum_distance", "min"),
+        messages=("messages", "sum"),
+    )
+    intervals["end"] = intervals["end"] + pd.Timedelta(minutes=1)
+
+    return intervals.sort_values(by=["begin", "mmsi"], ignore_index=True)[columns]
+
+
+def query_track_rows(
+    track_index_directory,
+    combined_deployment_directory,
+    device,
+    begin,
+    end,
+    radius,
+    minimum_radius=0,
+    columns=None,
+):
+    '''
+    Read the raw and interpolated AIS rows of the vessels that were between
+    minimum_radius and radius metres from the hydrophone of a device between
+    begin and end. The AIS files are only read for the deployments with a
+    match in the track index.
+    '''
+    data_frames = []
+    for track_index_file in get_track_index_files(track_index_directory, device, begin, end):
+        track_index = read_track_index_window(track_index_file, begin, end)
+        if not (
+            (track_index["minimum_distance"] <= radius) & (track_index["minimum_distance"] >= minimum_radius)
+        ).any():
+            continue
+
+        deployment_prefix = os.path.basename(track_index_file)[:-len(TRACK_INDEX_SUFFIX)]
+        deployment_files = [
+            os.path.join(combined_deployment_directory, deployment_prefix + file_suffix)
+            for file_suffix in ["clean_ais_data.feather", "clean_interpolated_delta_ais_data.feather"]
+        ]
+
+        read_columns = columns
+        if columns is not None and "distance_to_hydrophone" not in columns:
+            read_columns = columns + ["distance_to_hydrophone"]
+
+        row_range = get_interpolated_ais_data_row_range(*deployment_files, begin, end)
+        data_frame = read_interpolated_ais_data(*deployment_files, columns=read_columns, row_range=row_range)
+
+        data_frame = data_frame[
+            (data_frame["distance_to_hydrophone"] <= radius)
+            & (data_frame["distance_to_hydrophone"] >= minimum_radius)
+        ]
+        if columns is not None:
+            data_frame = data_frame[columns]
+
+        data_frames.append(data_frame)
+
+    if not data_frames:
+        return pd.DataFrame(columns=columns)
+
+    return pd.concat(data_frames, ignore_index=True)
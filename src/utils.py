@@ -1,7 +1,10 @@
 import os
 import ujson
+import struct
+import functools
 import multiprocessing
 
+import numpy as np
 import pandas as pd
 import pyarrow.feather as feather
 
@@ -51,19 +54,382 @@ def read_messages_from_json_file(_file):
         return ujson.load(input_file)
 
 
-def dump_data_frame_to_feather_file(_file, _data_frame):
-    feather.write_feather(_data_frame, _file)
+def dump_data_frame_to_feather_file(_file, _data_frame, compression=None):
+    # Without a compression, pyarrow writes LZ4 compressed files. Pass "uncompressed"
+    # for files that are read memory-mapped, which then need no decoding.
+    if compression is None:
+        feather.write_feather(_data_frame, _file)
+    else:
+        feather.write_feather(_data_frame, _file, compression=compression)
 
 
-def read_data_frame_from_feather_file(_file):
-    return feather.read_feather(_file)
+def _get_file_cache_key(_file):
+    file_stat = os.stat(_file)
+    return os.path.abspath(_file), file_stat.st_mtime_ns, file_stat.st_size
+
+
+@functools.lru_cache(maxsize=16)
+def _read_cached_feather_table(_file, _modification_time, _file_size):
+    # The modification time and size are only part of the cache key, so a
+    # rewritten file is never served from a stale mapping.
+    return feather.read_table(_file, memory_map=True)
+
+
+def read_table_from_feather_file(_file, columns=None, memory_map=True):
+    '''
+    Read a feather file as a pyarrow Table. When memory mapping is enabled the
+    table is backed by the file pages and kept in a small cache, so reading
+    the same file again only costs a stat call.
+    '''
+    if not memory_map:
+        return feather.read_table(_file, columns=columns, memory_map=False)
+
+    table = _read_cached_feather_table(*_get_file_cache_key(_file))
+
+    if columns is not None:
+        table = table.select(columns)
+
+    return table
+
+
+def read_data_frame_from_feather_file(_file, columns=None, row_range=None, memory_map=True):
+    '''
+    Read a feather file into a pandas DataFrame, optionally keeping only some
+    columns and the rows in the half-open interval row_range=(start, stop).
+    '''
+    table = read_table_from_feather_file(_file, columns=columns, memory_map=memory_map)
+
+    if row_range is not None:
+        start, stop = row_range
+        table = table.slice(start, max(stop - start, 0))
+
+    return table.to_pandas()
+
+
+@functools.lru_cache(maxsize=16)
+def _read_cached_feather_column(_file, _modification_time, _file_size, _column):
+    return read_table_from_feather_file(_file, columns=[_column]).column(0).to_numpy()
+
+
+def get_feather_row_ranges(_file, begins, ends, time_column="pd_timestamp"):
+    '''
+    Find, for each pair of begins and ends, the half-open row range of a
+    time-sorted feather file whose time_column lies within [begin, end].
+    '''
+    timestamps = _read_cached_feather_column(*_get_file_cache_key(_file), time_column)
+
+    starts = np.searchsorted(timestamps, pd.DatetimeIndex(begins).tz_localize(None).values, side="left")
+    stops = np.searchsorted(timestamps, pd.DatetimeIndex(ends).tz_localize(None).values, side="right")
+
+    return starts, stops
+
+
+def get_feather_row_range(_file, begin, end, time_column="pd_timestamp"):
+    '''
+    Find the half-open row range of a time-sorted feather file whose
+    time_column lies within [begin, end].
+    '''
+    starts, stops = get_feather_row_ranges(_file, [begin], [end], time_column=time_column)
+
+    return int(starts[0]), int(stops[0])
+
+
+def read_data_frame_from_feather_time_range(_file, begin, end, columns=None, time_column="pd_timestamp"):
+    '''
+    Read only the rows of a time-sorted feather file between begin and end.
+    '''
+    row_range = get_feather_row_range(_file, begin, end, time_column=time_column)
+
+    return read_data_frame_from_feather_file(_file, columns=columns, row_range=row_range)
+
+
+@functools.lru_cache(maxsize=4)
+def _get_cached_interpolated_ais_data_order(_raw_key, _delta_key, _time_column):
+    raw_timestamps = _read_cached_feather_column(*_raw_key, _time_column)
+    delta_timestamps = _read_cached_feather_column(*_delta_key, _time_column)
+
+    # A stable sort keeps the raw messages ahead of the interpolated ones with the same timestamp.
+    timestamps = np.concatenate([raw_timestamps, delta_timestamps])
+    order = np.argsort(timestamps, kind="stable")
+
+    return timestamps[order], order
+
+
+def get_interpolated_ais_data_order(_raw_file, _delta_file, time_column="pd_timestamp"):
+    '''
+    Get the time-ordered view of the raw AIS file merged with its interpolated
+    delta file. Returns the sorted timestamps and, for each position of the
+    merged view, the row index into the raw rows followed by the delta rows.
+    '''
+    return _get_cached_interpolated_ais_data_order(
+        _get_file_cache_key(_raw_file), _get_file_cache_key(_delta_file), time_column
+    )
+
+
+def get_interpolated_ais_data_row_range(_raw_file, _delta_file, begin, end, time_column="pd_timestamp"):
+    '''
+    Same as get_feather_row_range, but over the merged raw and interpolated view.
+    '''
+    timestamps, _ = get_interpolated_ais_data_order(_raw_file, _delta_file, time_column=time_column)
+
+    start = np.searchsorted(timestamps, pd.Timestamp(begin).tz_localize(None).to_datetime64(), side="left")
+    stop = np.searchsorted(timestamps, pd.Timestamp(end).tz_localize(None).to_datetime64(), side="right")
+
+    return int(start), int(stop)
+
+
+def read_interpolated_ais_data(_raw_file, _delta_file, columns=None, row_range=None, time_column="pd_timestamp"):
+    '''
+    Read the raw AIS data merged with the interpolated rows stored in the delta
+    file, in time order. Only the timestamps are needed to build the merged
+    order; the other columns are gathered for the requested rows only.
+    The raw rows are flagged with is_interpolated=False.
+    '''
+    _, order = get_interpolated_ais_data_order(_raw_file, _delta_file, time_column=time_column)
+
+    if row_range is not None:
+        order = order[row_range[0]:row_range[1]]
+
+    raw_table = read_table_from_feather_file(_raw_file)
+    delta_table = read_table_from_feather_file(_delta_file)
+
+    if columns is None:
+        columns = delta_table.column_names
+
+    raw_columns = [column for column in columns if column != "is_interpolated"]
+    is_raw = order < raw_table.num_rows
+
+    raw_data_frame = raw_table.select(raw_columns).take(order[is_raw]).to_pandas()
+    if "is_interpolated" in columns:
+        raw_data_frame["is_interpolated"] = False
+
+    delta_data_frame = delta_table.select(columns).take(order[~is_raw] - raw_table.num_rows).to_pandas()
+
+    # Put the rows coming from both files back into the merged order.
+    positions = np.empty(order.shape[0], dtype=np.int64)
+    positions[is_raw] = np.arange(raw_data_frame.shape[0])
+    positions[~is_raw] = raw_data_frame.shape[0] + np.arange(delta_data_frame.shape[0])
+
+    data_frame = pd.concat([raw_data_frame, delta_data_frame], ignore_index=True)
+
+    return data_frame.iloc[positions][columns].reset_index(drop=True)
+
+
+def get_interval_id(begin, end):
+    return "_".join([pandas_timestamp_to_zulu_format(begin), pandas_timestamp_to_zulu_format(end)])
+
+
+def _get_interval_ais_data_table_files(interval_ais_data_directory):
+    return sorted(
+        file for file in os.listdir(interval_ais_data_directory)
+        if file.endswith("_intervals_ais_data.feather")
+    )
+
+
+@functools.lru_cache(maxsize=4)
+def _read_cached_interval_ais_data_index(_interval_ais_data_directory, _table_keys):
+    tables = [
+        read_data_frame_from_feather_file(os.path.join(_interval_ais_data_directory, file))
+        for file, _, _ in _table_keys
+    ]
+    if not tables:
+        raise FileNotFoundError(f"No interval AIS data tables found in {_interval_ais_data_directory}")
+
+    # The same interval can be selected for more than one scenario, but it always refers to the same rows.
+    index = pd.concat(tables, ignore_index=True).drop_duplicates(subset="interval_id")
+
+    return index.set_index("interval_id")
+
+
+def read_interval_ais_data_index(interval_ais_data_directory):
+    '''
+    Read all the interval AIS data tables of a directory into one DataFrame
+    indexed by interval_id. It is cached until any of the tables change.
+    '''
+    table_keys = tuple(
+        (file,) + _get_file_cache_key(os.path.join(interval_ais_data_directory, file))[1:]
+        for file in _get_interval_ais_data_table_files(interval_ais_data_directory)
+    )
+
+    return _read_cached_interval_ais_data_index(os.path.abspath(interval_ais_data_directory), table_keys)
+
+
+def read_interval_ais_data(interval_ais_data_directory, interval_id, columns=None):
+    '''
+    Read the AIS rows of an interval from the row ranges recorded in the
+    interval AIS data tables. The rows are zero-copy slices of the memory-mapped
+    raw and interpolated delta files, merged in time order.
+    '''
+    interval = read_interval_ais_data_index(interval_ais_data_directory).loc[interval_id]
+
+    data_frames = []
+    for file_column, start_column, stop_column in [
+        ("raw_file", "raw_start", "raw_stop"),
+        ("delta_file", "delta_start", "delta_stop"),
+    ]:
+        table = read_table_from_feather_file(
+            os.path.join(interval_ais_data_directory, interval[file_column])
+        )
+        table = table.slice(interval[start_column], interval[stop_column] - interval[start_column])
+
+        if columns is not None:
+            table = table.select(
+                [column for column in table.column_names if column in columns or column == "pd_timestamp"]
+            )
+
+        data_frame = table.to_pandas()
+        if "is_interpolated" not in data_frame.columns:
+            data_frame["is_interpolated"] = False
+
+        data_frames.append(data_frame)
+
+    data_frame = pd.concat(data_frames, ignore_index=True)
+    data_frame = data_frame.sort_values(by="pd_timestamp", kind="stable", ignore_index=True)
+
+    if columns is not None:
+        data_frame = data_frame[columns]
+
+    return data_frame
+
+
+def read_intervals_ais_data(interval_ais_data_directory, interval_ids, columns=None):
+    '''
+    Batch version of read_interval_ais_data. The rows of all the intervals
+    are gathered with one take per AIS file, grouped by interval and in the
+    same time order as read_interval_ais_data within it. The position of the
+    interval of each row in interval_ids is in the interval_position column.
+    '''
+    index = read_interval_ais_data_index(interval_ais_data_directory).loc[list(interval_ids)]
+    index = index.assign(interval_position=np.arange(index.shape[0]))
+
+    data_frames = []
+    for file_column, start_column, stop_column in [
+        ("raw_file", "raw_start", "raw_stop"),
+        ("delta_file", "delta_start", "delta_stop"),
+    ]:
+        for file, intervals in index.groupby(file_column, sort=False):
+            table = read_table_from_feather_file(os.path.join(interval_ais_data_directory, file))
+
+            # Expand the row ranges of the intervals into the row indices of the table.
+            starts = intervals[start_column].to_numpy(dtype=np.int64)
+            lengths = intervals[stop_column].to_numpy(dtype=np.int64) - starts
+            range_offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+            rows = np.repeat(starts, lengths) + np.arange(lengths.sum()) - range_offsets
+
+            if columns is not None:
+                table = table.select(
+                    [column for column in table.column_names if column in columns or column == "pd_timestamp"]
+                )
+
+            data_frame = table.take(rows).to_pandas()
+            if "is_interpolated" not in data_frame.columns:
+                data_frame["is_interpolated"] = False
+            data_frame["interval_position"] = np.repeat(intervals["interval_position"].to_numpy(), lengths)
+
+            data_frames.append(data_frame)
+
+    if not data_frames:
+        return pd.DataFrame(columns=(columns or ["pd_timestamp"]) + ["interval_position"])
+
+    data_frame = pd.concat(data_frames, ignore_index=True)
+
+    # The raw rows come first, so they stay ahead of the interpolated ones with the same timestamp.
+    order = np.lexsort(
+        (
+            np.arange(data_frame.shape[0]),
+            data_frame["pd_timestamp"].to_numpy(),
+            data_frame["interval_position"].to_numpy(),
+        )
+    )
+    data_frame = data_frame.iloc[order].reset_index(drop=True)
+
+    if columns is not None:
+        data_frame = data_frame[columns + ["interval_position"]]
+
+    return data_frame
+
+
+def read_wav_header(_file):
+    '''
+    Read the format of a WAV file and the position of its samples from the
+    RIFF chunks, without reading the samples. WAVE_FORMAT_EXTENSIBLE files
+    report the format of their sub format.
+    '''
+    file_size = os.path.getsize(_file)
+
+    with open(_file, "rb") as wav_file:
+        riff_header = wav_file.read(12)
+        if riff_header[:4] != b"RIFF" or riff_header[8:12] != b"WAVE":
+            raise ValueError(f"{_file} is not a RIFF WAVE file")
+
+        header = {}
+        while True:
+            chunk_header = wav_file.read(8)
+            if len(chunk_header) < 8:
+                break
+
+            chunk_id = chunk_header[:4]
+            chunk_size = struct.unpack("<I", chunk_header[4:])[0]
+
+            if chunk_id == b"fmt ":
+                format_chunk = wav_file.read(chunk_size)
+                if len(format_chunk) < 16:
+                    raise ValueError(f"{_file} has a truncated fmt chunk")
+
+                audio_format, channels, sample_rate, _, block_align, bits_per_sample = struct.unpack(
+                    "<HHIIHH", format_chunk[:16]
+                )
+                if audio_format == 0xFFFE and len(format_chunk) >= 26:
+                    audio_format = struct.unpack("<H", format_chunk[24:26])[0]
+
+                header.update(
+                    audio_format=audio_format,
+                    channels=channels,
+                    sample_rate=sample_rate,
+                    block_align=block_align,
+                    sample_width=block_align // channels,
+                    bits_per_sample=bits_per_sample,
+                )
+                wav_file.seek(chunk_size % 2, os.SEEK_CUR)
+
+            elif chunk_id == b"data":
+                # Recorders that stop abruptly can leave a data size larger than the file.
+                header["data_offset"] = wav_file.tell()
+                header["data_size"] = min(chunk_size, file_size - header["data_offset"])
+                break
+
+            else:
+                wav_file.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+    if "sample_rate" not in header or "data_offset" not in header:
+        raise ValueError(f"{_file} has no fmt or data chunk")
+
+    header["frame_count"] = header["data_size"] // header["block_align"]
+    header["duration"] = header["frame_count"] / header["sample_rate"]
+
+    return header
 
 
 def get_num_of_threads(use_all_threads=False):
+    '''
+    Get the number of processes of a pool: half of the threads, or all of
+    them with use_all_threads. The AIS cleaning and combining pools ask for
+    all of them, as they always ran on every thread.
+    '''
     # Threading differences between systems.
     number_of_threads = multiprocessing.cpu_count()
     if not use_all_threads:
-        number_of_threads = int(number_of_threads / 2)
+        number_of_threads = max(int(number_of_threads / 2), 1)
+
+    return number_of_threads
+
+
+def get_available_memory():
+    # Available physical memory in bytes, or None where sysconf does not provide it.
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
 
 
 def get_hydrophone_deployments(deployments_directory):
@@ -99,8 +465,8 @@ def zulu_string_to_datetime(_timestamp):
     return datetime.strptime(_timestamp, '%Y%m%dT%H%M%S.%f'+'Z')
 
 
-def get_exclusion_radius(inclusion_radius):
-    return inclusion_radius+2000
+def get_exclusion_radius(inclusion_radius, exclusion_radius_offset=2000):
+    return inclusion_radius+exclusion_radius_offset
 
 
 def get_min_max_normalization(input_value, min_value, max_value):
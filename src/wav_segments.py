@@ -0,0 +1,367 @@
+import os
+import functools
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+from utils import (
+    get_num_of_threads,
+    read_wav_header,
+    read_data_frame_from_feather_file,
+    dump_data_frame_to_feather_file,
+    _get_file_cache_key,
+)
+
+
+# Manifest written instead of the segment WAV files when the audio segments are virtual.
+SEGMENT_MANIFEST_FILE = "segments_manifest.csv"
+
+SEGMENT_MANIFEST_COLUMNS = ["wav_file", "source_file", "frame_offset", "frame_count"]
+
+# Catalog of the WAV headers of a directory, refreshed by update_wav_catalog.
+WAV_CATALOG_FILE = "wav_catalog.feather"
+
+WAV_HEADER_COLUMNS = [
+    "audio_format",
+    "channels",
+    "sample_rate",
+    "block_align",
+    "sample_width",
+    "bits_per_sample",
+    "data_offset",
+    "data_size",
+    "frame_count",
+]
+
+WAV_CATALOG_COLUMNS = ["file", "file_size", "modification_time", "is_valid"] + WAV_HEADER_COLUMNS + ["duration"]
+
+
+def _read_wav_catalog_entry(_file):
+    file_stat = os.stat(_file)
+    entry = {
+        "file": os.path.basename(_file),
+        "file_size": file_stat.st_size,
+        "modification_time": file_stat.st_mtime_ns,
+        "is_valid": True,
+    }
+
+    try:
+        wav_header = read_wav_header(_file)
+    except (OSError, ValueError):
+        # Broken files are cataloged too, so they are not parsed again until they change.
+        entry["is_valid"] = False
+        wav_header = dict.fromkeys(WAV_HEADER_COLUMNS, 0)
+        wav_header["duration"] = 0.0
+
+    entry.update((column, wav_header[column]) for column in WAV_HEADER_COLUMNS + ["duration"])
+
+    return entry
+
+
+def update_wav_catalog(wav_directory, number_of_workers=None):
+    '''
+    Parse the RIFF header of every WAV file of a directory into its catalog.
+    Only the files that are new or whose size or modification time changed
+    are parsed, in parallel, and the files that were removed are dropped.
+    Returns the catalog as a DataFrame.
+    '''
+    if number_of_workers is None:
+        number_of_workers = get_num_of_threads()
+
+    catalog_file = os.path.join(wav_directory, WAV_CATALOG_FILE)
+
+    file_stats = {
+        file: os.stat(os.path.join(wav_directory, file))
+        for file in os.listdir(wav_directory)
+        if file.lower().endswith(".wav")
+    }
+
+    catalog = pd.DataFrame(columns=WAV_CATALOG_COLUMNS)
+    if os.path.exists(catalog_file):
+        catalog = read_data_frame_from_feather_file(catalog_file, memory_map=False)
+
+    is_current = np.array(
+        [
+            file in file_stats
+            and file_stats[file].st_size == file_size
+            and file_stats[file].st_mtime_ns == modification_time
+            for file, file_size, modification_time in zip(
+                catalog["file"], catalog["file_size"], catalog["modification_time"]
+            )
+        ],
+        dtype=bool,
+    )
+    current_catalog = catalog[is_current]
+
+    files_to_parse = sorted(set(file_stats) - set(current_catalog["file"]))
+    if not files_to_parse and is_current.all():
+        return catalog
+
+    if files_to_parse:
+        print(f"Cataloging the headers of {len(files_to_parse)} WAV files in {wav_directory}...")
+
+    file_paths = [os.path.join(wav_directory, file) for file in files_to_parse]
+    if number_of_workers > 1 and len(file_paths) > 1:
+        threading_pool = multiprocessing.Pool(processes=number_of_workers)
+        entries = list(threading_pool.imap_unordered(_read_wav_catalog_entry, file_paths, chunksize=64))
+        threading_pool.close()
+        threading_pool.join()
+    else:
+        entries = [_read_wav_catalog_entry(file_path) for file_path in file_paths]
+
+    catalog = pd.concat(
+        [current_catalog, pd.DataFrame(entries, columns=WAV_CATALOG_COLUMNS)], ignore_index=True
+    )
+    integer_columns = {column: np.int64 for column in ["file_size", "modification_time"] + WAV_HEADER_COLUMNS}
+    catalog = catalog.sort_values(by="file", ignore_index=True).astype(
+        {**integer_columns, "is_valid": bool, "duration": float}
+    )
+
+    dump_data_frame_to_feather_file(catalog_file, catalog, compression="uncompressed")
+
+    return catalog
+
+
+@functools.lru_cache(maxsize=16)
+def _read_cached_wav_catalog(_catalog_file, _modification_time, _file_size):
+    catalog = read_data_frame_from_feather_file(_catalog_file, memory_map=False)
+
+    return {
+        entry["file"]: entry
+        for entry in catalog.to_dict(orient="records")
+    }
+
+
+def read_wav_catalog(wav_directory):
+    '''
+    Read the catalog of a directory as a dict of entries by file name.
+    It is cached until the catalog changes. Returns an empty dict if the
+    directory has no catalog.
+    '''
+    catalog_file = os.path.join(wav_directory, WAV_CATALOG_FILE)
+    if not os.path.exists(catalog_file):
+        return {}
+
+    return _read_cached_wav_catalog(*_get_file_cache_key(catalog_file))
+
+
+@functools.lru_cache(maxsize=256)
+def _read_cached_wav_header(_file, _modification_time, _file_size):
+    return read_wav_header(_file)
+
+
+def get_wav_header(_file):
+    '''
+    Get the header of a WAV file from the catalog of its directory. Files that
+    are not cataloged, or that changed since, are parsed (and cached) instead.
+    '''
+    _, modification_time, file_size = _get_file_cache_key(_file)
+
+    entry = read_wav_catalog(os.path.dirname(_file) or ".").get(os.path.basename(_file))
+    if (
+        entry is not None
+        and entry["is_valid"]
+        and entry["file_size"] == file_size
+        and entry["modification_time"] == modification_time
+    ):
+        return entry
+
+    return _read_cached_wav_header(os.path.abspath(_file), modification_time, file_size)
+
+
+@functools.lru_cache(maxsize=64)
+def _get_cached_wav_samples(_file, _modification_time, _file_size):
+    wav_header = _read_cached_wav_header(_file, _modification_time, _file_size)
+
+    shape = (wav_header["frame_count"], wav_header["channels"])
+    if wav_header["sample_width"] == 3:
+        # There is no 24-bit dtype, so those samples are mapped as bytes and converted on read.
+        return np.memmap(_file, dtype=np.uint8, mode="r", offset=wav_header["data_offset"], shape=shape + (3,))
+
+    dtype = {1: np.uint8, 2: np.dtype("<i2"), 4: np.dtype("<i4")}[wav_header["sample_width"]]
+
+    return np.memmap(_file, dtype=dtype, mode="r", offset=wav_header["data_offset"], shape=shape)
+
+
+def get_wav_samples(_file):
+    '''
+    Memory-map the samples of a PCM WAV file as a (frames, channels) array.
+    24-bit files are mapped as a (frames, channels, 3) array of bytes.
+    '''
+    return _get_cached_wav_samples(*_get_file_cache_key(_file))
+
+
+def _to_samples(frames):
+    if frames.ndim == 3:
+        frames = (
+            frames[..., 0].astype(np.int32)
+            | (frames[..., 1].astype(np.int32) << 8)
+            | (frames[..., 2].astype(np.int32) << 16)
+        )
+        frames = (frames << 8) >> 8
+
+    return frames
+
+
+def write_segment_manifest(output_save_dir, segment_spans):
+    '''
+    Write the manifest of the virtual segments of a directory. segment_spans
+    is a list of (segment name, spans) pairs, where each span is a (source
+    file, frame offset, frame count) tuple. The source files are stored
+    relative to the directory, so the dataset can be moved as a whole.
+    '''
+    rows = [
+        (wav_file, os.path.relpath(source_file, output_save_dir), frame_offset, frame_count)
+        for wav_file, spans in segment_spans
+        for source_file, frame_offset, frame_count in spans
+    ]
+
+    pd.DataFrame(rows, columns=SEGMENT_MANIFEST_COLUMNS).to_csv(
+        os.path.join(output_save_dir, SEGMENT_MANIFEST_FILE), index=False
+    )
+
+
+@functools.lru_cache(maxsize=16)
+def _read_cached_segment_manifest(_manifest_file, _modification_time, _file_size):
+    manifest = pd.read_csv(_manifest_file, dtype={"wav_file": str})
+    manifest_directory = os.path.dirname(_manifest_file)
+
+    segment_spans = {}
+    for row in manifest.itertuples(index=False):
+        segment_spans.setdefault(row.wav_file, []).append(
+            (
+                os.path.normpath(os.path.join(manifest_directory, row.source_file)),
+                int(row.frame_offset),
+                int(row.frame_count),
+            )
+        )
+
+    return segment_spans
+
+
+def get_segment_spans(path):
+    '''
+    Get the (source file, frame offset, frame count) spans of an audio segment.
+    A WAV file that exists is a single span of itself; otherwise the segment
+    is looked up by name in the manifest of its directory.
+    '''
+    if os.path.exists(path):
+        return [(path, 0, get_wav_header(path)["frame_count"])]
+
+    manifest_file = os.path.join(os.path.dirname(path), SEGMENT_MANIFEST_FILE)
+    if not os.path.exists(manifest_file):
+        raise FileNotFoundError(f"{path} does not exist and there is no segment manifest for it")
+
+    segment_spans = _read_cached_segment_manifest(*_get_file_cache_key(manifest_file))
+
+    wav_file = os.path.splitext(os.path.basename(path))[0]
+    if wav_file not in segment_spans:
+        raise FileNotFoundError(f"{path} is not in the segment manifest {manifest_file}")
+
+    return segment_spans[wav_file]
+
+
+def get_wav_segment_info(path):
+    '''
+    Get the sample rate, channels, sample width, number of frames and duration
+    of an audio segment, materialized or virtual, from the WAV headers only.
+    '''
+    spans = get_segment_spans(path)
+    wav_header = get_wav_header(spans[0][0])
+    frame_count = sum(frame_count for _, _, frame_count in spans)
+
+    return {
+        "sample_rate": wav_header["sample_rate"],
+        "channels": wav_header["channels"],
+        "sample_width": wav_header["sample_width"],
+        "frame_count": frame_count,
+        "duration": frame_count / wav_header["sample_rate"],
+    }
+
+
+def get_wav_segments_info(segment_directory, file_names, number_of_workers=None):
+    '''
+    Batch version of get_wav_segment_info for the audio segments of a
+    directory. Copied segments are looked up in the header catalog of the
+    directory, which is refreshed first, and virtual segments in its
+    manifest. Returns a DataFrame with one row per file name, in order.
+    '''
+    columns = ["sample_rate", "channels", "sample_width", "frame_count", "duration"]
+    file_names = pd.Index(file_names, dtype=str)
+
+    manifest_file = os.path.join(segment_directory, SEGMENT_MANIFEST_FILE)
+    if os.path.exists(manifest_file):
+        segment_spans = _read_cached_segment_manifest(*_get_file_cache_key(manifest_file))
+
+        segments = {}
+        for wav_file, spans in segment_spans.items():
+            wav_header = get_wav_header(spans[0][0])
+            segments[f"{wav_file}.wav"] = (
+                wav_header["sample_rate"],
+                wav_header["channels"],
+                wav_header["sample_width"],
+                sum(frame_count for _, _, frame_count in spans),
+            )
+
+        segments_info = pd.DataFrame.from_dict(
+            segments, orient="index", columns=columns[:-1]
+        ).reindex(file_names)
+    else:
+        catalog = update_wav_catalog(segment_directory, number_of_workers).set_index("file")
+
+        invalid_files = catalog.index[~catalog["is_valid"]].intersection(file_names)
+        if len(invalid_files):
+            raise ValueError(f"{segment_directory} has invalid WAV files: {', '.join(invalid_files)}")
+
+        segments_info = catalog.reindex(file_names)[columns[:-1]]
+
+    missing_files = file_names[segments_info["sample_rate"].isna().to_numpy()]
+    if len(missing_files):
+        raise FileNotFoundError(f"{segment_directory} has no audio segments named {', '.join(missing_files)}")
+
+    segments_info = segments_info.astype(np.int64)
+    segments_info["duration"] = segments_info["frame_count"] / segments_info["sample_rate"]
+
+    return segments_info
+
+
+def read_wav_segment(path, start_second=0, duration=None):
+    '''
+    Read a window of an audio segment, materialized or virtual, as a NumPy
+    array of (frames,) for mono audio or (frames, channels) otherwise.
+    The samples come from the memory-mapped source WAV files, so a window
+    inside a single source file is a read-only view that copies nothing.
+    24-bit samples are returned as int32.
+    '''
+    spans = get_segment_spans(path)
+    sample_rate = get_wav_header(spans[0][0])["sample_rate"]
+
+    total_frames = sum(frame_count for _, _, frame_count in spans)
+    start_frame = min(int(start_second * sample_rate), total_frames)
+    stop_frame = total_frames if duration is None else min(start_frame + int(duration * sample_rate), total_frames)
+
+    windows = []
+    span_position = 0
+    for source_file, frame_offset, frame_count in spans:
+        window_start = max(start_frame - span_position, 0)
+        window_stop = min(stop_frame - span_position, frame_count)
+
+        if window_start < window_stop:
+            windows.append(
+                _to_samples(get_wav_samples(source_file)[frame_offset + window_start:frame_offset + window_stop])
+            )
+
+        span_position += frame_count
+
+    if not windows:
+        samples = _to_samples(get_wav_samples(spans[0][0])[:0])
+    elif len(windows) == 1:
+        samples = windows[0]
+    else:
+        samples = np.concatenate(windows)
+
+    if samples.shape[1] == 1:
+        samples = samples[:, 0]
+
+    return samples
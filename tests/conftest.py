@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The pipeline modules and the tools are imported as the scripts do, from their own directories.
+SOURCE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.append(SOURCE_PATH)
+sys.path.append(os.path.join(SOURCE_PATH, "tools"))
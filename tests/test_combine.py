@@ -0,0 +1,100 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from combine import combine_deployment_ais_data
+from track_index import get_track_index
+from utils import (
+    dump_data_frame_to_feather_file,
+    pandas_timestamp_to_zulu_format,
+    read_data_frame_from_feather_file,
+    read_interpolated_ais_data,
+)
+
+DEPLOYMENT_PREFIX = "DEVICE_20200101T000000.000Z_20200102T000000.000Z_"
+
+
+def get_cleaned_ais_data(message_seconds):
+    '''
+    Cleaned AIS messages of two vessels, as step 3 writes them.
+    '''
+    rows = []
+    for mmsi, first_second in [(316000001, 0), (316000002, 5)]:
+        for second in np.asarray(message_seconds) + first_second:
+            timestamp = pd.Timestamp("2020-01-01T01:00:00") + pd.Timedelta(seconds=int(second))
+            rows.append(
+                {
+                    "ais_timestamp": pandas_timestamp_to_zulu_format(timestamp),
+                    "mmsi": mmsi,
+                    "id": 1,
+                    "x": -123.3 + second * 1e-5,
+                    "y": 49.08,
+                    "sog": 5.0,
+                    "cog": 90.0,
+                    "true_heading": 90.0,
+                    "type_and_cargo": 70.0,
+                    "dim_a": 10.0,
+                    "dim_b": 10.0,
+                    "dim_c": 5.0,
+                    "dim_d": 5.0,
+                    "distance_to_hydrophone": 1000.0 + second,
+                }
+            )
+    data_frame = pd.DataFrame(rows)
+    data_frame["pd_timestamp"] = pd.to_datetime(data_frame["ais_timestamp"], format="%Y%m%dT%H%M%S.%fZ")
+
+    return data_frame
+
+
+def combine(tmp_path, message_seconds):
+    deployment_directory = os.path.join(tmp_path, "deployments")
+    clean_ais_directory = os.path.join(tmp_path, "clean")
+    combined_deployment_directory = os.path.join(tmp_path, "combined")
+    for directory in [deployment_directory, clean_ais_directory, combined_deployment_directory]:
+        os.makedirs(directory)
+
+    pd.DataFrame({"begin": ["2020-01-01T00:00:00Z"], "end": ["2020-01-01T12:00:00Z"]}).to_csv(
+        os.path.join(deployment_directory, "DEVICE.csv"), index=False
+    )
+    dump_data_frame_to_feather_file(
+        os.path.join(clean_ais_directory, "DEVICE_20200101T010000.000Z_cleaned.feather"),
+        get_cleaned_ais_data(message_seconds),
+    )
+
+    combine_deployment_ais_data(deployment_directory, clean_ais_directory, combined_deployment_directory)
+
+    return [
+        os.path.join(combined_deployment_directory, DEPLOYMENT_PREFIX + file_suffix)
+        for file_suffix in ["clean_ais_data.feather", "clean_interpolated_delta_ais_data.feather"]
+    ]
+
+
+@pytest.mark.parametrize("message_seconds, interpolated_rows", [
+    # Messages every 10 seconds have nothing to interpolate.
+    (np.arange(0, 300, 10), 0),
+    # A gap of 100 seconds gets 4 rows per vessel, one every 20 seconds.
+    (np.r_[np.arange(0, 100, 10), np.arange(190, 300, 10)], 8),
+])
+def test_delta_schema(tmp_path, message_seconds, interpolated_rows):
+    raw_file, delta_file = combine(tmp_path, message_seconds)
+
+    raw_data_frame = read_data_frame_from_feather_file(raw_file)
+    delta_data_frame = read_data_frame_from_feather_file(delta_file)
+
+    assert delta_data_frame.shape[0] == interpolated_rows
+    assert list(delta_data_frame.columns) == list(raw_data_frame.columns) + ["is_interpolated"]
+    assert delta_data_frame.dtypes.drop("is_interpolated").to_dict() == raw_data_frame.dtypes.to_dict()
+
+    data_frame = read_interpolated_ais_data(raw_file, delta_file)
+
+    assert data_frame.shape[0] == raw_data_frame.shape[0] + interpolated_rows
+    assert data_frame["pd_timestamp"].is_monotonic_increasing
+    assert data_frame["mmsi"].dtype == np.int64
+    assert data_frame["is_interpolated"].sum() == interpolated_rows
+
+    track_index = get_track_index([raw_file, delta_file])
+
+    assert set(track_index["mmsi"]) == {316000001, 316000002}
+    assert track_index["messages"].sum() == data_frame.shape[0]
@@ -0,0 +1,59 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from ctd_index import CTD_COLUMNS, CTD_STORE_SUMMARY_FILE, ZULU_FORMAT, build_ctd_store, read_ctd_store
+from utils import dump_data_frame_to_feather_file, read_data_frame_from_feather_file
+
+DEPLOYMENTS = {
+    "DEVICEB": [("2020-01-02T06:00:00Z", "2020-01-04T18:00:00Z")],
+    "DEVICEA": [("2020-01-01T00:00:00Z", "2020-01-02T12:00:00Z"), ("2020-01-06T00:00:00Z", "2020-01-06T12:00:00Z")],
+    "DEVICEC": [("2020-01-03T00:00:00Z", "2020-01-03T12:00:00Z")],
+}
+
+
+def test_read_ctd_store(tmp_path):
+    deployment_directory = os.path.join(tmp_path, "deployments")
+    clean_ctd_directory = os.path.join(tmp_path, "clean")
+    ctd_store_directory = os.path.join(tmp_path, "ctd_store")
+    for directory in [deployment_directory, clean_ctd_directory, ctd_store_directory]:
+        os.makedirs(directory)
+
+    for device, deployments in DEPLOYMENTS.items():
+        pd.DataFrame(deployments, columns=["begin", "end"]).to_csv(
+            os.path.join(deployment_directory, f"{device}.csv"), index=False
+        )
+
+    # One cleaned file per day, with a sample every 7 seconds and some missing values.
+    random_state = np.random.RandomState(42)
+    for day in pd.date_range("2019-12-31", "2020-01-07", freq="D"):
+        dates = day + pd.to_timedelta(np.arange(0, 86400, 7), unit="s")
+        ctd_df = pd.DataFrame({"date": dates.strftime(ZULU_FORMAT)})
+        for column in CTD_COLUMNS:
+            values = random_state.normal(size=dates.shape[0])
+            values[random_state.rand(dates.shape[0]) < 0.1] = np.nan
+            ctd_df[column] = values
+        dump_data_frame_to_feather_file(
+            os.path.join(clean_ctd_directory, f"CTD_{day.strftime('%Y%m%dT%H%M%S')}.000Z_cleaned.feather"), ctd_df
+        )
+
+    build_ctd_store(deployment_directory, clean_ctd_directory, ctd_store_directory, cadence="1min", rolling_window="10min")
+
+    # The partitions are listed by the beginning of their deployment.
+    summary = pd.read_csv(os.path.join(ctd_store_directory, CTD_STORE_SUMMARY_FILE))
+    assert [file.split("_")[0] for file in summary["file"]] == ["DEVICEA", "DEVICEB", "DEVICEC", "DEVICEA"]
+
+    ctd_store, cadence = read_ctd_store(ctd_store_directory)
+
+    assert cadence == "1min"
+    assert ctd_store["date"].is_monotonic_increasing and ctd_store["date"].is_unique
+
+    # Same as sorting all of the partitions and keeping the bins of the deployment that begins first.
+    partitions = [
+        read_data_frame_from_feather_file(os.path.join(ctd_store_directory, file)) for file in summary["file"]
+    ]
+    expected = pd.concat(partitions, ignore_index=True)
+    expected = expected.sort_values(by="date", kind="stable").drop_duplicates(subset="date", ignore_index=True)
+
+    pd.testing.assert_frame_equal(ctd_store, expected)
@@ -0,0 +1,57 @@
+import os
+import wave
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import dataset_cleaninig
+import dataset_feature_cache
+
+SAMPLE_RATE = 8000
+
+
+def write_wav(path, seconds, channels=1, seed=0):
+    samples = np.random.RandomState(seed).randint(-3000, 3000, (int(seconds * SAMPLE_RATE), channels)).astype(np.int16)
+    with wave.open(path, "wb") as wav_file:
+        wav_file.setnchannels(channels)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(SAMPLE_RATE)
+        wav_file.writeframes(samples.tobytes())
+
+    return samples.astype(np.float64)
+
+
+@pytest.mark.parametrize("seconds", [0.4, 1.0, 9.7, 10.0, 20.5, 23.0])
+@pytest.mark.parametrize("channels", [1, 2])
+def test_segment_features(tmp_path, seconds, channels):
+    # Segments whose audio ends with less than a second after their last whole chunk have a sub-second tail.
+    path = os.path.join(tmp_path, "segment.wav")
+    samples = write_wav(path, seconds, channels)
+
+    features, frames = dataset_feature_cache.get_segment_features((path, SAMPLE_RATE))
+
+    assert frames == samples.shape[0]
+    assert features.shape == (int(np.ceil(seconds)), len(dataset_feature_cache.FEATURES))
+    for second, second_features in enumerate(features):
+        second_samples = samples[second * SAMPLE_RATE:(second + 1) * SAMPLE_RATE]
+        assert second_features[2] == pytest.approx(np.sqrt(np.mean(second_samples ** 2)))
+        assert second_features[3] == np.abs(second_samples).max()
+
+
+def test_window_features(tmp_path):
+    metadata = []
+    for position, seconds in enumerate([0.4, 20.5, 23.0, 35.5]):
+        path = os.path.join(tmp_path, f"{position}.wav")
+        write_wav(path, seconds, seed=position)
+        metadata.append({"label": "tug", "duration_sec": seconds, "path": path, "sample_rate": SAMPLE_RATE})
+    metadata = pd.DataFrame(metadata)
+
+    cache_path = os.path.join(tmp_path, "feature_cache")
+    dataset_feature_cache.build_feature_cache(metadata, cache_path)
+    window_metadata = dataset_feature_cache.get_window_features(dataset_feature_cache.load_feature_cache(cache_path), 10)
+
+    # The windows of KERNEL_SECONDS have the std of the cleaning.
+    cleaned_metadata = dataset_cleaninig.flutuation_analysis(metadata)
+    assert list(window_metadata["sub_init"]) == list(cleaned_metadata["sub_init"])
+    np.testing.assert_allclose(window_metadata["std"], cleaned_metadata["std"], rtol=1e-5)
@@ -0,0 +1,93 @@
+import os
+import wave
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from format import split_and_save_wav
+from wav_segments import SEGMENT_MANIFEST_FILE, read_wav_segment
+
+SAMPLE_RATE = 8000
+
+# Raw files of one minute; the last one has another sample rate, so no segment can join it with the others.
+RAW_WAV_FILES = {
+    "DEVICE_20200101T000000.000Z.wav": SAMPLE_RATE,
+    "DEVICE_20200101T000100.000Z.wav": SAMPLE_RATE,
+    "DEVICE_20200101T000200.000Z.wav": 2 * SAMPLE_RATE,
+}
+
+INTERVALS = [
+    # Inside the first file.
+    ("20200101T000010.000Z", "20200101T000040.000Z"),
+    # Across the first and second files.
+    ("20200101T000050.000Z", "20200101T000130.000Z"),
+    # Without audio.
+    ("20200101T010000.000Z", "20200101T010030.000Z"),
+    # Across files of different formats, which fails.
+    ("20200101T000150.000Z", "20200101T000210.000Z"),
+]
+
+
+def write_raw_wav_files(raw_wav_directory):
+    raw_samples = {}
+    for position, (wav_file, sample_rate) in enumerate(RAW_WAV_FILES.items()):
+        samples = np.random.RandomState(position).randint(-3000, 3000, 60 * sample_rate).astype(np.int16)
+        with wave.open(os.path.join(raw_wav_directory, wav_file), "wb") as output_wav:
+            output_wav.setnchannels(1)
+            output_wav.setsampwidth(2)
+            output_wav.setframerate(sample_rate)
+            output_wav.writeframes(samples.tobytes())
+        raw_samples[wav_file] = samples
+
+    return raw_samples
+
+
+@pytest.mark.parametrize("number_of_workers", [1, 2])
+def test_virtual_segments_match_exported_segments(tmp_path, number_of_workers):
+    raw_wav_directory = os.path.join(tmp_path, "raw")
+    os.makedirs(raw_wav_directory)
+    raw_samples = write_raw_wav_files(raw_wav_directory)
+    data_from_range = pd.DataFrame(INTERVALS, columns=["begin", "end"])
+
+    outputs = {}
+    for virtual in [False, True]:
+        output_save_dir = os.path.join(tmp_path, "virtual" if virtual else "exported")
+        os.makedirs(output_save_dir)
+        failed_intervals = split_and_save_wav(
+            raw_wav_directory,
+            output_save_dir,
+            data_from_range,
+            sorted(RAW_WAV_FILES),
+            number_of_workers=number_of_workers,
+            virtual=virtual,
+        )
+
+        assert [failed_interval["index"] for failed_interval in failed_intervals] == [3]
+        assert failed_intervals[0]["error"].startswith("ValueError")
+        assert pd.read_csv(os.path.join(output_save_dir, "failed_intervals.csv"))["index"].tolist() == [3]
+        assert not os.path.exists(os.path.join(output_save_dir, "3.wav"))
+        assert os.path.exists(os.path.join(output_save_dir, SEGMENT_MANIFEST_FILE)) == virtual
+        outputs[virtual] = (output_save_dir, pd.read_csv(os.path.join(output_save_dir, "intervals.csv"), dtype=str))
+
+    exported_directory, exported_intervals = outputs[False]
+    virtual_directory, virtual_intervals = outputs[True]
+    pd.testing.assert_frame_equal(exported_intervals, virtual_intervals)
+    assert exported_intervals["wav_file"].tolist() == ["0", "1"]
+    assert not os.path.exists(os.path.join(virtual_directory, "0.wav"))
+
+    first_file, second_file = sorted(RAW_WAV_FILES)[:2]
+    expected_samples = [
+        raw_samples[first_file][10 * SAMPLE_RATE:40 * SAMPLE_RATE],
+        np.concatenate([raw_samples[first_file][50 * SAMPLE_RATE:], raw_samples[second_file][:30 * SAMPLE_RATE]]),
+    ]
+    for wav_file, expected in zip(exported_intervals["wav_file"], expected_samples):
+        exported = read_wav_segment(os.path.join(exported_directory, f"{wav_file}.wav"))
+        np.testing.assert_array_equal(exported, expected)
+        np.testing.assert_array_equal(read_wav_segment(os.path.join(virtual_directory, f"{wav_file}.wav")), exported)
+
+        # A window of a segment is the same both ways too.
+        np.testing.assert_array_equal(
+            read_wav_segment(os.path.join(virtual_directory, f"{wav_file}.wav"), start_second=5, duration=10),
+            read_wav_segment(os.path.join(exported_directory, f"{wav_file}.wav"), start_second=5, duration=10),
+        )
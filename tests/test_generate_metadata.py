@@ -0,0 +1,69 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from generate_metadata import CLASSES, read_metadata, split_dataset_by_hash, write_metadata
+
+DATASETS = ["test", "validation", "train"]
+
+
+def get_metadata(segments, first_segment=0):
+    '''
+    A metadata with a few windows per segment, as step 11 writes it.
+    '''
+    random_state = np.random.RandomState(first_segment)
+    rows = []
+    for segment in range(first_segment, first_segment + segments):
+        label = CLASSES[random_state.randint(len(CLASSES))]
+        for sub_init in range(random_state.randint(1, 6)):
+            rows.append({"label": label, "path": f"{label}/segment_{segment}.wav", "sub_init": sub_init})
+
+    return pd.DataFrame(rows)
+
+
+def split(root_path, metadata, output_format, **kwargs):
+    write_metadata(metadata, os.path.join(root_path, f"metadata.{output_format}"))
+    split_dataset_by_hash(root_path, f"metadata.{output_format}", output_format=output_format, **kwargs)
+
+    return {
+        dataset: read_metadata(os.path.join(root_path, f"metadata_{dataset}.{output_format}")) for dataset in DATASETS
+    }
+
+
+def get_assignment(datasets):
+    return {
+        (row.path, row.sub_init): dataset
+        for dataset, metadata in datasets.items()
+        for row in metadata.itertuples(index=False)
+    }
+
+
+@pytest.mark.parametrize("output_format", ["csv", "parquet"])
+def test_split_is_stable(tmp_path, output_format):
+    metadata = get_metadata(2000)
+
+    datasets = split(tmp_path, metadata, output_format, chunk_rows=1000)
+    assignment = get_assignment(datasets)
+
+    assert len(assignment) == metadata.shape[0]
+    # The datasets are fractions of all of the rows, whatever the classes.
+    for dataset, fraction in zip(DATASETS, [0.1, 0.2, 0.7]):
+        assert datasets[dataset].shape[0] / metadata.shape[0] == pytest.approx(fraction, abs=0.03)
+    # All of the windows of a segment are in the same dataset.
+    assert sum(len(set(metadata_split["path"])) for metadata_split in datasets.values()) == metadata["path"].nunique()
+
+    # Another run, in other chunks and with the rows in another order, gives the same datasets.
+    shuffled_metadata = metadata.sample(frac=1, random_state=1, ignore_index=True)
+    assert get_assignment(split(tmp_path, shuffled_metadata, output_format, chunk_rows=333)) == assignment
+
+    # Appending rows does not move the rows already assigned.
+    appended_metadata = pd.concat([metadata, get_metadata(500, first_segment=2000)], ignore_index=True)
+    appended_assignment = get_assignment(split(tmp_path, appended_metadata, output_format, chunk_rows=1000))
+
+    assert len(appended_assignment) == appended_metadata.shape[0]
+    assert {key: appended_assignment[key] for key in assignment} == assignment
+
+    # Another seed gives other datasets.
+    assert get_assignment(split(tmp_path, metadata, output_format, random_seed=7)) != assignment
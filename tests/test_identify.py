@@ -0,0 +1,286 @@
+import io
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from identify import get_scenario_radii, get_unique_intervals, identify_deployment_scenarios
+from utils import dump_data_frame_to_feather_file, pandas_timestamp_to_zulu_format, read_data_frame_from_feather_file
+
+INCLUSION_RADII = np.array([1000, 2000, 3000])
+
+DEPLOYMENT_BEGIN = pd.Timestamp("2020-01-01")
+DEPLOYMENT_END = pd.Timestamp("2020-01-04")
+
+INTERVAL_FILE_SUFFIXES = ["background_intervals.csv", "unique_vessel_intervals.csv"]
+
+
+def test_scenario_radii():
+    assert get_scenario_radii("in_04000_out_06000") == (4000, 6000)
+    assert get_scenario_radii("in_100000_out_102000") == (100000, 102000)
+    assert get_scenario_radii(6000) == 6000
+
+
+def test_farthest_range_first():
+    # Radii of six digits sort before the padded ones of five as names, but are farther away.
+    minutes = pd.date_range("2020-01-01", periods=60, freq="1min")
+    interval_dicts = {key: minutes for key in ["in_04000_out_06000", "in_20000_out_22000", "in_100000_out_102000"]}
+
+    list_of_data_to_fetch = get_unique_intervals(interval_dicts, minimum_consecutive_minutes=30)
+
+    assert list(list_of_data_to_fetch) == ["in_100000_out_102000"]
+
+    list_of_data_to_fetch = get_unique_intervals({6000: minutes, 102000: minutes}, minimum_consecutive_minutes=30)
+
+    assert list(list_of_data_to_fetch) == [102000]
+
+
+def get_ais_data(random_state, first_minute):
+    '''
+    AIS messages with the edge cases of the scenario identification: empty
+    minutes, runs just under and over the minimum consecutive minutes,
+    vessels exactly on an inclusion or an exclusion radius, several vessels in
+    the same minute and NaN distances, followed by random vessel tracks.
+    '''
+    nan = float("nan")
+    blocks = []
+    for minutes in [28, 29, 30, 31, 32, 33]:
+        blocks += [(minutes, []), (2, [(200, 500.0)])]
+    blocks += [(31, [(300, 20000.0), (301, nan)]), (2, [(200, 500.0)])]
+    for minutes in [3, 4, 5, 6, 7, 8]:
+        blocks += [(minutes, [(100 + minutes, 1500.0)]), (35, [])]
+    blocks += [
+        (8, [(400, 2000.0)]),
+        (8, [(401, 4000.0)]),
+        (8, [(402, 1500.0), (403, 4000.0)]),
+        (8, [(404, 1000.0), (405, 1200.0)]),
+        (8, [(406, 1500.0), (406, nan)]),
+        (8, [(407, 3000.0), (408, 5000.0)]),
+        (8, [(409, 500.0), (410, 4000.0)]),
+        (8, [(411, 1500.0), (412, 4500.0)]),
+        (40, [(413, 5000.0)]),
+        (40, [(414, 4000.0)]),
+        (35, []),
+    ]
+
+    vessel_minutes = []
+    minute = 0
+    for minutes, vessels in blocks:
+        vessel_minutes += [(minute + offset, mmsi, distance) for offset in range(minutes) for mmsi, distance in vessels]
+        minute += minutes
+
+    # Random tracks, closing in and moving away from the hydrophone.
+    for mmsi in range(500, 508):
+        track_begin = minute + random_state.randint(0, 180)
+        distances = np.abs(np.cumsum(random_state.randint(-600, 601, random_state.randint(5, 60)))) + random_state.randint(0, 4000)
+        distances = np.where(random_state.rand(distances.shape[0]) < 0.05, nan, distances)
+        vessel_minutes += [(track_begin + offset, mmsi, distance) for offset, distance in enumerate(distances)]
+
+    rows = []
+    for minute, mmsi, distance in vessel_minutes:
+        for second in np.sort(random_state.choice(60, random_state.randint(1, 4), replace=False)):
+            rows.append((first_minute + pd.Timedelta(minutes=minute, seconds=int(second)), mmsi, distance))
+
+    return pd.DataFrame(rows, columns=["pd_timestamp", "mmsi", "distance_to_hydrophone"])
+
+
+def get_deployment_ais_data():
+    # Three days of the deployment, so days can be appended.
+    random_state = np.random.RandomState(28)
+    data_frame = pd.concat(
+        [get_ais_data(random_state, DEPLOYMENT_BEGIN + pd.Timedelta(days=day, hours=2)) for day in range(3)],
+        ignore_index=True,
+    )
+    data_frame = data_frame.sort_values(by="pd_timestamp", kind="stable", ignore_index=True)
+
+    # Some of the rows are stored as interpolated rows, in the delta file.
+    data_frame["is_interpolated"] = random_state.rand(data_frame.shape[0]) < 0.25
+
+    return data_frame
+
+
+def get_directories(root_path):
+    directories = [os.path.join(root_path, directory) for directory in ["combined", "scenarios", "intervals"]]
+    for directory in directories:
+        os.makedirs(directory, exist_ok=True)
+
+    return directories
+
+
+def identify(root_path, data_frame, **kwargs):
+    combined_deployment_directory, scenario_intervals_directory, interval_ais_data_directory = get_directories(root_path)
+
+    deployment_files = [
+        os.path.join(
+            combined_deployment_directory,
+            "_".join(
+                [
+                    "DEVICE",
+                    pandas_timestamp_to_zulu_format(DEPLOYMENT_BEGIN),
+                    pandas_timestamp_to_zulu_format(DEPLOYMENT_END),
+                    file_suffix,
+                ]
+            ),
+        )
+        for file_suffix in ["clean_ais_data.feather", "clean_interpolated_delta_ais_data.feather"]
+    ]
+    dump_data_frame_to_feather_file(
+        deployment_files[0], data_frame[~data_frame["is_interpolated"]].drop(columns="is_interpolated")
+    )
+    dump_data_frame_to_feather_file(deployment_files[1], data_frame[data_frame["is_interpolated"]])
+
+    identify_deployment_scenarios(
+        "DEVICE",
+        DEPLOYMENT_BEGIN,
+        DEPLOYMENT_END,
+        deployment_files,
+        scenario_intervals_directory,
+        interval_ais_data_directory,
+        INCLUSION_RADII,
+        **kwargs,
+    )
+
+
+def read_interval_files(root_path):
+    _, scenario_intervals_directory, interval_ais_data_directory = get_directories(root_path)
+    prefix = "_".join(
+        ["DEVICE", pandas_timestamp_to_zulu_format(DEPLOYMENT_BEGIN), pandas_timestamp_to_zulu_format(DEPLOYMENT_END)]
+    )
+
+    interval_files = {}
+    for file_suffix in INTERVAL_FILE_SUFFIXES:
+        with open(os.path.join(scenario_intervals_directory, f"{prefix}_{file_suffix}")) as interval_file:
+            interval_files[file_suffix] = interval_file.read()
+
+        interval_files[file_suffix.replace(".csv", "_ais_data.feather")] = read_data_frame_from_feather_file(
+            os.path.join(interval_ais_data_directory, f"{prefix}_{file_suffix.replace('.csv', '_ais_data.feather')}")
+        )
+
+    return interval_files
+
+
+def get_baseline_interval_dicts(data_frame, inclusion_radii, exclusion_radius_offset=2000):
+    # The loop over every minute of the deployment that the minute aggregates replaced.
+    inclusion_exclusion_interval_dicts = {}
+    background_noise_interval_dicts = {}
+
+    data_frame = data_frame.sort_values(by=["pd_timestamp"])
+    data_frame = data_frame.set_index(data_frame["pd_timestamp"].rename(None))
+
+    for interval_left, interval_data in data_frame.groupby(pd.Grouper(freq="1Min", offset="0Min", label="left")):
+        for inclusion_radius in inclusion_radii:
+            exclusion_radius = inclusion_radius + exclusion_radius_offset
+
+            if sum(interval_data["distance_to_hydrophone"] <= exclusion_radius) == 0:
+                background_noise_interval_dicts.setdefault(exclusion_radius, []).append(interval_left)
+            else:
+                only_one_vessel_within_exclusion_radius = (
+                    interval_data[interval_data["distance_to_hydrophone"] <= exclusion_radius]["mmsi"].unique().shape[0]
+                ) == 1
+                all_messages_are_within_inclusion_radius = sum(
+                    interval_data["distance_to_hydrophone"] <= inclusion_radius
+                ) == sum(interval_data["distance_to_hydrophone"] <= exclusion_radius)
+
+                if only_one_vessel_within_exclusion_radius and all_messages_are_within_inclusion_radius:
+                    scenario = f"in_{inclusion_radius:05d}_out_{exclusion_radius:05d}"
+                    inclusion_exclusion_interval_dicts.setdefault(scenario, []).append(interval_left)
+
+    return background_noise_interval_dicts, inclusion_exclusion_interval_dicts
+
+
+def get_baseline_intervals(interval_dicts, minimum_consecutive_minutes):
+    # The run detection of the consecutive minutes that get_unique_intervals replaced.
+    list_of_data_to_fetch = {}
+    descending_keys = sorted(interval_dicts.keys(), reverse=True)
+
+    for distance_index, key in enumerate(descending_keys):
+        temporary_data_frame = pd.DataFrame(interval_dicts[key], columns=["closed_left"])
+        temporary_data_frame["difference"] = (
+            temporary_data_frame["closed_left"].diff().dt.total_seconds().div(60, fill_value=0.0)
+        )
+        temporary_data_frame["consecutive"] = (
+            temporary_data_frame["difference"]
+            .groupby((temporary_data_frame["difference"] != temporary_data_frame["difference"].shift()).cumsum())
+            .transform("size")
+        )
+        temporary_data_frame = temporary_data_frame[temporary_data_frame["consecutive"] >= minimum_consecutive_minutes]
+
+        end_index = -1
+        while end_index != (temporary_data_frame.shape[0] - 1):
+            start_index = end_index + 1
+            end_index = start_index + temporary_data_frame.iloc[start_index]["consecutive"] - 1
+            list_of_data_to_fetch.setdefault(key, []).append(
+                [
+                    temporary_data_frame.iloc[start_index]["closed_left"],
+                    temporary_data_frame.iloc[end_index]["closed_left"] + pd.DateOffset(minutes=1),
+                ]
+            )
+
+        reference_list = set(temporary_data_frame["closed_left"])
+        for modify_index in range(distance_index + 1, len(descending_keys)):
+            interval_dicts[descending_keys[modify_index]] = [
+                value for value in interval_dicts[descending_keys[modify_index]] if value not in reference_list
+            ]
+
+    return list_of_data_to_fetch
+
+
+def get_baseline_csv(list_of_data_to_fetch, is_background):
+    lines = ["exclusion_radius,begin,end" if is_background else "inclusion_radius,exclusion_radius,begin,end"]
+    for key, intervals in list_of_data_to_fetch.items():
+        radii = [f"{key:05d}"] if is_background else key.split("_")[1::2]
+        for begin, end in intervals:
+            lines.append(",".join(radii + [pandas_timestamp_to_zulu_format(begin), pandas_timestamp_to_zulu_format(end)]))
+
+    return "\n".join(lines) + "\n"
+
+
+def test_same_intervals_as_baseline(tmp_path):
+    data_frame = get_deployment_ais_data()
+
+    identify(tmp_path, data_frame)
+    interval_files = read_interval_files(tmp_path)
+
+    background_interval_dicts, vessel_interval_dicts = get_baseline_interval_dicts(data_frame, INCLUSION_RADII)
+    background_intervals = get_baseline_intervals(background_interval_dicts, 30)
+    vessel_intervals = get_baseline_intervals(vessel_interval_dicts, 5)
+
+    # Every radius has both selected and discarded runs.
+    assert all(background_intervals.values()) and len(background_intervals) == len(INCLUSION_RADII)
+    assert all(vessel_intervals.values()) and len(vessel_intervals) == len(INCLUSION_RADII)
+
+    assert interval_files["background_intervals.csv"] == get_baseline_csv(background_intervals, True)
+    assert interval_files["unique_vessel_intervals.csv"] == get_baseline_csv(vessel_intervals, False)
+
+
+@pytest.mark.parametrize("overlap_minutes", [1, 60])
+@pytest.mark.parametrize("file_suffix", INTERVAL_FILE_SUFFIXES)
+def test_incremental_identification(tmp_path, capsys, overlap_minutes, file_suffix):
+    data_frame = get_deployment_ais_data()
+
+    identify(os.path.join(tmp_path, "full"), data_frame)
+    interval_files = read_interval_files(os.path.join(tmp_path, "full"))
+
+    # The previous runs end in the middle of the longest interval, so its run crosses their end.
+    intervals = pd.read_csv(io.StringIO(interval_files[file_suffix]))
+    begins = pd.to_datetime(intervals["begin"], format="%Y%m%dT%H%M%S.%fZ")
+    ends = pd.to_datetime(intervals["end"], format="%Y%m%dT%H%M%S.%fZ")
+    longest = (ends - begins).idxmax()
+    crossing_end = begins[longest] + (ends[longest] - begins[longest]) / 2 + pd.Timedelta(seconds=17)
+
+    # Days are appended to the deployment files between the runs.
+    incremental_path = os.path.join(tmp_path, "incremental")
+    for end in [crossing_end, DEPLOYMENT_BEGIN + pd.Timedelta(days=2), None]:
+        appended_data_frame = data_frame if end is None else data_frame[data_frame["pd_timestamp"] < end]
+        identify(incremental_path, appended_data_frame, incremental=True, overlap_minutes=overlap_minutes)
+
+    # Only the first run reads the whole deployment.
+    assert capsys.readouterr().out.count("Resuming from") == 2
+
+    incremental_interval_files = read_interval_files(incremental_path)
+    for interval_file, content in interval_files.items():
+        if isinstance(content, str):
+            assert incremental_interval_files[interval_file] == content
+        else:
+            pd.testing.assert_frame_equal(incremental_interval_files[interval_file], content)
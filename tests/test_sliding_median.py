@@ -0,0 +1,95 @@
+import warnings
+
+import numpy as np
+import pytest
+from scipy import ndimage, signal
+
+import sliding_median
+from sliding_median import PAD_MODES
+
+
+@pytest.fixture(params=[True, False], ids=["scipy_rank_filter", "sorted_blocks"])
+def fast_rank_filter(request, monkeypatch):
+    # Both backends are checked, whatever the installed scipy.
+    monkeypatch.setattr(sliding_median, "SCIPY_FAST_RANK_FILTER", request.param)
+    return request.param
+
+
+def get_samples(random_state, shape, dtype, maximum):
+    # Small maximums give many equal samples, so the ties are checked too.
+    samples = random_state.randint(-maximum, maximum, shape)
+    if np.issubdtype(dtype, np.floating):
+        samples = samples + random_state.choice([0, 0.5], shape)
+    return samples.astype(dtype)
+
+
+def get_expected(samples, kernel_size, mode):
+    rows = samples.reshape(-1, samples.shape[-1])
+    return np.stack([ndimage.median_filter(row, size=kernel_size, mode=mode) for row in rows]).reshape(samples.shape)
+
+
+@pytest.mark.parametrize("mode", list(PAD_MODES))
+@pytest.mark.parametrize("dtype", [np.int16, np.float32, np.float64])
+@pytest.mark.parametrize("maximum", [2, 32767])
+def test_same_as_ndimage(fast_rank_filter, mode, dtype, maximum):
+    random_state = np.random.RandomState(42)
+    for _ in range(40):
+        kernel_size = random_state.randint(1, 40)
+        shape = (random_state.randint(1, 5), random_state.randint(1, 200))
+        samples = get_samples(random_state, shape, dtype, maximum)
+
+        median = sliding_median.sliding_median(samples, kernel_size, mode=mode)
+
+        assert median.dtype == samples.dtype
+        np.testing.assert_array_equal(median, get_expected(samples, kernel_size, mode))
+
+
+@pytest.mark.parametrize("mode", list(PAD_MODES))
+@pytest.mark.parametrize("kernel_size", [1, 2, 4, 7, 16])
+def test_kernel_sizes(fast_rank_filter, mode, kernel_size):
+    samples = get_samples(np.random.RandomState(kernel_size), (3, 50), np.int16, 4)
+
+    np.testing.assert_array_equal(sliding_median.sliding_median(samples, kernel_size, mode=mode), get_expected(samples, kernel_size, mode))
+
+
+@pytest.mark.parametrize("mode", list(PAD_MODES))
+@pytest.mark.parametrize("length", [1, 3, 8])
+def test_rows_shorter_than_kernel(fast_rank_filter, mode, length):
+    samples = get_samples(np.random.RandomState(length), (2, length), np.float64, 10)
+
+    np.testing.assert_array_equal(sliding_median.sliding_median(samples, 9, mode=mode), get_expected(samples, 9, mode))
+
+
+def test_one_dimensional_and_empty(fast_rank_filter):
+    samples = get_samples(np.random.RandomState(0), (300,), np.int16, 100)
+
+    np.testing.assert_array_equal(sliding_median.sliding_median(samples, 11), ndimage.median_filter(samples, size=11))
+    assert sliding_median.sliding_median(np.empty((0, 10), dtype=np.int16), 5).shape == (0, 10)
+
+
+@pytest.mark.parametrize("dtype", [np.int16, np.float64])
+def test_same_as_medfilt(fast_rank_filter, dtype):
+    random_state = np.random.RandomState(7)
+    for _ in range(40):
+        # medfilt only takes odd kernels.
+        kernel_size = 2 * random_state.randint(0, 20) + 1
+        samples = get_samples(random_state, (random_state.randint(1, 4), random_state.randint(1, 150)), dtype, 3)
+
+        with warnings.catch_warnings():
+            # medfilt warns about kernels longer than the signal.
+            warnings.simplefilter("ignore", UserWarning)
+            expected = np.stack([signal.medfilt(row, kernel_size=kernel_size) for row in samples])
+
+        np.testing.assert_array_equal(sliding_median.sliding_median(samples, kernel_size, mode="constant"), expected)
+
+
+def test_batches_of_sorted_blocks(monkeypatch):
+    # Signals longer than a batch of pairs of blocks are filtered in several batches.
+    monkeypatch.setattr(sliding_median, "PAIRS_PER_BATCH", 3)
+    samples = get_samples(np.random.RandomState(1), (1000,), np.int16, 50)
+    kernel_size = 9
+
+    window_medians = sliding_median.get_window_medians(samples, kernel_size)
+
+    expected = ndimage.median_filter(samples, size=kernel_size)[kernel_size // 2:samples.shape[0] - kernel_size // 2]
+    np.testing.assert_array_equal(window_medians, expected)
@@ -0,0 +1,177 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from combine import combine_deployment_ais_data
+from track_index import build_track_index, query_track_index, query_track_rows
+from utils import dump_data_frame_to_feather_file, pandas_timestamp_to_zulu_format, read_interpolated_ais_data
+
+DEPLOYMENT_PREFIX = "DEVICE_20200101T000000.000Z_20200102T000000.000Z_"
+
+RADIUS = 3000
+
+QUERIES = [
+    ("2020-01-01T00:00:00", "2020-01-02T00:00:00", RADIUS, 0),
+    ("2020-01-01T01:10:30", "2020-01-01T01:40:15", RADIUS, 0),
+    ("2020-01-01T01:10:30", "2020-01-01T01:40:15", 6000, 1500),
+    ("2020-01-01T01:59:59", "2020-01-01T02:00:00", 10000, 0),
+    ("2020-01-01T00:10:00", "2020-01-01T00:50:00", 10000, 0),
+    ("2020-01-01T01:00:00", "2020-01-01T03:00:00", 500, 400),
+]
+
+
+def get_cleaned_ais_data(has_gaps):
+    '''
+    Cleaned AIS messages of several vessels between 01:00 and 03:00, with
+    integer distances to the hydrophone. One vessel stays exactly on RADIUS.
+    '''
+    random_state = np.random.RandomState(34)
+    message_gaps = [5, 10, 20, 90, 300, 1500] if has_gaps else [5, 10, 20]
+
+    rows = []
+    for mmsi in range(316000001, 316000007):
+        seconds = np.cumsum(random_state.choice(message_gaps, 400)) + random_state.randint(0, 3600)
+        seconds = seconds[seconds < 7200]
+        distances = np.clip(np.cumsum(random_state.randint(-300, 301, seconds.shape[0])) + random_state.randint(0, 8000), 0, None)
+        if mmsi == 316000006:
+            distances = np.full(seconds.shape[0], RADIUS)
+
+        for second, distance in zip(seconds, distances):
+            timestamp = pd.Timestamp("2020-01-01T01:00:00") + pd.Timedelta(seconds=int(second))
+            rows.append(
+                {
+                    "ais_timestamp": pandas_timestamp_to_zulu_format(timestamp),
+                    "mmsi": mmsi,
+                    "id": 1,
+                    "x": -123.3,
+                    "y": 49.08,
+                    "sog": 5.0,
+                    "cog": 90.0,
+                    "true_heading": 90.0,
+                    "type_and_cargo": 70.0,
+                    "dim_a": 10.0,
+                    "dim_b": 10.0,
+                    "dim_c": 5.0,
+                    "dim_d": 5.0,
+                    "distance_to_hydrophone": float(distance),
+                }
+            )
+    data_frame = pd.DataFrame(rows)
+    data_frame["pd_timestamp"] = pd.to_datetime(data_frame["ais_timestamp"], format="%Y%m%dT%H%M%S.%fZ")
+
+    return data_frame
+
+
+@pytest.fixture(params=[True, False], ids=["gaps", "no_gaps"])
+def directories(request, tmp_path):
+    deployment_directory = os.path.join(tmp_path, "deployments")
+    clean_ais_directory = os.path.join(tmp_path, "clean")
+    combined_deployment_directory = os.path.join(tmp_path, "combined")
+    track_index_directory = os.path.join(tmp_path, "track_index")
+    for directory in [deployment_directory, clean_ais_directory, combined_deployment_directory, track_index_directory]:
+        os.makedirs(directory)
+
+    pd.DataFrame({"begin": ["2020-01-01T00:00:00Z"], "end": ["2020-01-01T12:00:00Z"]}).to_csv(
+        os.path.join(deployment_directory, "DEVICE.csv"), index=False
+    )
+    dump_data_frame_to_feather_file(
+        os.path.join(clean_ais_directory, "DEVICE_20200101T010000.000Z_cleaned.feather"),
+        get_cleaned_ais_data(request.param),
+    )
+
+    combine_deployment_ais_data(deployment_directory, clean_ais_directory, combined_deployment_directory)
+    build_track_index(deployment_directory, combined_deployment_directory, track_index_directory)
+
+    return combined_deployment_directory, track_index_directory
+
+
+def read_combined_ais_data(combined_deployment_directory):
+    return read_interpolated_ais_data(
+        *[
+            os.path.join(combined_deployment_directory, DEPLOYMENT_PREFIX + file_suffix)
+            for file_suffix in ["clean_ais_data.feather", "clean_interpolated_delta_ais_data.feather"]
+        ]
+    )
+
+
+def get_expected_intervals(data_frame, begin, end, radius, minimum_radius):
+    # Every minute bucket overlapping [begin, end], with all of its messages.
+    data_frame = data_frame.assign(minute=data_frame["pd_timestamp"].dt.floor("1min"))
+    data_frame = data_frame[(data_frame["minute"] >= pd.Timestamp(begin).floor("1min")) & (data_frame["minute"] <= pd.Timestamp(end))]
+
+    intervals = []
+    for mmsi, vessel_data_frame in data_frame.groupby("mmsi"):
+        minutes = vessel_data_frame.groupby("minute").agg(
+            minimum_distance=("distance_to_hydrophone", "min"), messages=("mmsi", "size")
+        )
+        minutes = minutes[(minutes["minimum_distance"] <= radius) & (minutes["minimum_distance"] >= minimum_radius)]
+
+        for minute, row in minutes.iterrows():
+            if intervals and intervals[-1]["mmsi"] == mmsi and intervals[-1]["end"] == minute:
+                intervals[-1]["end"] = minute + pd.Timedelta(minutes=1)
+                intervals[-1]["minimum_distance"] = min(intervals[-1]["minimum_distance"], row["minimum_distance"])
+                intervals[-1]["messages"] += row["messages"]
+            else:
+                intervals.append(
+                    {
+                        "mmsi": mmsi,
+                        "begin": minute,
+                        "end": minute + pd.Timedelta(minutes=1),
+                        "minimum_distance": row["minimum_distance"],
+                        "messages": row["messages"],
+                    }
+                )
+
+    return sorted(intervals, key=lambda interval: (interval["begin"], interval["mmsi"]))
+
+
+@pytest.mark.parametrize("begin, end, radius, minimum_radius", QUERIES)
+def test_query_track_index(directories, begin, end, radius, minimum_radius):
+    combined_deployment_directory, track_index_directory = directories
+
+    intervals = query_track_index(track_index_directory, "DEVICE", begin, end, radius, minimum_radius=minimum_radius)
+    expected = get_expected_intervals(
+        read_combined_ais_data(combined_deployment_directory), begin, end, radius, minimum_radius
+    )
+
+    assert intervals.shape[0] == len(expected)
+    for interval, expected_interval in zip(intervals.to_dict("records"), expected):
+        assert interval["mmsi"] == expected_interval["mmsi"]
+        assert interval["begin"] == expected_interval["begin"]
+        assert interval["end"] == expected_interval["end"]
+        assert interval["minimum_distance"] == pytest.approx(expected_interval["minimum_distance"], rel=1e-6)
+        assert interval["messages"] == expected_interval["messages"]
+
+
+@pytest.mark.parametrize("begin, end, radius, minimum_radius", QUERIES)
+def test_query_track_rows(directories, begin, end, radius, minimum_radius):
+    combined_deployment_directory, track_index_directory = directories
+
+    data_frame = query_track_rows(
+        track_index_directory, combined_deployment_directory, "DEVICE", begin, end, radius, minimum_radius=minimum_radius
+    )
+
+    expected = read_combined_ais_data(combined_deployment_directory)
+    expected = expected[
+        (expected["pd_timestamp"] >= pd.Timestamp(begin))
+        & (expected["pd_timestamp"] <= pd.Timestamp(end))
+        & (expected["distance_to_hydrophone"] <= radius)
+        & (expected["distance_to_hydrophone"] >= minimum_radius)
+    ]
+
+    assert data_frame.shape[0] == expected.shape[0]
+    if expected.shape[0]:
+        pd.testing.assert_frame_equal(data_frame, expected.reset_index(drop=True))
+
+    columns = ["pd_timestamp", "mmsi"]
+    data_frame = query_track_rows(
+        track_index_directory, combined_deployment_directory, "DEVICE", begin, end, radius,
+        minimum_radius=minimum_radius, columns=columns,
+    )
+
+    assert list(data_frame.columns) == columns
+    assert data_frame.shape[0] == expected.shape[0]
+    if expected.shape[0]:
+        assert list(data_frame["mmsi"]) == list(expected["mmsi"])
@@ -0,0 +1,208 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from identify import write_intervals
+from utils import (
+    dump_data_frame_to_feather_file,
+    get_feather_row_ranges,
+    get_interval_id,
+    pandas_timestamp_to_zulu_format,
+    read_data_frame_from_feather_file,
+    read_interpolated_ais_data,
+    read_interval_ais_data,
+    read_interval_ais_data_index,
+    read_intervals_ais_data,
+)
+
+DEPLOYMENT_BEGIN = pd.Timestamp("2020-01-01")
+DEPLOYMENT_END = pd.Timestamp("2020-01-02")
+
+# The AIS data of each device, from the first to the last message, with half an hour without messages.
+DEVICE_AIS_DATA = {
+    "DEVICEA": ("2020-01-01T01:00:00", "2020-01-01T03:00:00"),
+    "DEVICEB": ("2020-01-01T05:00:00", "2020-01-01T06:30:00"),
+}
+AIS_DATA_GAP = (pd.Timedelta(minutes=50), pd.Timedelta(minutes=80))
+
+
+def get_ais_data(random_state, first_message, last_message):
+    '''
+    AIS messages of three vessels, with messages exactly on the first and last
+    timestamps, and interpolated rows with the same timestamps as raw ones.
+    '''
+    seconds = int((pd.Timestamp(last_message) - pd.Timestamp(first_message)).total_seconds())
+    timestamps = pd.Timestamp(first_message) + pd.to_timedelta(
+        np.r_[0, np.sort(random_state.randint(0, seconds, 600)), seconds], unit="s"
+    )
+    timestamps = timestamps[
+        (timestamps < pd.Timestamp(first_message) + AIS_DATA_GAP[0])
+        | (timestamps > pd.Timestamp(first_message) + AIS_DATA_GAP[1])
+    ]
+
+    data_frame = pd.DataFrame(
+        {
+            "pd_timestamp": timestamps,
+            "mmsi": random_state.choice([316000001, 316000002, 316000003], timestamps.shape[0]),
+            "distance_to_hydrophone": random_state.uniform(0, 10000, timestamps.shape[0]),
+            "is_interpolated": random_state.rand(timestamps.shape[0]) < 0.3,
+        }
+    )
+    data_frame.loc[data_frame.index[::50], "is_interpolated"] = False
+    ties = data_frame.loc[data_frame.index[::50]].assign(is_interpolated=True)
+
+    return pd.concat([data_frame, ties], ignore_index=True).sort_values(by="pd_timestamp", kind="stable", ignore_index=True)
+
+
+def get_intervals(first_message, last_message):
+    '''
+    Intervals before, across and after the first and last messages, inside
+    the data, in the half hour without messages and long after the data.
+    With the minute of AIS data kept on each side, the intervals right before
+    and after the data end and begin exactly on the first and last messages.
+    '''
+    first_message = pd.Timestamp(first_message)
+    last_message = pd.Timestamp(last_message)
+
+    return [
+        [first_message - pd.Timedelta(minutes=30), first_message - pd.Timedelta(minutes=1)],
+        [first_message - pd.Timedelta(minutes=10), first_message + pd.Timedelta(minutes=10)],
+        [first_message + pd.Timedelta(minutes=10), first_message + pd.Timedelta(minutes=40)],
+        [first_message + AIS_DATA_GAP[0] + pd.Timedelta(minutes=5), first_message + AIS_DATA_GAP[1] - pd.Timedelta(minutes=5)],
+        [last_message - pd.Timedelta(minutes=10), last_message + pd.Timedelta(minutes=10)],
+        [last_message + pd.Timedelta(minutes=1), last_message + pd.Timedelta(minutes=30)],
+        [last_message + pd.Timedelta(minutes=60), last_message + pd.Timedelta(minutes=90)],
+    ]
+
+
+@pytest.fixture(scope="module")
+def interval_ais_data(tmp_path_factory):
+    root_path = tmp_path_factory.mktemp("interval_ais_data")
+    combined_deployment_directory = os.path.join(root_path, "combined")
+    scenario_intervals_directory = os.path.join(root_path, "scenarios")
+    interval_ais_data_directory = os.path.join(root_path, "intervals")
+    for directory in [combined_deployment_directory, scenario_intervals_directory, interval_ais_data_directory]:
+        os.makedirs(directory)
+
+    random_state = np.random.RandomState(31)
+    deployments = {}
+    for device, (first_message, last_message) in DEVICE_AIS_DATA.items():
+        deployment_files = [
+            os.path.join(
+                combined_deployment_directory,
+                "_".join(
+                    [
+                        device,
+                        pandas_timestamp_to_zulu_format(DEPLOYMENT_BEGIN),
+                        pandas_timestamp_to_zulu_format(DEPLOYMENT_END),
+                        file_suffix,
+                    ]
+                ),
+            )
+            for file_suffix in ["clean_ais_data.feather", "clean_interpolated_delta_ais_data.feather"]
+        ]
+
+        data_frame = get_ais_data(random_state, first_message, last_message)
+        dump_data_frame_to_feather_file(
+            deployment_files[0],
+            data_frame[~data_frame["is_interpolated"]].drop(columns="is_interpolated").reset_index(drop=True),
+        )
+        dump_data_frame_to_feather_file(deployment_files[1], data_frame[data_frame["is_interpolated"]].reset_index(drop=True))
+
+        # The intervals of the vessels repeat some of the background ones, so their ids are in both tables.
+        intervals = get_intervals(first_message, last_message)
+        for is_background, list_of_data_to_fetch, csv_name in [
+            (True, {5000: intervals[0::2], 3000: intervals[1::2]}, "background_intervals.csv"),
+            (False, {"in_01000_out_03000": intervals[2:4]}, "unique_vessel_intervals.csv"),
+        ]:
+            write_intervals(
+                list_of_data_to_fetch,
+                device,
+                DEPLOYMENT_BEGIN,
+                DEPLOYMENT_END,
+                scenario_intervals_directory,
+                interval_ais_data_directory,
+                deployment_files,
+                is_background=is_background,
+                csv_name=csv_name,
+            )
+
+        deployments[device] = (deployment_files, intervals)
+
+    return interval_ais_data_directory, deployments
+
+
+def get_expected_interval_ais_data(deployment_files, begin, end):
+    # The interval tables keep a minute of AIS data on each side of the intervals.
+    data_frame = read_interpolated_ais_data(*deployment_files)
+
+    return data_frame[
+        (data_frame["pd_timestamp"] >= begin - pd.Timedelta(minutes=1))
+        & (data_frame["pd_timestamp"] <= end + pd.Timedelta(minutes=1))
+    ].reset_index(drop=True)
+
+
+def test_feather_row_ranges(interval_ais_data):
+    _, deployments = interval_ais_data
+    raw_file = deployments["DEVICEA"][0][0]
+    timestamps = read_data_frame_from_feather_file(raw_file)["pd_timestamp"]
+
+    first_message = timestamps.iloc[0]
+    begins = pd.DatetimeIndex(
+        [first_message, first_message - pd.Timedelta(hours=1), timestamps.iloc[100], first_message + AIS_DATA_GAP[0], timestamps.iloc[-1]]
+    )
+    ends = pd.DatetimeIndex(
+        [first_message, first_message - pd.Timedelta(minutes=1), timestamps.iloc[200], first_message + AIS_DATA_GAP[1], timestamps.iloc[-1] + pd.Timedelta(hours=1)]
+    )
+
+    starts, stops = get_feather_row_ranges(raw_file, begins, ends)
+
+    for begin, end, start, stop in zip(begins, ends, starts, stops):
+        assert list(np.flatnonzero((timestamps >= begin) & (timestamps <= end))) == list(range(start, stop))
+    assert list(stops - starts) == [1, 0, 101, 0, 1]
+
+
+def test_interval_ais_data_index(interval_ais_data):
+    interval_ais_data_directory, deployments = interval_ais_data
+
+    index = read_interval_ais_data_index(interval_ais_data_directory)
+
+    # The intervals of the vessels are also background intervals of the same deployment, and are only kept once.
+    interval_ids = [get_interval_id(*interval) for _, intervals in deployments.values() for interval in intervals]
+    assert sorted(index.index) == sorted(interval_ids)
+    assert index.index.is_unique
+    assert set(index["raw_file"]) == {
+        os.path.relpath(deployment_files[0], interval_ais_data_directory) for deployment_files, _ in deployments.values()
+    }
+
+
+@pytest.mark.parametrize("device", list(DEVICE_AIS_DATA))
+@pytest.mark.parametrize("columns", [None, ["mmsi", "distance_to_hydrophone"], ["pd_timestamp", "is_interpolated"]])
+def test_interval_ais_data(interval_ais_data, device, columns):
+    interval_ais_data_directory, deployments = interval_ais_data
+    deployment_files, intervals = deployments[device]
+
+    empty_intervals = 0
+    for begin, end in intervals:
+        data_frame = read_interval_ais_data(interval_ais_data_directory, get_interval_id(begin, end), columns=columns)
+
+        expected = get_expected_interval_ais_data(deployment_files, begin, end)
+        expected = expected[columns if columns is not None else data_frame.columns]
+
+        pd.testing.assert_frame_equal(data_frame, expected, check_dtype=expected.shape[0] > 0)
+        empty_intervals += expected.shape[0] == 0
+
+    # Only the intervals in the half hour without messages and long after the data have no rows.
+    assert empty_intervals == 2
+
+    interval_ids = [get_interval_id(begin, end) for begin, end in intervals[::-1]]
+    data_frame = read_intervals_ais_data(interval_ais_data_directory, interval_ids, columns=columns)
+
+    for interval_position, interval_id in enumerate(interval_ids):
+        expected = read_interval_ais_data(interval_ais_data_directory, interval_id, columns=columns)
+        interval_data_frame = data_frame[data_frame["interval_position"] == interval_position]
+        interval_data_frame = interval_data_frame.drop(columns="interval_position").reset_index(drop=True)
+
+        pd.testing.assert_frame_equal(interval_data_frame[expected.columns], expected, check_dtype=expected.shape[0] > 0)
@@ -0,0 +1,45 @@
+import os
+import wave
+
+import numpy as np
+
+from wav_segments import WAV_CATALOG_COLUMNS, WAV_CATALOG_FILE, read_wav_catalog, update_wav_catalog
+
+
+def write_wav(path, frames, channels=1, sample_rate=8000, sample_width=2):
+    samples = np.random.RandomState(frames).randint(-3000, 3000, (frames, channels)).astype(np.int16)
+    with wave.open(path, "wb") as wav_file:
+        wav_file.setnchannels(channels)
+        wav_file.setsampwidth(sample_width)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(samples.tobytes())
+
+    return samples
+
+
+def test_wav_catalog(tmp_path):
+    write_wav(os.path.join(tmp_path, "a.wav"), 8000)
+    write_wav(os.path.join(tmp_path, "b.wav"), 4000, channels=2, sample_rate=16000)
+    with open(os.path.join(tmp_path, "broken.wav"), "wb") as broken_file:
+        broken_file.write(b"not a wav file")
+
+    catalog = update_wav_catalog(str(tmp_path), number_of_workers=1)
+
+    assert list(catalog.columns) == WAV_CATALOG_COLUMNS
+    assert list(catalog["file"]) == ["a.wav", "b.wav", "broken.wav"]
+    assert list(catalog["is_valid"]) == [True, True, False]
+    assert list(catalog["channels"]) == [1, 2, 0]
+    assert list(catalog["sample_rate"]) == [8000, 16000, 0]
+    assert list(catalog["frame_count"]) == [8000, 4000, 0]
+    assert list(catalog["duration"]) == [1.0, 0.25, 0.0]
+    assert catalog["frame_count"].dtype == np.int64 and catalog["is_valid"].dtype == bool
+    assert os.path.exists(os.path.join(tmp_path, WAV_CATALOG_FILE))
+
+    # Only the new and removed files change the catalog when it is updated again.
+    os.remove(os.path.join(tmp_path, "broken.wav"))
+    write_wav(os.path.join(tmp_path, "c.wav"), 800)
+
+    catalog = update_wav_catalog(str(tmp_path), number_of_workers=1)
+
+    assert list(catalog["file"]) == ["a.wav", "b.wav", "c.wav"]
+    assert read_wav_catalog(str(tmp_path))["c.wav"]["frame_count"] == 800